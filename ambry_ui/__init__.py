@@ -9,8 +9,6 @@ import templates as tdir
 from ambry.util import get_logger
 from flask import Flask, g
 from flask import Response, url_for, session
-from flask.json import JSONEncoder as FlaskJSONEncoder
-from flask.json import dumps
 from flask_login import LoginManager
 from flask_bootstrap import Bootstrap
 from flask_wtf.csrf import CsrfProtect
@@ -36,26 +34,172 @@ app_config = {
 
     'LOGGED_IN_USER': None,  # Name of user to auto-login
     'AMBRY_ADMIN_PASS': None,  # Name of user to auto-login
+
+    # Size of the per-worker database connection pool shared by all requests
+    'LIBRARY_POOL_SIZE': int(os.getenv('AMBRY_UI_POOL_SIZE', 5)),
+    'LIBRARY_POOL_OVERFLOW': int(os.getenv('AMBRY_UI_POOL_OVERFLOW', 5)),
+    'LIBRARY_POOL_RECYCLE': int(os.getenv('AMBRY_UI_POOL_RECYCLE', 3600)),  # Seconds
+
+    'CSV_FLUSH_SIZE': int(os.getenv('AMBRY_UI_CSV_FLUSH_SIZE', 128 * 1024)),  # Bytes per streamed CSV block
+    'MPACK_BATCH_ROWS': int(os.getenv('AMBRY_UI_MPACK_BATCH_ROWS', 10000)),  # Rows per streamed msgpack block
+
+    # Maximum size of the materialized CSV files for partitions. 0 disables them.
+    'ARTIFACT_CACHE_SIZE': int(os.getenv('AMBRY_UI_ARTIFACT_CACHE_SIZE', 10 * 1024 ** 3)),
+    'USE_X_SENDFILE': bool(os.getenv('AMBRY_UI_USE_X_SENDFILE', False)),
+
+    'CATALOG_TTL': int(os.getenv('AMBRY_UI_CATALOG_TTL', 300)),  # Seconds before the bundle catalog is reloaded
+
+    # Log a warning when a statement shape is executed more than this many times in one request. 0 disables it.
+    'QUERY_REPEAT_THRESHOLD': int(os.getenv('AMBRY_UI_QUERY_REPEAT_THRESHOLD', 20)),
+
+    # Maximum memory used by each worker's cache of plot dataframes, in bytes
+    'DATAFRAME_CACHE_SIZE': int(os.getenv('AMBRY_UI_DATAFRAME_CACHE_SIZE', 256 * 1024 ** 2)),
+
+    # Maximum points sent for each series of a time plot. 0 sends all of them
+    'PLOT_MAX_POINTS': int(os.getenv('AMBRY_UI_PLOT_MAX_POINTS', 1000)),
+
+    # Processes for converting notebooks to HTML, and seconds a page view waits for a conversion
+    'NOTEBOOK_WORKERS': int(os.getenv('AMBRY_UI_NOTEBOOK_WORKERS', 2)),
+    'NOTEBOOK_RENDER_TIMEOUT': float(os.getenv('AMBRY_UI_NOTEBOOK_RENDER_TIMEOUT', 10)),
+
+    # Directory shared by the workers for /metrics. Defaults to a directory in the library cache
+    'METRICS_DIR': os.getenv('AMBRY_UI_METRICS_DIR'),
+
+    # Client addresses that can read /metrics and /json/stats without logging in as an admin
+    'METRICS_ALLOW': [a.strip() for a in os.getenv('AMBRY_UI_METRICS_ALLOW', '127.0.0.1,::1').split(',')
+                      if a.strip()],
+
+    # Maximum size of the in-process tier of the object cache, in bytes of pickled values
+    'OBJECT_CACHE_SIZE': int(os.getenv('AMBRY_UI_OBJECT_CACHE_SIZE', 64 * 1024 ** 2)),
+
+    # Maximum size of the shared directory tier of the object cache, in bytes. 0 doesn't limit it
+    'OBJECT_DISK_CACHE_SIZE': int(os.getenv('AMBRY_UI_OBJECT_DISK_CACHE_SIZE', 1024 ** 3)),
 }
 
 if os.getenv('AMBRY_ADMIN_PASS'):
     app_config['AMBRY_ADMIN_PASS'] ==os.getenv('AMBRY_ADMIN_PASS')
 
 
-class JSONEncoder(FlaskJSONEncoder):
-    def default(self, o):
-        return str(type(o))
+_library = None  # (pid, Library) for the process that opened the library
+_library_locks = {}
+
+
+def _library_lock():
+    """Return the lock for opening the library in this process. A forked child gets its own lock, since its
+    copy of the parent's lock may be held by a thread that doesn't exist in the child. setdefault() is atomic,
+    so every thread of a process gets the same lock. """
+    import threading
+
+    pid = os.getpid()
+
+    try:
+        return _library_locks[pid]
+    except KeyError:
+        return _library_locks.setdefault(pid, threading.Lock())
+
+
+_library_lock()  # Create the lock for this process at import
+
+
+def _ping_connection(dbapi_connection, connection_record, connection_proxy):
+    """Pool checkout listener that tests the connection before handing it out, so connections
+    dropped by the server are replaced instead of failing the request"""
+    from sqlalchemy import exc
+
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute('SELECT 1')
+    except Exception:
+        raise exc.DisconnectionError()  # The pool will retry with a new connection
+    finally:
+        cursor.close()
+
+
+def bounded_pool(pool, config):
+    """Return a QueuePool with the configured size, with the same connection creator, dialect, reset
+    behavior and event listeners as the pool that the engine was created with. Ambry creates the engine,
+    so the sizes can't be passed to create_engine(). """
+    from sqlalchemy.pool import QueuePool
+
+    return QueuePool(pool._creator,
+                     pool_size=config['LIBRARY_POOL_SIZE'],
+                     max_overflow=config['LIBRARY_POOL_OVERFLOW'],
+                     recycle=config['LIBRARY_POOL_RECYCLE'],
+                     echo=pool.echo,
+                     logging_name=pool._orig_logging_name,
+                     reset_on_return=pool._reset_on_return,
+                     _dispatch=pool.dispatch,  # Listeners for the engine's connect and checkout events
+                     _dialect=pool._dialect)
+
+
+def scope_sessions(database):
+    """Give each thread its own session, rather than sharing the database's one session between requests.
+
+    Ambry's Database.session property returns Database._session, and only creates a session from
+    Database.Session when _session is None, so setting _session to a scoped_session makes every use of
+    database.session go to the current thread's session. test_session_per_thread checks this, and this
+    function fails at startup if the property stops returning _session. """
+    from sqlalchemy.orm import scoped_session, sessionmaker
+
+    if database._session is not None:
+        database._session.close()
+
+    database.Session = sessionmaker(bind=database.engine)
+    database._session = scoped_session(database.Session)
+
+    if not isinstance(database.session, scoped_session):
+        raise RuntimeError("Database.session doesn't return Database._session; can't scope sessions to threads")
+
+
+def _open_library(config):
+    """Create the Library shared by all of the requests in a worker, and replace the engine's
+    connection pool with a bounded pool that is health-checked on checkout"""
+    from ambry.library import Library
+    from ambry.run import get_runconfig
+    from sqlalchemy import event
+    from queries import instrument
+
+    l = Library(get_runconfig(), read_only=True, echo=False)
+
+    engine = l.database.engine
+
+    if engine.name != 'sqlite':  # Sqlite uses one connection per thread, so pool sizes don't apply.
+        old_pool = engine.pool
+        engine.pool = bounded_pool(old_pool, config)
+        old_pool.dispose()
+
+    event.listen(engine.pool, 'checkout', _ping_connection)
+
+    instrument(engine)
+
+    scope_sessions(l.database)
+
+    return l
+
+
+def get_library():
+    """Return the Library for this worker process, creating it on first use. The
+    library is re-created after a fork, since connections can't be shared between processes. """
+    global _library
+
+    pid = os.getpid()
+
+    opened = _library
+    if opened is not None and opened[0] == pid:
+        return opened[1]
+
+    with _library_lock():
+        if _library is None or _library[0] != pid:
+            _library = (pid, _open_library(app.config))
+
+        return _library[1]
 
 
 class AmbryAppContext(object):
     """Ambry specific objects for the application context"""
 
     def __init__(self):
-        from ambry.library import Library
-        from ambry.run import get_runconfig
-
-        rc = get_runconfig()
-        self.library = Library(rc, read_only=True, echo=False)
+        self.library = get_library()
 
     def render(self, template, *args, **kwargs):
         from flask import render_template
@@ -110,15 +254,34 @@ class AmbryAppContext(object):
             abort(404)
 
     def json(self, **kwargs):
-        return Response(dumps(kwargs, cls=JSONEncoder), mimetype='application/json')
+        from encoding import dumps
+
+        return Response(dumps(kwargs), mimetype='application/json')
+
+    def json_stream(self, key, items, **kwargs):
+        """Return a streamed JSON response for an object with the kwargs and a long list of items
+        under key"""
+        from flask import stream_with_context
+        from encoding import iter_list
 
-    def close(self):
-        self.library.close()
+        return Response(stream_with_context(iter_list(key, items, **kwargs)), mimetype='application/json')
+
+    def close(self, exception=None):
+        """Discard the request thread's session at the end of a request, rolling back uncommitted
+        changes and returning its connection to the pool. Other threads' sessions aren't affected. """
+
+        session = self.library.database.session
+
+        try:
+            if exception is not None:
+                session.rollback()
+        finally:
+            session.remove()
 
 
 def get_aac():  # Ambry Application Context
-    """Opens a new database connection if there is none yet for the
-    current application context.
+    """Return the Ambry context for the current application context, which wraps the
+    worker's shared library.
     """
     if not hasattr(g, 'aac'):
         g.aac = AmbryAppContext()
@@ -126,15 +289,35 @@ def get_aac():  # Ambry Application Context
     return g.aac
 
 
+_change_listeners = []
+
+
+def on_library_change(f):
+    """Decorator that registers a function to be called when bundles are added to or removed from the
+    library. The function is called with the library, the event name and the bundle vid. """
+    _change_listeners.append(f)
+    return f
+
+
+def library_changed(library, event, vid=None):
+    """Notify the listeners that the library has changed.
+
+    :param library: The library
+    :param event: 'checkin', 'remove', 'sync', or 'save' for a source file saved in Jupyter
+    :param vid: The vid of the bundle that changed, if known.
+    """
+    for f in _change_listeners:
+        try:
+            f(library, event, vid)
+        except Exception as e:
+            logger.error("Library change listener {} failed: {}".format(f.__name__, e))
+
+
 class Application(Flask):
 
     def __init__(self, app_config, import_name, static_path=None, static_url_path=None, static_folder='static',
                  template_folder='templates', instance_path=None, instance_relative_config=False):
 
-        from flask.ext.cache import Cache
-        from ambry.library import Library
-        from ambry.run import get_runconfig
-
         self._initialized = False
         self.csrf = CsrfProtect()
         self.login_manager = LoginManager()
@@ -144,23 +327,11 @@ class Application(Flask):
 
         self.config.update(app_config)
 
-
-        l = Library(get_runconfig(), read_only=True, echo=False)
-
-        self.cache = Cache(config={'CACHE_TYPE': 'filesystem', 'CACHE_DIR': l.filesystem.cache('ui')})
-        self.cache.init_app(self)
-
-
-
-
     def __call__(self, environ, start_response):
 
         if not self._initialized:
-            from ambry.library import Library
-            from ambry.run import get_runconfig
 
-            rc = get_runconfig()
-            l = Library(rc, read_only=True, echo=False)
+            l = get_library()
 
             secret_key = None
 
@@ -198,6 +369,7 @@ class Application(Flask):
             self.login_manager.init_app(app)
             Bootstrap(app)
 
+            l.database.session.close()
 
             self._initialized = True
 
@@ -206,12 +378,21 @@ class Application(Flask):
 
 app = Application(app_config, __name__)
 
+from encoding import JSONEncoder
+app.json_encoder = JSONEncoder
+
+import queries
+queries.init_app(app)
+
+import metrics
+metrics.init_app(app)
+
 @app.teardown_appcontext
 def close_connection(exception):
 
     aac = getattr(g, 'aac', None)
     if aac is not None:
-        aac.close()
+        aac.close(exception)
 
 
 # Flask Magic. The views have to be imported for Flask to use them.
@@ -220,3 +401,8 @@ import ambry_ui.jsonviews
 import ambry_ui.api
 import ambry_ui.user
 import ambry_ui.plots
+import ambry_ui.catalog
+import ambry_ui.cache
+import ambry_ui.changes
+import ambry_ui.notebooks
+import ambry_ui.cube
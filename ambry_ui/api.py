@@ -5,7 +5,7 @@ API Views, return javascript rendietions of objects and allowing modification of
 import os
 import logging
 
-from . import app, get_aac
+from . import app, get_aac, library_changed
 
 from flask import Flask, g, current_app, send_from_directory, send_file, request, abort, url_for
 from flask.json import jsonify
@@ -225,10 +225,14 @@ def bundle_delete(ref):
     from ambry.orm.exc import NotFoundError
 
     try:
-        aac.library.remove(aac.bundle(ref))
+        b = aac.bundle(ref)
+        vid = b.identity.vid
+        aac.library.remove(b)
     except NotFoundError:
         abort(404)
 
+    library_changed(aac.library, 'remove', vid)
+
     return aac.json(
         ok=True
     )
@@ -303,6 +307,8 @@ def bundle_build_files_put(vid, name):
 
     fs.setcontent(request.content)
 
+    library_changed(aac.library, 'save', vid)
+
     return aac.json(
         file=fs.record.dict
     )
@@ -326,6 +332,8 @@ def bundle_build_checkin_post(vid):
 
     aac.library.checkin_bundle(path, cb)
 
+    library_changed(aac.library, 'checkin', vid)
+
     return aac.json(
         result='ok'
     )
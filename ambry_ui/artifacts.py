@@ -0,0 +1,289 @@
+"""Materialized CSV files for partitions.
+
+Partition versions never change, so the CSV rendition of a partition is written once, along with a gzipped
+copy, into the UI cache, and later downloads are served directly from the files.
+
+Copyright (c) 2015 Civic Knowledge. This file is licensed under the terms of
+the Revised BSD License, included in this distribution as LICENSE.txt
+"""
+
+import os
+
+INDEX_INTERVAL = 10000  # Rows between entries in the row offset index
+EVICT_GRACE = 600  # Seconds since a file was last used before it can be evicted, for downloads in progress
+
+
+class TooLarge(Exception):
+    """The files for a partition are larger than the whole cache"""
+
+
+class ArtifactCache(object):
+    """A size-bounded directory of CSV and gzipped CSV files for partitions, evicted in least recently
+    used order.
+
+    Each CSV file has a sparse index, in <vid>.csv.idx, of the byte offsets of every INDEX_INTERVAL'th
+    row, so a range of rows can be read by seeking close to it.
+
+    :param library: The library, which provides the cache directory and the partitions
+    :param max_size: Maximum total size of the files in bytes, or None for no limit
+    :param flush_size: Block size for the CSV encoder
+    """
+
+    def __init__(self, library, max_size=None, flush_size=None):
+        from streaming import DEFAULT_FLUSH_SIZE
+
+        self.library = library
+        self.max_size = max_size
+        self.flush_size = flush_size or DEFAULT_FLUSH_SIZE
+        self.root = library.filesystem.cache('ui/artifacts')
+        self.lock_dir = library.filesystem.cache('ui/locks')
+
+    def path(self, pvid, ext='csv'):
+        return os.path.join(self.root, '{}.{}'.format(pvid, ext))
+
+    def exists(self, pvid):
+        return all(os.path.exists(self.path(pvid, ext)) for ext in ('csv.idx', 'csv.gz', 'csv'))
+
+    def too_large(self, pvid):
+        """Return True if an earlier build found that the files for a partition don't fit in the cache. The
+        marker file holds the cache size the build was limited to, so it is ignored if the cache grows. """
+        try:
+            with open(self.path(pvid, 'toolarge')) as f:
+                limit = int(f.read().strip() or 0)
+        except (IOError, ValueError):
+            return False
+
+        return self.max_size is not None and self.max_size <= limit
+
+    def get(self, p, wait=True):
+        """Return the paths to the CSV and gzipped CSV files for a partition, building them if they
+        don't exist yet. Returns None if the files are too large to be kept in the cache.
+
+        :param wait: If False, and the files don't exist, start building them on a background thread and
+            return None, for requests that would otherwise wait longer than the server's timeout.
+        """
+        from singleflight import run
+
+        if self.too_large(p.vid):
+            return None
+
+        if not self.exists(p.vid):
+            if not wait:
+                self.start_build(p.vid)
+                return None
+
+            run('artifact', p.vid, lambda: self.build(p), lock_dir=self.lock_dir)
+
+        paths = self.path(p.vid, 'csv'), self.path(p.vid, 'csv.gz')
+
+        for path in paths + (self.path(p.vid, 'csv.idx'),):
+            self.touch(path)
+
+        if not self.exists(p.vid):
+            return None
+
+        return paths
+
+    def start_build(self, pvid):
+        """Build the files for a partition on a background thread, unless they are already being built. The
+        thread gets the partition from the library itself, since the request's session is closed when the
+        request ends. Returns the thread, or None. """
+        from singleflight import start
+
+        def build():
+            try:
+                self.build(self.library.partition(pvid))
+            finally:
+                database = getattr(self.library, 'database', None)
+
+                if database is not None:
+                    database.session.remove()  # The thread's own session, from scope_sessions()
+
+        return start('artifact', pvid, build, lock_dir=self.lock_dir)
+
+    def touch(self, path):
+        """Mark a file as recently used"""
+        try:
+            os.utime(path, None)
+        except OSError:  # Evicted by another process
+            pass
+
+    def build(self, p, force=False):
+        """Write the CSV and gzipped CSV files and the row index for a partition. The files are written
+        to temporary names and renamed into place, so readers never see a partial file.
+
+        If the files grow larger than the whole cache, the build stops, and a marker file records that the
+        partition is too large, so later requests stream it without trying again.
+
+        :return: True if the files were built, False if they exist or are too large to be cached
+        """
+        from streaming import CsvEncoder
+        from tempfile import mkstemp
+        import gzip
+        import json
+
+        if (self.exists(p.vid) or self.too_large(p.vid)) and not force:
+            return False
+
+        p.localize()
+
+        reader = p.reader
+
+        csv_fd, csv_tmp = mkstemp(dir=self.root, prefix='.' + p.vid, suffix='.csv')
+        gz_fd, gz_tmp = mkstemp(dir=self.root, prefix='.' + p.vid, suffix='.csv.gz')
+        idx_fd, idx_tmp = mkstemp(dir=self.root, prefix='.' + p.vid, suffix='.csv.idx')
+
+        try:
+            encoder = CsvEncoder(self.flush_size, index_interval=INDEX_INTERVAL)
+
+            with os.fdopen(csv_fd, 'wb') as csv_f, os.fdopen(gz_fd, 'wb') as gz_raw:
+                gz_f = gzip.GzipFile(filename=p.vid + '.csv', fileobj=gz_raw, mode='wb', mtime=0)
+
+                for block in encoder(reader.headers, reader.rows):
+                    csv_f.write(block)
+                    gz_f.write(block)
+
+                    if self.max_size is not None and csv_f.tell() + gz_raw.tell() > self.max_size:
+                        raise TooLarge()
+
+                gz_f.close()
+
+            with os.fdopen(idx_fd, 'wb') as idx_f:
+                json.dump(dict(interval=INDEX_INTERVAL, rows=encoder.n_rows, offsets=encoder.offsets), idx_f)
+
+            os.rename(idx_tmp, self.path(p.vid, 'csv.idx'))
+            os.rename(gz_tmp, self.path(p.vid, 'csv.gz'))
+            os.rename(csv_tmp, self.path(p.vid, 'csv'))
+
+        except TooLarge:
+            self._remove(csv_tmp, gz_tmp, idx_tmp)
+
+            with open(self.path(p.vid, 'toolarge'), 'w') as f:
+                f.write(str(self.max_size))
+
+            return False
+
+        except:
+            self._remove(csv_tmp, gz_tmp, idx_tmp)
+            raise
+
+        self._remove(self.path(p.vid, 'toolarge'))
+
+        self.evict(keep=(p.vid,))
+
+        return True
+
+    @staticmethod
+    def _remove(*paths):
+        for fn in paths:
+            if os.path.exists(fn):
+                os.remove(fn)
+
+    def rows(self, p, offset, limit):
+        """Return the headers, the total number of rows, and up to limit rows starting at row offset, as
+        lists of strings, reading from the CSV file. Returns None if the file can't be cached. """
+        from itertools import islice
+        import unicodecsv as csv
+        import json
+
+        if not self.get(p):
+            return None
+
+        with open(self.path(p.vid, 'csv.idx')) as f:
+            index = json.load(f)
+
+        with open(self.path(p.vid, 'csv'), 'rb') as f:
+            reader = csv.reader(f)
+            headers = next(reader)
+
+            offsets = index['offsets']
+            i = offset // index['interval']
+
+            if offset >= index['rows']:
+                return headers, index['rows'], []
+            elif i < len(offsets):
+                f.seek(offsets[i])
+                reader = csv.reader(f)  # The old reader may have read ahead of the seek
+                skip = offset - i * index['interval']
+            else:
+                skip = offset
+
+            rows = list(islice(reader, skip, skip + limit))
+
+        return headers, index['rows'], rows
+
+    def files(self):
+        """Return (mtime, size, path) for each of the cached files, oldest first"""
+
+        files = []
+
+        for fn in os.listdir(self.root):
+            if fn.startswith('.') or fn.endswith('.toolarge'):  # Files being built, and markers
+                continue
+
+            path = os.path.join(self.root, fn)
+
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+
+            files.append((st.st_mtime, st.st_size, path))
+
+        return sorted(files)
+
+    @property
+    def size(self):
+        return sum(size for _, size, _ in self.files())
+
+    def evict(self, max_size=None, keep=(), grace=None):
+        """Remove the least recently used files until the total size is no more than max_size,
+        which defaults to the size the cache was created with. Returns the paths of the removed files.
+
+        :param keep: Vids of partitions whose files must not be removed, such as one that was just built
+        :param grace: Files used within this many seconds are not removed, since they may be being sent
+            by another worker. Defaults to EVICT_GRACE, or 0 when max_size is given.
+        """
+        import time
+
+        if grace is None:
+            grace = EVICT_GRACE if max_size is None else 0
+
+        max_size = self.max_size if max_size is None else max_size
+
+        if max_size is None:
+            return []
+
+        files = self.files()
+        total = sum(size for _, size, _ in files)
+        removed = []
+        keep = tuple(str(vid) + '.' for vid in keep)
+        recent = time.time() - grace
+
+        for mtime, size, path in files:
+            if total <= max_size:
+                break
+
+            if os.path.basename(path).startswith(keep) or mtime > recent:
+                continue
+
+            try:
+                os.remove(path)
+                removed.append(path)
+            except OSError:
+                pass
+
+            total -= size
+
+        return removed
+
+    def clean(self):
+        """Remove all of the files and the too-large markers. Returns the paths of the removed files"""
+        import glob
+
+        removed = self.evict(0)
+
+        for path in glob.glob(os.path.join(self.root, '*.toolarge')):
+            os.remove(path)
+
+        return removed
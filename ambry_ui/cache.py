@@ -0,0 +1,428 @@
+"""A two tier cache for computed objects, such as measure and dimension configurations.
+
+The first tier is an in-process LRU, bounded by the total pickled size of the values. The second is a
+directory of pickle files in the library's cache, which is shared by all of the worker processes. Values
+are found in the memory tier, then the disk tier, and are computed and stored in both on a miss. The disk
+tier is bounded too: when a worker has written a tenth of its maximum size, the least recently used files
+are removed.
+
+Keys are namespaced, and grouped by the bundle that the vid they are stored with belongs to, so all of
+the values for a bundle and its partitions are removed when it is checked in again or removed from the
+library. Other workers clear their memory tier when the library change counter changes.
+
+Copyright (c) 2015 Civic Knowledge. This file is licensed under the terms of
+the Revised BSD License, included in this distribution as LICENSE.txt
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from . import app, on_library_change
+
+MISSING = object()
+GLOBAL_GROUP = '_global'
+EVICT_FRACTION = 0.1  # Check the size of the disk tier after writing this fraction of its maximum size
+
+
+def bundle_vid(vid):
+    """Return the vid of the bundle for a bundle, partition, table or column vid, which is the group
+    its cached values are stored in"""
+    from ambry.identity import ObjectNumber
+
+    if not vid:
+        return GLOBAL_GROUP
+
+    try:
+        return str(ObjectNumber.parse(vid).as_dataset)
+    except (ValueError, TypeError, AttributeError):
+        return str(vid)
+
+
+class MemoryLRU(object):
+    """A least recently used cache of values, bounded by the total of the sizes given for the values"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items = OrderedDict()  # key -> (value, size, group)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        with self._lock:
+            try:
+                item = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return MISSING
+
+            self.hits += 1
+            self._items[key] = item  # Move to the most recently used end
+
+            return item[0]
+
+    def set(self, key, value, size, group=None):
+        """Store a value, evicting least recently used values until the total size fits. Values larger
+        than the whole cache are not stored. """
+        with self._lock:
+            if key in self._items:
+                self.size -= self._items.pop(key)[1]
+
+            if size > self.max_bytes:
+                return False
+
+            self._items[key] = (value, size, group)
+            self.size += size
+
+            while self.size > self.max_bytes:
+                _, (_, s, _) = self._items.popitem(last=False)
+                self.size -= s
+                self.evictions += 1
+
+            return True
+
+    def stats(self):
+        with self._lock:
+            return dict(items=len(self._items), bytes=self.size, hits=self.hits, misses=self.misses,
+                        evictions=self.evictions)
+
+    def remove_group(self, group):
+        with self._lock:
+            for key in [k for k, (_, _, g) in self._items.items() if g == group]:
+                self.size -= self._items.pop(key)[1]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+
+
+class DiskCache(object):
+    """Pickled values in files, in a directory for each group.
+
+    :param root: Directory for the files
+    :param max_bytes: If set, the maximum total size of the files. The least recently used files are
+        removed when the files written by this process since the last check add up to EVICT_FRACTION
+        of it.
+    """
+
+    def __init__(self, root, max_bytes=None):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.evictions = 0
+        self._written = 0
+        self._lock = threading.Lock()
+
+    def path(self, group, key):
+        return os.path.join(self.root, group, key + '.pkl')
+
+    def get(self, group, key):
+        """Return the pickled value, or None if it isn't in the cache"""
+        path = self.path(group, key)
+
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except IOError:
+            return None
+
+        try:
+            os.utime(path, None)  # Mark it as recently used, for eviction
+        except OSError:
+            pass
+
+        return data
+
+    def set(self, group, key, data):
+        from tempfile import mkstemp
+
+        d = os.path.join(self.root, group)
+
+        if not os.path.exists(d):
+            try:
+                os.makedirs(d)
+            except OSError:  # Created by another process
+                pass
+
+        fd, tmp = mkstemp(dir=d, prefix='.' + key)
+
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmp, self.path(group, key))
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+        if self.max_bytes:
+            with self._lock:
+                self._written += len(data)
+                check = self._written >= self.max_bytes * EVICT_FRACTION
+                if check:
+                    self._written = 0
+
+            if check:
+                self.evict()
+
+    def files(self):
+        """Return (mtime, size, path) for each of the cached files, oldest first"""
+
+        files = []
+
+        for group in os.listdir(self.root):
+            d = os.path.join(self.root, group)
+
+            try:
+                names = os.listdir(d)
+            except OSError:  # Removed by another process, or not a directory
+                continue
+
+            for fn in names:
+                if fn.startswith('.'):  # Files being written
+                    continue
+
+                path = os.path.join(d, fn)
+
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+
+                files.append((st.st_mtime, st.st_size, path))
+
+        return sorted(files)
+
+    def evict(self, max_bytes=None):
+        """Remove the least recently used files until the total size is no more than max_bytes, which
+        defaults to the size the cache was created with. Returns the number of files removed. """
+
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+
+        if max_bytes is None:
+            return 0
+
+        files = self.files()
+        total = sum(size for _, size, _ in files)
+        removed = 0
+
+        for _, size, path in files:
+            if total <= max_bytes:
+                break
+
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:  # Removed by another process
+                pass
+
+            total -= size
+
+        with self._lock:
+            self.evictions += removed
+
+        return removed
+
+    def remove_group(self, group):
+        import shutil
+
+        shutil.rmtree(os.path.join(self.root, group), ignore_errors=True)
+
+    def clear(self):
+        for group in os.listdir(self.root):
+            self.remove_group(group)
+
+
+class TieredCache(object):
+    """An in-process LRU in front of a shared directory of pickle files.
+
+    :param root: Directory for the disk tier
+    :param max_bytes: Maximum total pickled size of the values in the memory tier
+    :param disk_max_bytes: If set, the maximum total size of the files in the disk tier
+    :param generation: If set, a function that returns the library change counter. The memory tier is
+        cleared when it changes, checked at most every check_interval seconds.
+    :param group: Function that returns the group for a vid. Defaults to bundle_vid()
+    """
+
+    def __init__(self, root, max_bytes, generation=None, group=None, check_interval=1.0, disk_max_bytes=None):
+        self.memory = MemoryLRU(max_bytes)
+        self.disk = DiskCache(root, disk_max_bytes)
+        self.generation = generation
+        self.group = group or bundle_vid
+        self.check_interval = check_interval
+        self._generation = None
+        self._checked = 0
+        self._lock = threading.Lock()
+        self._counters = dict(memory_hits=0, disk_hits=0, misses=0, sets=0, invalidations=0)
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    @staticmethod
+    def key(namespace, vid, *args, **kwargs):
+        """Return the key for a value, which includes the namespace, the vid, and a hash of the other
+        arguments"""
+        from hashlib import sha1
+
+        h = sha1(repr((args, sorted(kwargs.items())))).hexdigest()
+
+        return '{}-{}-{}'.format(namespace, vid, h)
+
+    def _check_generation(self):
+        if not self.generation or time.time() - self._checked < self.check_interval:
+            return
+
+        g = self.generation()
+
+        with self._lock:
+            self._checked = time.time()
+            changed = self._generation is not None and g != self._generation
+            self._generation = g
+
+        if changed:
+            self.memory.clear()
+
+    def get(self, namespace, vid, *args, **kwargs):
+        """Return a value, or MISSING if it isn't in either tier"""
+        import cPickle as pickle
+
+        self._check_generation()
+
+        key = self.key(namespace, vid, *args, **kwargs)
+
+        v = self.memory.get(key)
+
+        if v is not MISSING:
+            self._count('memory_hits')
+            return v
+
+        group = self.group(vid)
+
+        data = self.disk.get(group, key)
+
+        if data is None:
+            self._count('misses')
+            return MISSING
+
+        try:
+            v = pickle.loads(data)
+        except Exception:  # Truncated or from an incompatible version
+            self._count('misses')
+            return MISSING
+
+        self._count('disk_hits')
+        self.memory.set(key, v, len(data), group)
+
+        return v
+
+    def set(self, namespace, vid, value, *args, **kwargs):
+        """Store a value in both tiers"""
+        import cPickle as pickle
+
+        key = self.key(namespace, vid, *args, **kwargs)
+        group = self.group(vid)
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+        self.memory.set(key, value, len(data), group)
+        self.disk.set(group, key, data)
+
+        self._count('sets')
+
+    def get_or_set(self, namespace, vid, f, *args, **kwargs):
+        """Return the cached value, or call f(vid, *args, **kwargs) and cache its return value"""
+
+        v = self.get(namespace, vid, *args, **kwargs)
+
+        if v is MISSING:
+            v = f(vid, *args, **kwargs)
+            self.set(namespace, vid, v, *args, **kwargs)
+
+        return v
+
+    def invalidate(self, vid=None):
+        """Remove the values for the bundle that a vid belongs to, or all values if vid is None"""
+
+        if vid is None:
+            self.memory.clear()
+            self.disk.clear()
+        else:
+            group = self.group(vid)
+            self.memory.remove_group(group)
+            self.disk.remove_group(group)
+
+        self._count('invalidations')
+
+    def stats(self):
+        with self._lock:
+            d = dict(self._counters)
+
+        d.update(evictions=self.memory.evictions, memory_items=len(self.memory), memory_bytes=self.memory.size,
+                 disk_evictions=self.disk.evictions)
+
+        return d
+
+
+_cache = None  # (pid, TieredCache) for the process that created it
+_cache_locks = {}  # pid -> lock for creating the cache, like the library's locks
+
+
+def _cache_lock():
+    pid = os.getpid()
+
+    try:
+        return _cache_locks[pid]
+    except KeyError:
+        return _cache_locks.setdefault(pid, threading.Lock())
+
+
+def get_cache(library=None):
+    """Return the cache for this worker process, creating it on first use, in the cache directory of
+    the given library or the worker's library"""
+    from . import get_library
+    from catalog import generation
+    global _cache
+
+    pid = os.getpid()
+
+    created = _cache
+    if created is not None and created[0] == pid:
+        return created[1]
+
+    l = library or get_library()  # Before taking the lock, since opening the library takes its own
+
+    with _cache_lock():
+        if _cache is None or _cache[0] != pid:
+            _cache = (pid, TieredCache(l.filesystem.cache('ui/objects'), app.config['OBJECT_CACHE_SIZE'],
+                                       generation=lambda: generation(l),
+                                       disk_max_bytes=app.config['OBJECT_DISK_CACHE_SIZE'] or None))
+
+        return _cache[1]
+
+
+def memoize(namespace):
+    """Decorator that caches the return value of a function whose first argument is a vid. Callers
+    share the returned value, so they must not modify it. """
+
+    def decorator(f):
+
+        @wraps(f)
+        def wrapper(vid, *args, **kwargs):
+            return get_cache().get_or_set(namespace, vid, f, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@on_library_change
+def invalidate_cache(library, event, vid):
+    get_cache(library).invalidate(vid)
@@ -0,0 +1,163 @@
+"""An in-memory catalog of summary records for the bundles in the library.
+
+The index page and the /json bundle list need a few values for every bundle, which, read through each
+bundle's metadata and build state accessors, costs several queries per bundle. The catalog loads them
+for all bundles at once, and keeps them until the library changes.
+
+Changes are tracked with a generation number in a file in the UI cache, which is incremented by
+library_changed(), so all of the workers see changes made through any of them. Records also expire after
+a time, to pick up changes made outside of the UI.
+
+Copyright (c) 2015 Civic Knowledge. This file is licensed under the terms of
+the Revised BSD License, included in this distribution as LICENSE.txt
+"""
+
+import os
+import threading
+import time
+
+from . import app, on_library_change
+
+
+def _generation_file(library):
+    return os.path.join(library.filesystem.cache('ui'), 'generation')
+
+
+def generation(library):
+    """Return the library change counter"""
+    try:
+        with open(_generation_file(library)) as f:
+            return int(f.read() or 0)
+    except (IOError, ValueError):
+        return 0
+
+
+def bump_generation(library):
+    """Increment the library change counter, and return the new value"""
+    import fcntl
+
+    with open(_generation_file(library), 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.seek(0)
+            try:
+                g = int(f.read() or 0) + 1
+            except ValueError:
+                g = 1
+            f.seek(0)
+            f.truncate()
+            f.write(str(g))
+            f.flush()
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+    return g
+
+
+def _isoformat(t):
+    from datetime import datetime
+
+    try:
+        return datetime.fromtimestamp(float(t)).isoformat() if t else None
+    except (TypeError, ValueError):
+        return None
+
+
+def load_records(library):
+    """Load the summary records for all bundles, with one query for the datasets and one for the
+    metadata and build state values. """
+    from ambry.orm import Config
+    from sqlalchemy import and_, or_
+
+    session = library.database.session
+
+    datasets = library.datasets
+
+    q = (session.query(Config.d_vid, Config.type, Config.key, Config.value)
+         .filter(or_(and_(Config.type == 'metadata', Config.group == 'about',
+                          Config.key.in_(('title', 'summary', 'access'))),
+                     and_(Config.type == 'buildstate', Config.group == 'state',
+                          Config.key.in_(('new', 'lasttime', 'current'))))))
+
+    values = {}
+
+    for d_vid, type_, key, value in q:
+        values.setdefault(d_vid, {})[(type_, key)] = value
+
+    records = []
+
+    for ds in datasets:
+        d = ds.dict
+        v = values.get(ds.vid, {})
+
+        records.append(dict(
+            vid=ds.vid,
+            name=d.get('name'),
+            vname=d.get('vname'),
+            title=v.get(('metadata', 'title')),
+            summary=v.get(('metadata', 'summary')),
+            access=v.get(('metadata', 'access')),
+            created=_isoformat(v.get(('buildstate', 'new'))),
+            created_time=v.get(('buildstate', 'new')),
+            updated=_isoformat(v.get(('buildstate', 'lasttime'))),
+            updated_time=v.get(('buildstate', 'lasttime')),
+            state=d.get('state') or v.get(('buildstate', 'current')),
+            dataset=d
+        ))
+
+    return records
+
+
+def fingerprint(records):
+    from hashlib import sha1
+
+    return sha1(repr(sorted((r['vid'], r['state'], r['updated_time']) for r in records))).hexdigest()
+
+
+class Catalog(object):
+    """Summary records for all of the bundles, reloaded when the library generation changes or the
+    records are older than ttl seconds. """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._records = None
+        self._fingerprint = None
+        self._generation = None
+        self._loaded = 0
+
+    def records(self, library):
+        """Return the list of records, reloading them if they are out of date"""
+
+        g = generation(library)
+
+        with self._lock:
+            if self._records is None or g != self._generation or time.time() - self._loaded > self.ttl:
+                self._records = load_records(library)
+                self._fingerprint = fingerprint(self._records)
+                self._generation = g
+                self._loaded = time.time()
+
+            return self._records
+
+    def fingerprint(self, library):
+        """Return a hash of the bundles' vids, states and update times, which changes when bundles are added,
+        removed or rebuilt, including through other programs, once the records are reloaded"""
+
+        self.records(library)
+
+        with self._lock:
+            return self._fingerprint
+
+    def invalidate(self):
+        with self._lock:
+            self._records = None
+
+
+catalog = Catalog(ttl=app.config['CATALOG_TTL'])
+
+
+@on_library_change
+def invalidate_catalog(library, event, vid):
+    bump_generation(library)
+    catalog.invalidate()
@@ -0,0 +1,290 @@
+"""A feed of the bundles and partitions that have been added, updated or removed since a cursor, for
+library mirrors.
+
+Changes come from two places: the build state times of the bundles in the catalog, which cover bundles
+changed outside of the UI, and a log of the checkins, syncs and removals made through the UI, which covers
+removed bundles and bundles checked in with old build times.
+
+Changes are ordered by time and vid. A cursor is the time and vid of the last change a client has seen,
+so a page of changes can end between changes with the same time.
+
+Partitions change with their bundles. Each logged checkin, sync and removal has the partitions that it
+added, updated and removed, found by comparing the bundle's partitions with the ones recorded at its
+previous change, and a bundle's change in the feed has the partition changes of its events after the
+cursor.
+
+Copyright (c) 2015 Civic Knowledge. This file is licensed under the terms of
+the Revised BSD License, included in this distribution as LICENSE.txt
+"""
+
+import json
+import os
+import time
+
+from . import on_library_change
+
+
+class CursorError(ValueError):
+    """A malformed cursor"""
+
+
+def _log_file(library):
+    return os.path.join(library.filesystem.cache('ui'), 'changes.ndjson')
+
+
+def _partitions_file(library, vid):
+    return os.path.join(library.filesystem.cache('ui/partitions'), '{}.json'.format(vid))
+
+
+def partition_changes(library, vid, current):
+    """Return a dict of the partitions of a bundle that were added, updated and removed since its last
+    logged change, and record the current partitions for the next one. If the earlier partitions weren't
+    recorded, the current ones are taken as updated.
+
+    :param current: Vids of the bundle's partitions now, which are none for a removed bundle
+    """
+    from tempfile import mkstemp
+
+    path = _partitions_file(library, vid)
+    current = set(current)
+
+    try:
+        with open(path) as f:
+            previous = set(json.load(f))
+    except (IOError, ValueError):
+        previous = current
+
+    if current:
+        fd, tmp = mkstemp(dir=os.path.dirname(path), prefix='.')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(sorted(current), f)
+        os.rename(tmp, path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+    return dict(added=sorted(current - previous), updated=sorted(current & previous),
+                removed=sorted(previous - current))
+
+
+def record_event(library, event, vid, t=None, partitions=None):
+    """Append a change event to the log. The time is taken while the log is locked, so the log is in time
+    order.
+
+    :param partitions: If set, a dict of the vids of the partitions added, updated and removed
+    """
+    import fcntl
+
+    e = dict(event=event, vid=vid)
+
+    if partitions is not None:
+        e['partitions'] = partitions
+
+    with open(_log_file(library), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.write(json.dumps(dict(e, time=t or time.time())) + '\n')
+            f.flush()
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _line_time(line):
+    """Return the time of a log line, or infinity for a line that is still being written"""
+    try:
+        return json.loads(line)['time']
+    except (ValueError, KeyError, TypeError):
+        return float('inf')
+
+
+def _seek_time(f, t):
+    """Move to the first line of the log with a time at or after t, with a binary search over the byte
+    offsets, so reading recent events doesn't read the whole log"""
+
+    f.seek(0, os.SEEK_END)
+    lo, hi = 0, f.tell()
+
+    def line_at(pos):
+        """Return the first line that starts at or after pos"""
+        f.seek(max(pos - 1, 0))
+        if pos:
+            f.readline()
+        return f.readline()
+
+    while lo < hi:
+        mid = (lo + hi) // 2
+        line = line_at(mid)
+
+        if line and _line_time(line) < t:
+            lo = mid + 1
+        else:
+            hi = mid
+
+    f.seek(max(lo - 1, 0))
+    if lo:
+        f.readline()
+
+
+def read_events(library, since=None):
+    """Return the logged events, as dicts with time, event and vid
+
+    :param since: If set, only return the events at or after this time
+    """
+
+    events = []
+
+    try:
+        with open(_log_file(library)) as f:
+            if since:
+                _seek_time(f, since)
+
+            for line in f:
+                try:
+                    events.append(json.loads(line))
+                except ValueError:  # A line being written by another process
+                    pass
+    except IOError:
+        pass
+
+    return events
+
+
+def format_cursor(t, vid):
+    return '{:.6f}:{}'.format(t, vid)
+
+
+def parse_cursor(cursor):
+    """Return the (time, vid) for a cursor. A cursor may also be just a unix time, for changes after
+    that time, in which case the vid is None. """
+
+    if not cursor:
+        return 0.0, ''
+
+    t, sep, vid = cursor.partition(':')
+
+    try:
+        return float(t), vid if sep else None
+    except ValueError:
+        raise CursorError("Bad cursor: '{}'".format(cursor))
+
+
+def _float(v):
+    try:
+        return float(v) if v else 0.0
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def merge_changes(records, events):
+    """Return the latest change for each bundle, as a list of (time, vid, event) sorted by time and vid.
+
+    :param records: Catalog records for the bundles in the library
+    :param events: Logged events
+    """
+
+    records = {r['vid']: r for r in records}
+    latest = {}
+
+    # Times are rounded to the precision of the cursors, so a change compares equal to its own cursor.
+    for vid, r in records.items():
+        t = _float(r.get('updated_time')) or _float(r.get('created_time'))
+        latest[vid] = (round(t, 6), vid, 'updated')
+
+    for e in events:
+        vid = e['vid']
+        e = dict(e, time=round(e['time'], 6))
+
+        if e['event'] == 'remove':
+            if vid not in records:
+                latest[vid] = max(latest.get(vid, (0, vid, None)), (e['time'], vid, 'removed'))
+        elif vid in records and e['time'] > latest[vid][0]:
+            latest[vid] = (e['time'], vid, 'updated')
+
+    return sorted(latest.values())
+
+
+def net_partition_changes(event_partitions):
+    """Return a dict of partition vids to their net change over the partition changes of a sequence of
+    events: 'added' if a partition didn't exist before the first, 'removed' if it doesn't exist after the
+    last, and otherwise 'updated'. """
+
+    existed, exists = {}, {}
+
+    for changes in event_partitions:
+        for kind in ('added', 'updated', 'removed'):
+            for pvid in changes.get(kind, []):
+                existed.setdefault(pvid, kind != 'added')
+                exists[pvid] = kind != 'removed'
+
+    return {pvid: 'removed' if not exists[pvid] else 'updated' if existed[pvid] else 'added'
+            for pvid in exists}
+
+
+def changes(records, events, since=None, limit=100):
+    """Return a page of changes after a cursor, the cursor for the next page, and whether there are more
+    changes after the page.
+
+    Each change is a dict with the cursor, time, event and vid, and, for bundles that exist, the
+    catalog record. The event is 'added' for bundles created after the cursor time, 'updated' for
+    other bundles that exist and 'removed' for bundles that were removed. 'partitions' is a dict of
+    partition vids to 'added', 'updated' or 'removed', from the logged events after the cursor, or None if
+    no events with partitions were logged, as for bundles changed outside of the UI.
+
+    Events before the cursor time don't affect the page, so the events can be read with
+    read_events(library, since=<cursor time>).
+    """
+
+    since_t, since_vid = parse_cursor(since)
+
+    after = [c for c in merge_changes(records, events)
+             if c[0] > since_t or (c[0] == since_t and since_vid is not None and c[1] > since_vid)]
+    page = after[:limit]
+
+    records = {r['vid']: r for r in records}
+    page_vids = set(vid for _, vid, _ in page)
+    event_partitions = {}
+
+    for e in sorted(events, key=lambda e: e['time']):
+        t = round(e['time'], 6)
+        after_cursor = t > since_t or (t == since_t and since_vid is not None and e['vid'] > since_vid)
+
+        if e['vid'] in page_vids and after_cursor and e.get('partitions') is not None:
+            event_partitions.setdefault(e['vid'], []).append(e['partitions'])
+
+    partitions = {vid: net_partition_changes(ep) for vid, ep in event_partitions.items()}
+
+    out = []
+
+    for t, vid, event in page:
+        r = records.get(vid)
+
+        if event == 'updated' and _float(r.get('created_time')) > since_t:
+            event = 'added'
+
+        out.append(dict(cursor=format_cursor(t, vid), time=t, event=event, vid=vid, record=r,
+                        partitions=partitions.get(vid)))
+
+    next_cursor = out[-1]['cursor'] if out else since
+
+    return out, next_cursor, len(after) > limit
+
+
+def bundle_partition_vids(library, vid):
+    """Return the vids of a bundle's partitions, or none if the bundle doesn't exist"""
+    from ambry.orm.exc import NotFoundError
+
+    try:
+        return [p.vid for p in library.bundle(vid).partitions]
+    except NotFoundError:
+        return []
+
+
+@on_library_change
+def log_change(library, event, vid):
+    if not vid:
+        return
+
+    if event in ('checkin', 'sync', 'remove'):
+        current = bundle_partition_vids(library, vid) if event != 'remove' else []
+        record_event(library, event, vid, partitions=partition_changes(library, vid, current))
+    else:
+        record_event(library, event, vid)
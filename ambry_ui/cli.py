@@ -62,6 +62,20 @@ def make_parser(cmd):
     sp = cmd.add_parser('run_args', help='Print evalable environmental vars for running the UI')
     sp.set_defaults(subcommand=run_args)
 
+    sp = cmd.add_parser('artifacts', help='Build or clean the cached CSV files for partition downloads')
+    sp.set_defaults(subcommand=build_artifacts)
+    sp.add_argument('-f', '--force', action='store_true', default=False, help="Rebuild files that already exist")
+    sp.add_argument('-c', '--clean', action='store_true', default=False, help="Remove all of the files")
+    sp.add_argument('-s', '--size', action='store_true', default=False,
+                    help="Print the total size of the files and exit")
+    sp.add_argument('refs', nargs='*', help='References to partitions or bundles. Defaults to all partitions')
+
+    sp = cmd.add_parser('cubes', help='Build or clean the cached measure and dimension cubes for plots')
+    sp.set_defaults(subcommand=build_cubes)
+    sp.add_argument('-f', '--force', action='store_true', default=False, help="Rebuild cubes that already exist")
+    sp.add_argument('-c', '--clean', action='store_true', default=False, help="Remove all of the cubes")
+    sp.add_argument('refs', nargs='*', help='References to partitions or bundles. Defaults to all partitions')
+
     sp = cmd.add_parser('notebook', help='Run jupyter notebook')
     sp.set_defaults(subcommand=start_notebook)
     sp.add_argument('-H', '--host', help="Server host.", default='localhost')
@@ -273,6 +287,75 @@ def list_users(args, l, rc):
     prt(tabulate(records[1:], records[0]))
 
 
+def ref_partitions(l, refs):
+    """Yield the partitions for references to partitions or bundles, or all partitions if there are no
+    references. Warns about references that aren't found. """
+    from ambry.orm.exc import NotFoundError
+
+    if not refs:
+        for b in l.bundles:
+            for p in b.partitions:
+                yield p
+        return
+
+    for ref in refs:
+        try:
+            yield l.partition(ref)
+        except NotFoundError:
+            try:
+                for p in l.bundle(ref).partitions:
+                    yield p
+            except NotFoundError:
+                warn("No partition or bundle for reference '{}'".format(ref))
+
+
+def build_artifacts(args, l, rc):
+    """Build the materialized CSV files for partitions, so the first download doesn't have to"""
+    from ambry_ui import app_config
+    from ambry_ui.artifacts import ArtifactCache
+
+    ac = ArtifactCache(l, max_size=app_config['ARTIFACT_CACHE_SIZE'] or None,
+                       flush_size=app_config['CSV_FLUSH_SIZE'])
+
+    if args.size:
+        prt("{} files, {:,} bytes in {}".format(len(ac.files()), ac.size, ac.root))
+        return
+
+    if args.clean:
+        removed = ac.clean()
+        prt("Removed {} files".format(len(removed)))
+        return
+
+    for p in ref_partitions(l, args.refs):
+        if ac.build(p, force=args.force):
+            prt("Built {}".format(p.vname))
+        elif ac.too_large(p.vid):
+            prt("Too large {}".format(p.vname))
+        else:
+            prt("Exists {}".format(p.vname))
+
+
+def build_cubes(args, l, rc):
+    """Build the measure and dimension cubes for partitions, so the first plot doesn't have to"""
+    from ambry_ui.cube import build, cube_path, remove
+    import os
+
+    if args.clean:
+        prt("Removed {} cubes".format(remove(l)))
+        return
+
+    for p in ref_partitions(l, args.refs):
+        if os.path.exists(cube_path(l, p.vid)) and not args.force:
+            prt("Exists {}".format(p.vname))
+            continue
+
+        try:
+            build(l, p)
+            prt("Built {}".format(p.vname))
+        except Exception as e:
+            warn("Failed to build cube for {}: {}".format(p.vname, e))
+
+
 def start_notebook(args, l, rc):
 
     from notebook.notebookapp import NotebookApp
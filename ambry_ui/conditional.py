@@ -0,0 +1,129 @@
+"""Entity tags and conditional GET for read-only views.
+
+A response for a view of a bundle or partition is determined by the vids in the URL, the query, the
+version of the UI and the state of the library. Checking a bundle in again replaces the objects for the
+same vid, so the library change counter is part of every tag. The conditional() decorator computes a strong
+ETag from those values, and answers a matching If-None-Match with a 304 before the view runs, after
+checking that the client may see the bundle or partition.
+
+Copyright (c) 2015 Civic Knowledge. This file is licensed under the terms of
+the Revised BSD License, included in this distribution as LICENSE.txt
+"""
+
+from functools import wraps
+
+MAX_AGE = 300
+
+
+def compute_etag(values, listing, private, encoded=False):
+    """Return the entity tag for the current request"""
+    from hashlib import sha1
+    from flask import request, session
+    from flask_login import current_user
+    from __meta__ import __version__ as ui_version
+    from catalog import generation, catalog
+    from . import get_library
+
+    parts = [ui_version, request.path, '&'.join(sorted(request.query_string.split('&')))]
+    parts += [str(v) for v in values]
+
+    # A vid doesn't identify a fixed version: a bundle checked in again keeps its vid
+    parts.append(str(generation(get_library())))
+
+    if listing:
+        # Bundles added outside of the UI don't change the counter, but do change the catalog when it is
+        # reloaded after CATALOG_TTL
+        parts.append(catalog.fingerprint(get_library()))
+
+    if encoded:
+        parts.append(str(request.accept_encodings.quality('gzip') > 0))
+
+    if private:
+        import time
+        # The page includes the session's user and CSRF token. Tokens expire, so change the tag every half hour.
+        parts += [str(current_user.get_id() if current_user.is_authenticated else None),
+                  str(session.get('csrf_token')), str(int(time.time() // 1800))]
+
+    return sha1('|'.join(parts)).hexdigest()
+
+
+def cache_control(r, private):
+    if private:
+        r.headers['Cache-Control'] = 'private, no-cache'
+        r.vary.add('Cookie')
+    else:
+        r.headers['Cache-Control'] = 'public, max-age={}, must-revalidate'.format(MAX_AGE)
+
+
+def check_access(kind, ref):
+    """Abort unless the client may see the partition or bundle, so a 304 doesn't confirm that a
+    private one exists and hasn't changed"""
+    from flask import abort
+    from ambry.orm.exc import NotFoundError
+    from views import check_access as check_partition_access, check_bundle_access
+    from . import get_aac
+
+    l = get_aac().library
+
+    try:
+        if kind == 'partition':
+            check_partition_access(l.partition(ref))
+        else:
+            check_bundle_access(l.bundle(ref))
+    except NotFoundError:
+        abort(404)
+
+
+def conditional(*vid_args, **options):
+    """View decorator that adds a strong ETag and Cache-Control header to successful responses, and
+    returns 304 Not Modified when the If-None-Match header has the tag.
+
+    :param vid_args: Names of the view arguments that hold bundle or partition references.
+    :param listing: If True, the view lists the contents of the library, or shows files that can be
+        edited in a bundle version, so the tag includes a hash of the bundle catalog.
+    :param private: If True, the response depends on the session, such as for HTML pages with the user's
+        name and login form, so the tag includes the user and the response isn't stored in shared caches.
+    :param encoded: If True, the response is gzipped when the client accepts it, so the tag includes
+        whether it does.
+    :param access: 'partition' or 'bundle' if the view checks access to the object in the first of the
+        vid_args, which is then checked before the tag is compared.
+    """
+
+    listing = options.get('listing', False)
+    private = options.get('private', False)
+    encoded = options.get('encoded', False)
+    access = options.get('access')
+
+    def decorator(f):
+
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            from flask import request, Response
+            from . import app
+
+            values = [kwargs.get(a) for a in vid_args]
+
+            if access:
+                check_access(access, values[0])
+
+            etag = compute_etag(values, listing, private, encoded)
+
+            if request.if_none_match.contains_weak(etag):
+                r = Response(status=304)
+            else:
+                r = app.make_response(f(*args, **kwargs))
+
+                if r.status_code != 200:
+                    return r
+
+            r.set_etag(etag)
+            cache_control(r, private)
+
+            if encoded:
+                r.vary.add('Accept-Encoding')
+
+            return r
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,489 @@
+"""Measure and dimension cubes for plots.
+
+A cube is a columnar copy of a partition, made for aggregating measures by dimensions. The dimension and
+label columns named in the partition's dimension sets are dictionary encoded, as an array of integer codes
+into a list of the column's distinct values, and columns that hold only numbers also have an array of their
+values as floats. Other columns are only kept if they are numeric, as measures. The arrays are saved as
+NumPy files in a directory in the library cache and memory-mapped when the cube is opened, so all of the
+workers share one copy, in the operating system's page cache. The list of distinct values for each column
+is in its own file, loaded when the column is first used.
+
+Partition versions never change, so a cube is built once, on the first plot request for the partition or with
+``ambry ui cubes``, and removed when its bundle is checked in again or removed.
+
+Copyright (c) 2015 Civic Knowledge. This file is licensed under the terms of
+the Revised BSD License, included in this distribution as LICENSE.txt
+"""
+
+import os
+import threading
+
+from . import on_library_change
+
+CUBE_VERSION = 2  # Incremented when the file layout changes, so old cubes are rebuilt
+
+_lock = threading.Lock()
+_open = {}  # path -> Cube, for the cubes opened by this process
+
+
+def cube_root(library):
+    return library.filesystem.cache('ui/cubes')
+
+
+def cube_path(library, pvid):
+    return os.path.join(cube_root(library), '{}-v{}'.format(pvid, CUBE_VERSION))
+
+
+def _is_number(v):
+    return isinstance(v, (int, long, float)) and not isinstance(v, bool)
+
+
+class _ColumnBuilder(object):
+    """Accumulates the codes, if the column is encoded, and the numeric values, for one column"""
+
+    def __init__(self, encode):
+        from array import array
+
+        self.encode = encode
+        self.codes = array('i')
+        self.numbers = array('d')
+        self.numeric = True
+        self.integer = True
+        self.index = {}
+        self.values = []
+
+    def append(self, v):
+        if v is None or v == '':
+            if self.encode:
+                self.codes.append(-1)
+            if self.numeric:
+                self.numbers.append(float('nan'))
+            return
+
+        if self.encode:
+            try:
+                code = self.index[v]
+            except KeyError:
+                code = self.index[v] = len(self.values)
+                self.values.append(v)
+
+            self.codes.append(code)
+
+        if self.numeric:
+            if _is_number(v):
+                self.numbers.append(v)
+                self.integer = self.integer and not isinstance(v, float)
+            else:
+                self.numeric = self.integer = False
+                self.numbers = None
+
+
+def build(library, p, path=None):
+    """Write the cube for a partition. The files are written to a temporary directory that is renamed into
+    place, so readers never see a partial cube. """
+    import cPickle as pickle
+    import numpy as np
+    import shutil
+    from tempfile import mkdtemp
+
+    path = path or cube_path(library, p.vid)
+
+    p.localize()
+
+    ds_list = p.measuredim.dict['dimension_sets'].values()
+
+    labels = {}
+    dimensions = set()
+
+    for ds in ds_list:
+        for dim, label in ((ds['p_dim'], ds.get('p_label')), (ds.get('s_dim'), ds.get('s_label'))):
+            if dim:
+                dimensions.add(dim)
+                labels[dim] = label or dim
+
+        dimensions.update(ds.get('filters', {}).keys())
+
+    encoded = dimensions | set(labels.values())
+
+    reader = p.reader
+    headers = list(reader.headers)
+    builders = [_ColumnBuilder(h in encoded) for h in headers]
+
+    n_rows = 0
+    for row in reader.rows:
+        for b, v in zip(builders, row):
+            b.append(v)
+        n_rows += 1
+
+    tmp = mkdtemp(dir=os.path.dirname(path), prefix='.' + os.path.basename(path))
+
+    try:
+        columns = {}
+
+        for i, (name, b) in enumerate(zip(headers, builders)):
+            if not b.encode and not b.numeric:
+                continue  # Not a dimension, label or measure
+
+            if b.encode:
+                np.save(os.path.join(tmp, '{}.codes.npy'.format(i)), np.array(b.codes, dtype=np.int32))
+
+                with open(os.path.join(tmp, '{}.dict.pkl'.format(i)), 'wb') as f:
+                    pickle.dump(b.values, f, pickle.HIGHEST_PROTOCOL)
+
+            if b.numeric:
+                np.save(os.path.join(tmp, '{}.values.npy'.format(i)), np.array(b.numbers, dtype=np.float64))
+
+            columns[name] = dict(number=i, encoded=b.encode, numeric=b.numeric, integer=b.integer)
+
+        meta = dict(version=CUBE_VERSION, pvid=p.vid, n_rows=n_rows, headers=headers, columns=columns,
+                    labels=labels, dimensions=sorted(dimensions),
+                    vids={c.vid: c.name for c in p.table.columns})
+
+        with open(os.path.join(tmp, 'meta.pkl'), 'wb') as f:
+            pickle.dump(meta, f, pickle.HIGHEST_PROTOCOL)
+
+        if os.path.exists(path):
+            shutil.rmtree(path, ignore_errors=True)
+
+        os.rename(tmp, path)
+
+    except:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+
+    return path
+
+
+class Cube(object):
+    """A memory-mapped cube, which aggregates a measure by one or two dimensions.
+
+    :param path: The cube's directory
+    """
+
+    def __init__(self, path):
+        import cPickle as pickle
+
+        self.path = path
+        self.inode = os.stat(path).st_ino
+
+        with open(os.path.join(path, 'meta.pkl'), 'rb') as f:
+            self.meta = pickle.load(f)
+
+        self.n_rows = self.meta['n_rows']
+        self.columns = self.meta['columns']
+        self._arrays = {}
+        self._values = {}
+        self._lookups = {}
+
+    def column_name(self, ref):
+        """Return the name of a column, given its name or vid"""
+        if ref in self.columns:
+            return ref
+
+        try:
+            return self.meta['vids'][ref]
+        except KeyError:
+            raise KeyError("No column '{}' in the cube for {}".format(ref, self.meta['pvid']))
+
+    def label(self, dim):
+        """Return the name of the column that has the labels for a dimension's values"""
+        label = self.meta['labels'].get(dim, dim)
+        return label if label in self.columns else dim
+
+    def _load(self, name, kind):
+        import numpy as np
+
+        key = (name, kind)
+
+        if key not in self._arrays:
+            fn = os.path.join(self.path, '{}.{}.npy'.format(self.columns[name]['number'], kind))
+            self._arrays[key] = np.load(fn, mmap_mode='r')
+
+        return self._arrays[key]
+
+    def _encoded(self, name):
+        name = self.column_name(name)
+
+        if not self.columns[name]['encoded']:
+            raise ValueError("Column '{}' is not a dimension or label".format(name))
+
+        return name
+
+    def codes(self, name):
+        """Return the dictionary codes for a dimension or label column, with -1 for empty values"""
+        return self._load(self._encoded(name), 'codes')
+
+    def numbers(self, name):
+        """Return the values of a numeric column as floats, with NaN for empty values"""
+        name = self.column_name(name)
+
+        if not self.columns[name]['numeric']:
+            raise ValueError("Column '{}' is not numeric".format(name))
+
+        return self._load(name, 'values')
+
+    def values(self, name):
+        """Return the distinct values of a dimension or label column, in code order"""
+        import cPickle as pickle
+
+        name = self._encoded(name)
+
+        if name not in self._values:
+            with open(os.path.join(self.path, '{}.dict.pkl'.format(self.columns[name]['number'])), 'rb') as f:
+                self._values[name] = pickle.load(f)
+
+        return self._values[name]
+
+    def code(self, name, v):
+        """Return the code for a value of a column, or None if the column doesn't have the value. Values
+        are compared as strings, since filter values come from the query string"""
+        name = self.column_name(name)
+
+        if name not in self._lookups:
+            values = self.values(name)
+            self._lookups[name] = {unicode(x): i for i, x in enumerate(values)}
+
+            if self.columns[name]['numeric']:  # So '2010' matches 2010.0
+                self._lookups[name].update({float(x): i for i, x in enumerate(values)})
+
+        lookup = self._lookups[name]
+
+        code = lookup.get(unicode(v))
+
+        if code is None and self.columns[name]['numeric']:
+            try:
+                code = lookup.get(float(v))
+            except ValueError:
+                pass
+
+        return code
+
+    def _first_codes(self, dim, label):
+        """Return the codes in the label column for the first row with each code of a dimension"""
+        import numpy as np
+
+        dim_codes = np.asarray(self.codes(dim))
+
+        if label == dim:
+            return np.arange(len(self.values(dim)))
+
+        first = np.zeros(len(self.values(dim)), dtype=np.int64)
+        present, idx = np.unique(dim_codes, return_index=True)
+        first[present[present >= 0]] = idx[present >= 0]
+
+        return np.asarray(self.codes(label))[first]
+
+    def group(self, measure, dims, filters=None):
+        """Add up a measure for each combination of values of the dimensions, for the rows that match the
+        filters.
+
+        Dimensions that are neither grouped nor filtered are collapsed by selecting their total rows, where the
+        dimension is empty, if the selected rows have any, and otherwise by adding up the rows.
+
+        :return: (sums, counts), arrays with an axis for each dimension, indexed by the dimensions' codes
+        """
+        import numpy as np
+
+        filters = filters or {}
+
+        m = np.asarray(self.numbers(measure))
+        mask = ~np.isnan(m)
+
+        for k, v in filters.items():
+            code = self.code(k, v)
+
+            if code is None:
+                mask[:] = False
+            else:
+                mask &= np.asarray(self.codes(k)) == code
+
+        used = {self.column_name(d) for d in list(dims) + list(filters)}
+
+        for d in self.meta['dimensions']:
+            if d in used or d not in self.columns:
+                continue
+
+            empty = np.asarray(self.codes(d)) == -1
+
+            if (empty & mask).any():
+                mask &= empty
+
+        codes = [np.asarray(self.codes(d)) for d in dims]
+
+        for c in codes:
+            mask &= c >= 0
+
+        shape = tuple(len(self.values(d)) for d in dims)
+        key = np.ravel_multi_index([c[mask] for c in codes], shape)
+        size = int(np.prod(shape))
+
+        sums = np.bincount(key, weights=m[mask], minlength=size).reshape(shape)
+        counts = np.bincount(key, minlength=size).reshape(shape)
+
+        return sums, counts
+
+    def aggregate(self, measure, primary, secondary=None, filters=None):
+        """Add up a measure for each value of the primary dimension, and of the secondary dimension if there
+        is one, for the rows that match the filters.
+
+        :return: (primary codes, secondary codes, sums, counts). The codes are those of the values that have
+            rows. The sums and counts are arrays indexed by primary code, or by primary and secondary codes.
+            The secondary codes are None if there is no secondary dimension.
+        """
+
+        sums, counts = self.group(measure, [primary, secondary] if secondary else [primary], filters)
+
+        return self._present(sums, counts, secondary)
+
+    @staticmethod
+    def _present(sums, counts, secondary):
+        import numpy as np
+
+        if secondary:
+            return np.nonzero(counts.any(axis=1))[0], np.nonzero(counts.any(axis=0))[0], sums, counts
+        else:
+            return np.nonzero(counts)[0], None, sums, counts
+
+    def dataframe(self, measure, primary, secondary=None, filters=None):
+        """Return a dataframe of the aggregated measure, indexed by the primary dimension's labels, with a
+        column for the measure, or a column for each label of the secondary dimension"""
+
+        measure = self.column_name(measure)
+        primary = self.column_name(primary)
+        secondary = self.column_name(secondary) if secondary else None
+
+        return self._frame(measure, primary, secondary, *self.aggregate(measure, primary, secondary, filters))
+
+    def variants(self, measure, primary, secondary=None, filters=None):
+        """Return the dataframes for a plot and for each of its filtered variants, computed with one grouped
+        pass for each filter dimension.
+
+        :param filters: Dict of dimension names to the lists of values to make variants for
+        :return: List of (filter, dataframe) pairs, where the filter is a dict. The first has no filter.
+        """
+
+        measure = self.column_name(measure)
+        primary = self.column_name(primary)
+        secondary = self.column_name(secondary) if secondary else None
+
+        import numpy as np
+
+        out = [({}, self.dataframe(measure, primary, secondary))]
+
+        for col, values in sorted((filters or {}).items()):
+            dims = [primary, secondary, col] if secondary else [primary, col]
+            sums, counts = self.group(measure, dims)
+
+            for v in values:
+                code = self.code(col, v)
+
+                if code is None:
+                    s, c = np.zeros(sums.shape[:-1]), np.zeros(counts.shape[:-1], dtype=int)
+                else:
+                    s, c = sums[..., code], counts[..., code]
+
+                out.append(({col: v}, self._frame(measure, primary, secondary, *self._present(s, c, secondary))))
+
+        return out
+
+    def _labels(self, dim, codes):
+        """Return the labels for codes of a dimension, and the name of the label column"""
+        label = self.label(dim)
+        labels = self.values(label)
+        label_codes = self._first_codes(dim, label)
+
+        return [labels[c] if c >= 0 else None for c in label_codes[codes]], label
+
+    def _frame(self, measure, primary, secondary, p_codes, s_codes, sums, counts):
+        import numpy as np
+        import pandas as pd
+
+        labels, p_label = self._labels(primary, p_codes)
+        index = pd.Index(labels, name=p_label)
+
+        if secondary:
+            labels, s_label = self._labels(secondary, s_codes)
+
+            values = np.where(counts > 0, sums, np.nan)[np.ix_(p_codes, s_codes)]
+
+            df = pd.DataFrame(values, index=index, columns=pd.Index(labels, name=s_label))
+        else:
+            values = sums[p_codes]
+
+            if self.columns[measure]['integer']:
+                values = values.astype(np.int64)
+
+            df = pd.DataFrame({measure: values}, index=index)
+
+            if primary == 'gvid' and p_label != 'gvid':
+                gvids = self.values('gvid')
+                df['gvid'] = [gvids[c] for c in p_codes]
+
+        return df
+
+
+def get_cube(library, pvid, partition=None):
+    """Return the cube for a partition, building it if it doesn't exist yet. Only one process builds a
+    cube at a time; the others wait for it.
+
+    :param partition: The partition, if the caller has it already. Otherwise it is loaded only if the cube
+        has to be built.
+    """
+    from singleflight import run
+
+    path = cube_path(library, pvid)
+
+    with _lock:
+        c = _open.get(path)
+
+    try:
+        if c is not None and os.stat(path).st_ino == c.inode:  # Not rebuilt by another process
+            return c
+    except OSError:
+        pass
+
+    def _build():
+        if not os.path.exists(path):
+            build(library, partition or library.partition(pvid), path)
+
+    if not os.path.exists(path):
+        run('cube', pvid, _build, lock_dir=library.filesystem.cache('ui/locks'))
+
+    c = Cube(path)
+
+    with _lock:
+        _open[path] = c
+
+    return c
+
+
+def remove(library, vid=None):
+    """Remove the cubes for the partitions of a bundle, or all cubes if vid is None. Returns the number of
+    cubes removed"""
+    import shutil
+    from cache import bundle_vid
+
+    root = cube_root(library)
+    group = bundle_vid(vid) if vid else None
+    n = 0
+
+    for fn in os.listdir(root):
+        if fn.startswith('.'):
+            continue
+
+        if group is None or bundle_vid(fn.rsplit('-', 1)[0]) == group:
+            shutil.rmtree(os.path.join(root, fn), ignore_errors=True)
+            n += 1
+
+    with _lock:
+        for path in list(_open):
+            if not os.path.exists(path):
+                del _open[path]
+
+    return n
+
+
+@on_library_change
+def remove_cubes(library, event, vid):
+    if event in ('checkin', 'remove', 'sync'):
+        remove(library, vid)
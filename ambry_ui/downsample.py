@@ -0,0 +1,139 @@
+"""Downsampling of time series for plots.
+
+A chart can't draw more points than it has pixels, so long series are reduced on the server before they are
+sent. Largest-Triangle-Three-Buckets keeps the points that preserve the visual shape of a line; min/max
+keeps the lowest and highest value in each bucket, so no peaks are lost.
+
+Copyright (c) 2015 Civic Knowledge. This file is licensed under the terms of
+the Revised BSD License, included in this distribution as LICENSE.txt
+"""
+
+import numpy as np
+
+
+def lttb(x, y, n):
+    """Return the indices of n points of a series, chosen with Largest-Triangle-Three-Buckets. The first and
+    last points are always kept, and one point is chosen from each of n - 2 buckets in between: the one that
+    makes the largest triangle with the point chosen from the previous bucket and the average of the next.
+
+    :param x: Sorted x values, as floats
+    :param y: y values, as floats. NaN values are never chosen unless a bucket has nothing else.
+    :param n: Number of points to return
+    """
+    length = len(x)
+
+    if n >= length:
+        return np.arange(length)
+
+    if n < 3:
+        return np.array([0, length - 1])[:max(n, 0)]
+
+    edges = np.linspace(1, length - 1, n - 1).astype(int)  # Bucket boundaries, between the first and last
+
+    out = np.empty(n, dtype=int)
+    out[0], out[-1] = 0, length - 1
+
+    a = 0
+
+    for i in range(n - 2):
+        start, end = edges[i], edges[i + 1]
+
+        if i + 2 < len(edges):
+            next_start, next_end = edges[i + 1], edges[i + 2]
+        else:
+            next_start, next_end = length - 1, length
+
+        next_y = y[next_start:next_end]
+
+        avg_x = x[next_start:next_end].mean()
+        avg_y = y[a] if np.isnan(next_y).all() else np.nanmean(next_y)
+
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+
+        a = start + int(np.argmax(np.where(np.isnan(area), -1, area)))
+        out[i + 1] = a
+
+    return out
+
+
+def minmax(x, y, n):
+    """Return the indices of at most n points of a series: the first and last points, and the points with
+    the lowest and highest values in each of (n - 2) / 2 buckets, in order.
+
+    :param x: Sorted x values. Only the length is used
+    :param y: y values, as floats
+    :param n: Maximum number of points to return
+    """
+    length = len(x)
+
+    if n >= length:
+        return np.arange(length)
+
+    if n < 4:
+        return lttb(x, y, n)
+
+    edges = np.linspace(1, length - 1, (n - 2) // 2 + 1).astype(int)
+
+    keep = [0, length - 1]
+
+    for start, end in zip(edges[:-1], edges[1:]):
+        bucket = y[start:end]
+
+        if end > start and not np.isnan(bucket).all():
+            keep.append(start + int(np.nanargmin(bucket)))
+            keep.append(start + int(np.nanargmax(bucket)))
+
+    return np.unique(keep)
+
+
+METHODS = {
+    'lttb': lttb,
+    'minmax': minmax
+}
+
+
+def _x_values(index):
+    """Return the values of a dataframe's index as floats, or the positions if they aren't numbers or times"""
+    values = np.asarray(index)
+
+    if np.issubdtype(values.dtype, np.datetime64):
+        return values.astype('datetime64[ns]').astype(np.int64).astype(float)
+
+    try:
+        return values.astype(float)
+    except (TypeError, ValueError):
+        return np.arange(len(values), dtype=float)
+
+
+def downsample_frame(df, max_points, method='lttb'):
+    """Return a dataframe of a series, or of several series in columns, sorted by its index and reduced to
+    about max_points rows for each numeric column. The rows chosen for all of the columns are kept.
+
+    :param df: Dataframe indexed by time, or another ordered dimension
+    :param max_points: Maximum number of points for each column, or 0 for all of them
+    :param method: 'lttb' or 'minmax'
+    """
+    if method not in METHODS:
+        raise ValueError("Unknown downsampling method '{}'".format(method))
+
+    if max_points < 0:
+        raise ValueError("max_points must not be negative")
+
+    df = df.sort_index()
+
+    if not max_points or len(df) <= max_points:
+        return df
+
+    f = METHODS[method]
+    x = _x_values(df.index)
+    keep = np.zeros(len(df), dtype=bool)
+
+    columns = [c for c in df.columns if np.issubdtype(df[c].dtype, np.number)]
+
+    if not columns:
+        return df
+
+    for c in columns:
+        keep[f(x, df[c].values.astype(float), max_points)] = True
+
+    return df[keep]
@@ -0,0 +1,128 @@
+"""JSON encoding for ORM dicts, column statistics and other large payloads.
+
+The encoder converts the types that appear in partition and column records -- datetimes, dates, Decimals,
+UUIDs and numpy scalars and arrays -- to their JSON equivalents. Documents are encoded without sorting
+keys or indentation, which lets the json module use its C encoder, when it has one.
+
+Copyright (c) 2015 Civic Knowledge. This file is licensed under the terms of
+the Revised BSD License, included in this distribution as LICENSE.txt
+"""
+
+import datetime
+import decimal
+import json
+import uuid
+
+from ambry.util import get_logger
+from flask.json import JSONEncoder as FlaskJSONEncoder
+
+logger = get_logger(__name__)
+
+
+def has_c_encoder(cls):
+    """Return True if the module of a json or simplejson encoder class has the C encoder"""
+    import sys
+
+    return getattr(sys.modules[cls.__module__], 'c_make_encoder', None) is not None
+
+
+class JSONEncoder(FlaskJSONEncoder):
+    """Encoder that converts dates and times to ISO 8601 strings, Decimals to floats, UUIDs to strings,
+    and numpy values to Python numbers and lists. Other objects are encoded as the name of their type. """
+
+    def default(self, o):
+
+        if isinstance(o, (datetime.datetime, datetime.date, datetime.time)):
+            return o.isoformat()
+        elif isinstance(o, decimal.Decimal):
+            return float(o)
+        elif isinstance(o, uuid.UUID):
+            return str(o)
+        elif isinstance(o, (set, frozenset)):
+            return list(o)
+        elif type(o).__module__ == 'numpy' and hasattr(o, 'tolist'):
+            return o.tolist()  # Scalars to Python numbers, arrays to lists
+
+        return str(type(o))
+
+
+class StdlibJSONEncoder(json.JSONEncoder):
+    """The same conversions on the standard library's encoder, for when Flask uses simplejson without
+    its C extension"""
+
+    default = JSONEncoder.__dict__['default']
+
+
+def _encoder_class():
+    """Return the encoder class for dumps(), preferring one with a C encoder"""
+
+    flask_base = FlaskJSONEncoder.__bases__[0]  # json.JSONEncoder or simplejson.JSONEncoder
+
+    if has_c_encoder(flask_base):
+        return JSONEncoder
+    elif has_c_encoder(json.JSONEncoder):
+        return StdlibJSONEncoder
+
+    logger.warning("No C extension for {}; large JSON documents will be slow to encode"
+                   .format(flask_base.__module__))
+
+    return JSONEncoder
+
+
+_encoder = _encoder_class()(separators=(',', ':'), sort_keys=False)
+
+
+def dumps(o):
+    """Encode an object as a compact JSON string"""
+    return _encoder.encode(o)
+
+
+def iter_list(key, items, chunk_size=100, **kwargs):
+    """Generate a JSON object with the kwargs and a list of items under key, in chunks of about
+    chunk_size items, so a long list can be sent without holding the whole document in memory.
+    Each chunk is encoded with the one-shot encoder. """
+
+    head = dumps(kwargs)[:-1]  # Without the closing brace
+
+    yield '{}{}{}:['.format(head, ',' if kwargs else '', dumps(key))
+
+    chunk = []
+    first = True
+
+    for item in items:
+        chunk.append(dumps(item))
+
+        if len(chunk) >= chunk_size:
+            yield ('' if first else ',') + ','.join(chunk)
+            first = False
+            chunk = []
+
+    if chunk:
+        yield ('' if first else ',') + ','.join(chunk)
+
+    yield ']}'
+
+
+def select_fields(o, fields):
+    """Return a dict with only the keys of o that are in fields, or o itself if fields is empty"""
+    if not fields:
+        return o
+
+    return {k: o[k] for k in fields if k in o}
+
+
+def iter_ndjson(items, fields=None, chunk_size=100):
+    """Generate newline-delimited JSON, one line for each item, restricted to fields if it is set, in
+    chunks of chunk_size lines. """
+
+    chunk = []
+
+    for item in items:
+        chunk.append(dumps(select_fields(item, fields)))
+
+        if len(chunk) >= chunk_size:
+            yield '\n'.join(chunk) + '\n'
+            chunk = []
+
+    if chunk:
+        yield '\n'.join(chunk) + '\n'
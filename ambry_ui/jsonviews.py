@@ -2,69 +2,187 @@
 API Views, return javascript renditions of objects and allowing modification of the database
 """
 
-from flask import url_for
+from flask import url_for, request
 from werkzeug.local import LocalProxy
 from . import app, get_aac
+from conditional import conditional
 
 
 aac = LocalProxy(get_aac)
 
+def bundle_record(r):
+    """Return the /json record for a bundle, from its catalog record"""
+    o = dict(r['dataset'])
+    o['bundle_url'] = url_for('bundle_json', vid=r['vid'])
+    o['title'] = r['title']
+    o['summary'] = r['summary']
+    o['created'] = r['created']
+    o['updated'] = r['updated']
+    return o
+
+
+def dataset_dict(b):
+    """Return the dataset record for a bundle"""
+    o = b.dataset.dict
+    del o['dataset']
+    o['title'] = b.metadata.about.title
+    o['summary'] = b.metadata.about.summary
+    o['created'] = b.buildstate.new_datetime.isoformat() if b.buildstate.new_datetime else None
+    o['updated'] = b.buildstate.last_datetime.isoformat() if b.buildstate.last_datetime else None
+    return o
+
+
+def partition_dict(p):
+    """Return the record for a partition in a bundle's list of partitions"""
+    o = p.dict
+    o['csv_url'] = url_for('stream_file', pvid=o['vid'], ct='csv')
+    o['details_url'] = url_for('partition_json', vid=o['vid'])
+    o['description'] = p.table.description
+    o['sub_description'] = p.display.sub_description
+    return o
+
+
+def bundle_partitions(b):
+    """Yield the partitions of a bundle, with their tables, which are loaded in the same query"""
+    from ambry.orm import Partition
+    from sqlalchemy.orm import noload, joinedload
+
+    for p in (b.dataset.query(Partition).filter(Partition.d_vid == b.identity.vid)
+                      .options(noload('*'), joinedload('table')).all()):
+        yield p
+
+
+def request_fields():
+    """Return the list of names in the 'fields' request parameter, or None"""
+    fields = request.args.get('fields')
+
+    return [f.strip() for f in fields.split(',') if f.strip()] if fields else None
+
+
+def ndjson_response(lines):
+    """Return a streamed response for an iterable of NDJSON chunks, gzipped if the client accepts it"""
+    from flask import Response, stream_with_context
+    from streaming import gzip_chunks
+
+    if request.accept_encodings.quality('gzip') > 0:
+        r = Response(stream_with_context(gzip_chunks(lines)), mimetype='application/x-ndjson')
+        r.headers['Content-Encoding'] = 'gzip'
+    else:
+        r = Response(stream_with_context(lines), mimetype='application/x-ndjson')
+
+    r.vary.add('Accept-Encoding')
+
+    return r
+
+
 @app.route('/json')
+@conditional(listing=True)
 def bundle_index_json():
+    from catalog import catalog
 
-    def augment(b):
-        o = b.dataset.dict
-        o['bundle_url'] = url_for('bundle_json', vid=o['vid'])
-        o['title'] = b.metadata.about.title
-        o['summary'] = b.metadata.about.summary
-        o['created'] = b.buildstate.new_datetime.isoformat() if b.buildstate.new_datetime else None
-        o['updated'] = b.buildstate.last_datetime.isoformat() if b.buildstate.last_datetime else None
-        b.close()
-        return o
+    return aac.json_stream('bundles', (bundle_record(r) for r in catalog.records(aac.library)))
 
-    return aac.json(
-        bundles=[augment(b) for b in aac.library.bundles]
 
-    )
+@app.route('/json.ndjson')
+@conditional(listing=True, encoded=True)
+def bundle_index_ndjson():
+    """The bundle records from /json, one per line"""
+    from catalog import catalog
+    from encoding import iter_ndjson
+
+    return ndjson_response(iter_ndjson((bundle_record(r) for r in catalog.records(aac.library)),
+                                       fields=request_fields()))
+
 
 @app.route('/json/bundle/<vid>')
+@conditional('vid')
 def bundle_json(vid):
 
     b = aac.bundle(vid)
 
-    def aug_dataset(b):
-        o = b.dataset.dict
-        del o['dataset']
-        o['title'] = b.metadata.about.title
-        o['summary'] = b.metadata.about.summary
-        o['created'] = b.buildstate.new_datetime.isoformat() if b.buildstate.new_datetime else None
-        o['updated'] = b.buildstate.last_datetime.isoformat() if b.buildstate.last_datetime else None
-        return o
-
-    def aug_partition(o):
-
-        o['csv_url'] = url_for('stream_file', pvid=o['vid'], ct='csv')
-        o['details_url'] = url_for('partition_json', vid=o['vid'])
-        o['description'] = p.table.description
-        o['sub_description'] = p.display.sub_description
-        return o
-
-    def partitions():
-        from ambry.orm import Partition
-        from sqlalchemy.orm import noload, joinedload
-        for p in (b.dataset.query(Partition).filter(Partition.d_vid == b.identity.vid)
-                          .options(noload('*'), joinedload('table')).all()):
-            yield p
-
     b.close()
     return aac.json(
-        dataset=aug_dataset(b),
-        partitions = [ aug_partition(p.dict) for p in partitions() ]
+        dataset=dataset_dict(b),
+        partitions = [ partition_dict(p) for p in bundle_partitions(b) ]
 
     )
 
 
+@app.route('/json/bundle/<vid>.ndjson')
+@conditional('vid', encoded=True)
+def bundle_ndjson(vid):
+    """The dataset and partitions from /json/bundle/<vid>, as a line with a 'dataset' object, followed by
+    a line with a 'partition' object for each partition"""
+    from encoding import iter_ndjson, select_fields
+
+    b = aac.bundle(vid)
+    fields = request_fields()
+
+    def records():
+        yield dict(dataset=select_fields(dataset_dict(b), fields))
+
+        for p in bundle_partitions(b):
+            yield dict(partition=select_fields(partition_dict(p), fields))
+
+    return ndjson_response(iter_ndjson(records()))
+
+
+MAX_CHANGES_LIMIT = 1000
+
+
+@app.route('/json/changes')
+@conditional(listing=True)
+def changes_json():
+    """Bundles added, updated or removed after the 'since' cursor, oldest first. Returns a page of at most
+    'limit' changes, the cursor to request the next page with, and whether there are more changes. Each
+    change for a bundle that exists has its /json record and the vids of its partitions, and each change
+    has the partitions that were added, updated or removed with the bundle. """
+    from flask import abort
+    from ambry.orm import Partition
+    from catalog import catalog
+    from changes import changes, read_events, parse_cursor, CursorError
+
+    try:
+        limit = min(max(int(request.args.get('limit', 100)), 1), MAX_CHANGES_LIMIT)
+        since = request.args.get('since')
+        events = read_events(aac.library, since=parse_cursor(since)[0] - 1e-6)  # Cursor times are rounded
+        page, cursor, more = changes(catalog.records(aac.library), events, since=since, limit=limit)
+    except (ValueError, CursorError):
+        abort(400)
+
+    vids = [c['vid'] for c in page if c['record']]
+    partitions = {}
+
+    if vids:
+        for pvid, d_vid in (aac.library.database.session.query(Partition.vid, Partition.d_vid)
+                                    .filter(Partition.d_vid.in_(vids))):
+            partitions.setdefault(d_vid, []).append(pvid)
+
+    def change(c):
+        r = c.pop('record')
+        logged = c.pop('partitions')
+        current = sorted(partitions.get(c['vid'], []))
+
+        if r:
+            c['bundle'] = bundle_record(r)
+            c['partitions'] = current
+
+        if logged is None:  # Changed outside of the UI, so the partitions have the bundle's change
+            logged = {pvid: 'added' if c['event'] == 'added' else 'updated' for pvid in current}
+
+        c['partition_changes'] = [dict(vid=pvid, event=event) for pvid, event in sorted(logged.items())]
+
+        return c
+
+    return aac.json(
+        changes=[change(c) for c in page],
+        cursor=cursor,
+        more=more
+    )
+
+
 @app.route('/json/partition/<vid>')
+@conditional('vid')
 def partition_json(vid):
 
     p = aac.library.partition(vid)
@@ -75,9 +193,11 @@ def partition_json(vid):
     d['description'] = p.table.description
     d['sub_description'] = p.sub_description
 
+    stats = table_column_stats(p.table)
+
     def aug_col(c):
         d = c.dict
-        d['stats'] = [ s.dict for s in c.stats ]
+        d['stats'] = stats.get(c.vid, [])
         return d
 
     d['table'] = p.table.dict
@@ -86,3 +206,154 @@ def partition_json(vid):
         partition = d
 
     )
+
+
+def table_column_stats(t):
+    """Return the stats records for all of the columns of a table, with one query, as a dict of lists
+    keyed by column vid"""
+    from ambry.orm import Column, ColumnStat
+
+    stats = {}
+
+    q = (aac.library.database.session.query(ColumnStat)
+         .join(Column, ColumnStat.c_vid == Column.vid)
+         .filter(Column.t_vid == t.vid))
+
+    for s in q:
+        stats.setdefault(s.c_vid, []).append(s.dict)
+
+    return stats
+
+
+MAX_ROWS_LIMIT = 10000
+ARTIFACT_ROWS_OFFSET = 100000  # Pages starting this deep build the CSV file, rather than read from the start
+
+
+def partition_rows(vid):
+    """Return a partition, the offset, its headers, total row count and the page of rows selected by the
+    'offset' and 'limit' request parameters. """
+    from flask import abort
+    from itertools import islice
+    from ambry.orm.exc import NotFoundError
+    from views import check_access, artifact_cache
+
+    try:
+        offset = max(int(request.args.get('offset', 0)), 0)
+        limit = min(max(int(request.args.get('limit', 100)), 0), MAX_ROWS_LIMIT)
+    except ValueError:
+        abort(400)
+
+    try:
+        p = aac.library.partition(vid)
+    except NotFoundError:
+        abort(404)
+
+    check_access(p)
+
+    ac = artifact_cache()
+
+    # The CSV file has an index of row offsets, but building it means writing the whole partition, so it is
+    # only worth waiting for when it will save reading a long way into the partition.
+    if ac and (ac.exists(p.vid) or offset >= ARTIFACT_ROWS_OFFSET):
+        r = ac.rows(p, offset, limit)
+    else:
+        r = None
+
+    if r is None:  # Read from the start of the partition.
+        from views import localize
+        localize(p)
+        reader = p.reader
+        r = reader.headers, p.count, list(islice(reader.rows, offset, offset + limit))
+
+    headers, count, rows = r
+
+    return p, offset, headers, count, rows
+
+
+@app.route('/json/partition/<vid>/rows')
+@conditional('vid', private=True, access='partition')
+def partition_rows_json(vid):
+    """A page of rows from a partition. The values are converted to the python types of their columns"""
+
+    p, offset, headers, count, rows = partition_rows(vid)
+
+    types = {c.name: c.python_type for c in p.table.columns}
+
+    def converter(h):
+        t = types.get(h)
+
+        def convert(v):
+            if v == '' or v is None:
+                return None
+            if t is None or not isinstance(v, basestring):
+                return v
+            try:
+                return t(v)
+            except (TypeError, ValueError):
+                return v
+
+        return convert
+
+    converters = [converter(h) for h in headers]
+
+    return aac.json(
+        partition=p.vid,
+        offset=offset,
+        count=count,
+        headers=headers,
+        rows=[[c(v) for c, v in zip(converters, row)] for row in rows]
+    )
+
+
+@app.route('/json/partition/<vid>/rows.csv')
+@conditional('vid', private=True, access='partition')
+def partition_rows_csv(vid):
+    """A page of rows from a partition, as CSV"""
+    from flask import Response
+    from streaming import CsvEncoder
+
+    p, offset, headers, count, rows = partition_rows(vid)
+
+    return Response(''.join(CsvEncoder()(headers, rows)), mimetype='text/csv')
+
+
+def check_metrics_access():
+    """Abort with a 403 unless the request comes from an address in METRICS_ALLOW, such as the
+    monitoring server's, or from a logged in admin"""
+    from flask import abort
+    from flask_login import current_user
+
+    if request.remote_addr in app.config['METRICS_ALLOW']:
+        return
+
+    if current_user.is_authenticated and current_user.is_admin:
+        return
+
+    abort(403)
+
+
+@app.route('/metrics')
+def metrics_text():
+    """Request, cache and single-flight metrics for all of the workers, in the Prometheus text format"""
+    from flask import Response
+    from metrics import registry, render
+
+    check_metrics_access()
+
+    return Response(render(registry.collect()), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/json/stats')
+def stats_json():
+    """Counters for the single-flight operations, the object cache and the dataframe cache in this worker"""
+    from singleflight import stats
+    from cache import get_cache
+    from plots import dataframe_cache
+
+    check_metrics_access()
+
+    return aac.json(
+        singleflight=stats(),
+        cache=get_cache().stats(),
+        dataframes=dataframe_cache().stats()
+    )
@@ -462,6 +462,8 @@ class AmbryContentsManager(ContentsManager):
                     nb = nbformat.from_dict(model['content'])
                     self.check_and_sign(nb, path)
 
+                    self.notebook_saved(l, b, f)
+
                     # One checkpoint should always exist for notebooks.
 
                     if not self.checkpoints.list_checkpoints(path):
@@ -493,6 +495,18 @@ class AmbryContentsManager(ContentsManager):
 
         return model
 
+    def notebook_saved(self, l, b, f):
+        """Tell the UI that a notebook has changed, and start rendering its HTML"""
+        from ambry_ui import library_changed
+        from ambry_ui.notebooks import prerender
+
+        library_changed(l, 'save', b.identity.vid)
+
+        try:
+            prerender(l, f.record.id, f.record.unpacked_contents)
+        except Exception as e:
+            self.log.error(u'Failed to start rendering notebook: %s', e)
+
     def delete_file(self, path):
         """Delete file at path."""
         from ambry.orm.exc import NotFoundError
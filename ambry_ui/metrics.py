@@ -0,0 +1,429 @@
+"""Request metrics, in the Prometheus text format.
+
+A WSGI middleware records, for each endpoint, the number of requests by status, a histogram of the time
+to handle the request, a histogram of the time to send the whole response body, which is much longer for
+streamed downloads, and the number of bytes sent. It also tracks the number of requests in progress.
+
+Each worker process keeps its metrics in memory, and writes them to a file in a directory shared by all of
+the workers at most once every FLUSH_INTERVAL seconds. /metrics reads all of the files and adds them up.
+When a worker exits, the next collection moves its counters and histograms into an archive file, so they
+keep increasing after gunicorn restarts the worker, and drops its gauges.
+
+Copyright (c) 2015 Civic Knowledge. This file is licensed under the terms of
+the Revised BSD License, included in this distribution as LICENSE.txt
+"""
+
+import json
+import os
+import threading
+import time
+
+FLUSH_INTERVAL = 1.0  # Seconds
+
+BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300, float('inf'))
+
+METRICS = {
+    'ambry_ui_requests_total': ('counter', 'Requests, by endpoint, method and status'),
+    'ambry_ui_request_duration_seconds': ('histogram', 'Time to handle a request, until the response '
+                                                       'headers are ready'),
+    'ambry_ui_response_duration_seconds': ('histogram', 'Time until the whole response body has been sent, '
+                                                        'including streaming'),
+    'ambry_ui_response_bytes_total': ('counter', 'Bytes sent in response bodies'),
+    'ambry_ui_requests_in_flight': ('gauge', 'Requests in progress'),
+    'ambry_ui_cache_requests_total': ('counter', 'Object and dataframe cache lookups, by cache and result'),
+    'ambry_ui_cache_evictions_total': ('counter', 'Values evicted from the in-process caches, by cache'),
+    'ambry_ui_cache_bytes': ('gauge', 'Size of the values in the in-process caches, by cache'),
+    'ambry_ui_singleflight_calls_total': ('counter', 'Single-flight operation calls, by operation and result'),
+}
+
+
+def _key(name, labels):
+    return json.dumps([name, sorted(labels.items())])
+
+
+class Registry(object):
+    """Metrics for one worker process, written to a file in a shared directory.
+
+    :param directory: The shared directory, or a function that returns it, called on the first write
+    """
+
+    def __init__(self, directory=None):
+        self._directory = directory
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}  # key -> [bucket counts, sum, count]
+        self.collectors = []
+        self._flushed = 0
+        self._pid = os.getpid()
+
+    @property
+    def directory(self):
+        if callable(self._directory):
+            self._directory = self._directory()
+
+        return self._directory
+
+    def _check_fork(self):
+        """Discard the metrics copied from the parent process"""
+        if os.getpid() != self._pid:
+            self.counters, self.gauges, self.histograms = {}, {}, {}
+            self._pid = os.getpid()
+
+    def inc(self, name, labels=None, value=1):
+        with self._lock:
+            self._check_fork()
+            k = _key(name, labels or {})
+            self.counters[k] = self.counters.get(k, 0) + value
+
+    def set_counter(self, name, labels, value):
+        """Set the total for a counter that is kept elsewhere in this process"""
+        with self._lock:
+            self._check_fork()
+            self.counters[_key(name, labels)] = value
+
+    def set_gauge(self, name, labels, value):
+        """Set a gauge that is kept elsewhere in this process"""
+        with self._lock:
+            self._check_fork()
+            self.gauges[_key(name, labels)] = value
+
+    def gauge_add(self, name, labels=None, value=1):
+        with self._lock:
+            self._check_fork()
+            k = _key(name, labels or {})
+            self.gauges[k] = self.gauges.get(k, 0) + value
+
+    def observe(self, name, labels, value):
+        with self._lock:
+            self._check_fork()
+            k = _key(name, labels)
+            h = self.histograms.get(k)
+
+            if h is None:
+                h = self.histograms[k] = [[0] * len(BUCKETS), 0.0, 0]
+
+            for i, b in enumerate(BUCKETS):
+                if value <= b:
+                    h[0][i] += 1
+                    break
+
+            h[1] += value
+            h[2] += 1
+
+    def collector(self, f):
+        """Register a function that is called before the metrics are written, to update counters kept
+        elsewhere in the process, such as cache statistics"""
+        self.collectors.append(f)
+        return f
+
+    def snapshot(self):
+        for f in self.collectors:
+            try:
+                f(self)
+            except Exception:
+                pass
+
+        with self._lock:
+            return dict(counters=dict(self.counters), gauges=dict(self.gauges),
+                        histograms={k: [list(v[0]), v[1], v[2]] for k, v in self.histograms.items()})
+
+    def path(self, pid=None):
+        return os.path.join(self.directory, '{}.json'.format(pid or os.getpid()))
+
+    def flush(self, force=False):
+        """Write this worker's metrics to its file, if FLUSH_INTERVAL has passed since the last write"""
+        from tempfile import mkstemp
+
+        if not force and time.time() - self._flushed < FLUSH_INTERVAL:
+            return
+
+        self._flushed = time.time()
+
+        data = json.dumps(self.snapshot())
+
+        fd, tmp = mkstemp(dir=self.directory, prefix='.')
+
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+
+        os.rename(tmp, self.path())
+
+    def collect(self):
+        """Return the metrics for all of the workers, added up"""
+        import fcntl
+
+        self.flush(force=True)
+
+        with open(os.path.join(self.directory, '.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                self._archive_dead()
+                return merge(_read(os.path.join(self.directory, fn)) for fn in os.listdir(self.directory)
+                             if fn.endswith('.json'))
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _archive_dead(self):
+        """Merge the counters and histograms of exited workers into the archive file"""
+
+        archive = os.path.join(self.directory, 'archive.json')
+        dead = []
+
+        for fn in os.listdir(self.directory):
+            if not fn.endswith('.json') or fn == 'archive.json':
+                continue
+
+            try:
+                pid = int(fn[:-5])
+            except ValueError:
+                continue
+
+            if not _alive(pid):
+                dead.append(os.path.join(self.directory, fn))
+
+        if not dead:
+            return
+
+        data = merge([_read(archive)] + [_read(fn) for fn in dead])
+        data['gauges'] = {}
+
+        with open(archive + '.tmp', 'w') as f:
+            json.dump(data, f)
+
+        os.rename(archive + '.tmp', archive)
+
+        for fn in dead:
+            os.remove(fn)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except OSError as e:
+        import errno
+        return e.errno == errno.EPERM
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def merge(snapshots):
+    """Add up worker snapshots"""
+    out = dict(counters={}, gauges={}, histograms={})
+
+    for s in snapshots:
+        for kind in ('counters', 'gauges'):
+            for k, v in s.get(kind, {}).items():
+                out[kind][k] = out[kind].get(k, 0) + v
+
+        for k, (buckets, sum_, count) in s.get('histograms', {}).items():
+            h = out['histograms'].get(k)
+
+            if h is None:
+                out['histograms'][k] = [list(buckets), sum_, count]
+            else:
+                h[0] = [a + b for a, b in zip(h[0], buckets)]
+                h[1] += sum_
+                h[2] += count
+
+    return out
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+
+    def escape(v):
+        return unicode(v).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+    return '{' + ','.join('{}="{}"'.format(k, escape(v)) for k, v in labels) + '}'
+
+
+def _format_value(v):
+    if v == float('inf'):
+        return '+Inf'
+
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+def render(data):
+    """Return the metrics in the Prometheus text exposition format"""
+
+    samples = {}  # name -> list of lines
+
+    for kind in ('counters', 'gauges'):
+        for k, v in data.get(kind, {}).items():
+            name, labels = json.loads(k)
+            samples.setdefault(name, []).append('{}{} {}'.format(name, _format_labels(labels), _format_value(v)))
+
+    for k, (buckets, sum_, count) in data.get('histograms', {}).items():
+        name, labels = json.loads(k)
+        lines = samples.setdefault(name, [])
+
+        cumulative = 0
+        for b, n in zip(BUCKETS, buckets):
+            cumulative += n
+            lines.append('{}_bucket{} {}'.format(name, _format_labels(labels + [['le', _format_value(b)]]),
+                                                 cumulative))
+
+        lines.append('{}_sum{} {}'.format(name, _format_labels(labels), _format_value(sum_)))
+        lines.append('{}_count{} {}'.format(name, _format_labels(labels), count))
+
+    out = []
+
+    for name in sorted(samples):
+        type_, help_ = METRICS.get(name, ('untyped', name))
+        out.append('# HELP {} {}'.format(name, help_))
+        out.append('# TYPE {} {}'.format(name, type_))
+        out.extend(sorted(samples[name]))
+
+    return '\n'.join(out) + '\n'
+
+
+class _Body(object):
+    """Response body wrapper that counts the bytes sent, and records the metrics when the server
+    closes it"""
+
+    def __init__(self, body, done):
+        self.body = body
+        self.done = done
+        self.size = 0
+
+    def __iter__(self):
+        for chunk in self.body:
+            self.size += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            self.done(self.size)
+
+
+class MetricsMiddleware(object):
+    """WSGI middleware that records the request metrics. The endpoint label is taken from the
+    'ambry_ui.endpoint' environ key, which the app sets for requests that match a route, and is
+    'unmatched' for other requests. """
+
+    def __init__(self, app, registry):
+        self.app = app
+        self.registry = registry
+
+    def __call__(self, environ, start_response):
+        r = self.registry
+        status = []
+        start = time.time()
+
+        def _start_response(s, headers, exc_info=None):
+            status.append(s.split(' ', 1)[0])
+            return start_response(s, headers, exc_info)
+
+        r.gauge_add('ambry_ui_requests_in_flight')
+
+        try:
+            body = self.app(environ, _start_response)
+        except:
+            r.gauge_add('ambry_ui_requests_in_flight', value=-1)
+            raise
+
+        endpoint = environ.get('ambry_ui.endpoint') or 'unmatched'
+        labels = dict(endpoint=endpoint)
+
+        r.observe('ambry_ui_request_duration_seconds', labels, time.time() - start)
+
+        def done(size):
+            r.gauge_add('ambry_ui_requests_in_flight', value=-1)
+            r.observe('ambry_ui_response_duration_seconds', labels, time.time() - start)
+            r.inc('ambry_ui_response_bytes_total', labels, size)
+            r.inc('ambry_ui_requests_total', dict(endpoint=endpoint, method=environ.get('REQUEST_METHOD'),
+                                                  status=status[0] if status else ''))
+            try:
+                r.flush()
+            except (IOError, OSError):
+                pass
+
+        return _Body(body, done)
+
+
+def _metrics_dir():
+    from . import app, get_library
+
+    d = app.config.get('METRICS_DIR') or get_library().filesystem.cache('ui/metrics')
+
+    if not os.path.exists(d):
+        os.makedirs(d)
+
+    return d
+
+
+registry = Registry(_metrics_dir)
+
+
+@registry.collector
+def collect_cache_stats(r):
+    import cache
+
+    created = cache._cache
+
+    if created is not None and created[0] == os.getpid():
+        s = created[1].stats()
+
+        for result in ('memory_hits', 'disk_hits', 'misses'):
+            r.set_counter('ambry_ui_cache_requests_total', dict(cache='objects', result=result), s[result])
+
+        r.set_counter('ambry_ui_cache_evictions_total', dict(cache='objects'), s['evictions'])
+        r.set_gauge('ambry_ui_cache_bytes', dict(cache='objects'), s['memory_bytes'])
+
+
+@registry.collector
+def collect_dataframe_stats(r):
+    import plots
+
+    if plots._dataframes is not None:
+        s = plots._dataframes.stats()
+
+        for result in ('hits', 'misses'):
+            r.set_counter('ambry_ui_cache_requests_total', dict(cache='dataframes', result=result), s[result])
+
+        r.set_counter('ambry_ui_cache_evictions_total', dict(cache='dataframes'), s['evictions'])
+        r.set_gauge('ambry_ui_cache_bytes', dict(cache='dataframes'), s['bytes'])
+
+
+@registry.collector
+def collect_singleflight_stats(r):
+    from singleflight import stats
+
+    for operation, s in stats().items():
+        for result in ('leaders', 'hits', 'waits', 'errors'):
+            r.set_counter('ambry_ui_singleflight_calls_total', dict(operation=operation, result=result),
+                          s[result])
+
+
+def init_app(app):
+    """Wrap the app's WSGI application with the metrics middleware, and label requests with their
+    endpoints"""
+    import atexit
+    from flask import request
+
+    app.wsgi_app = MetricsMiddleware(app.wsgi_app, registry)
+
+    @app.before_request
+    def label_endpoint():
+        request.environ['ambry_ui.endpoint'] = request.endpoint or 'unmatched'
+
+    @atexit.register
+    def flush_metrics():
+        if registry._flushed:  # Only for workers that have handled requests
+            try:
+                registry.flush(force=True)
+            except (IOError, OSError):
+                pass
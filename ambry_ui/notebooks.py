@@ -0,0 +1,154 @@
+"""Rendering notebooks to HTML, with a cache of the rendered HTML.
+
+Converting a notebook with nbconvert can take from hundreds of milliseconds to many seconds, so the HTML
+is cached in the library cache, keyed by the file id and a hash of the notebook's contents. Conversions run
+in a pool of processes, so a large notebook doesn't hold up a web worker, and are started ahead of time
+when bundles are checked in and when notebooks are saved in Jupyter.
+
+Copyright (c) 2015 Civic Knowledge. This file is licensed under the terms of
+the Revised BSD License, included in this distribution as LICENSE.txt
+"""
+
+import os
+import threading
+
+from . import app_config, on_library_change
+
+_pool = None
+_pool_pid = None
+_lock = threading.Lock()
+_pending = {}  # cache path -> AsyncResult for conversions started by this process
+
+
+def convert(contents):
+    """Convert a notebook, as a JSON string, to an HTML fragment"""
+    import nbformat
+    from nbconvert import HTMLExporter
+
+    notebook = nbformat.reads(contents, as_version=4)
+
+    html_exporter = HTMLExporter()
+    html_exporter.template_file = 'basic'
+
+    body, resources = html_exporter.from_notebook_node(notebook)
+
+    return body
+
+
+def content_hash(contents):
+    from hashlib import sha1
+
+    if isinstance(contents, unicode):
+        contents = contents.encode('utf-8')
+
+    return sha1(contents).hexdigest()
+
+
+def cache_path(library, fileid, contents):
+    return os.path.join(library.filesystem.cache('ui/notebooks'),
+                        '{}-{}.html'.format(fileid, content_hash(contents)))
+
+
+def _get_pool():
+    from multiprocessing import Pool
+    global _pool, _pool_pid
+
+    if _pool is None or _pool_pid != os.getpid():
+        _pool = Pool(processes=app_config['NOTEBOOK_WORKERS'], maxtasksperchild=20)
+        _pool_pid = os.getpid()
+        _pending.clear()
+
+    return _pool
+
+
+def _write(path, html):
+    """Write the HTML for a notebook, and remove the HTML for older versions of it"""
+    import glob
+
+    if isinstance(html, unicode):
+        html = html.encode('utf-8')
+
+    tmp = '{}.{}'.format(path, os.getpid())
+
+    with open(tmp, 'wb') as f:
+        f.write(html)
+
+    os.rename(tmp, path)
+
+    prefix = path.rsplit('-', 1)[0]
+
+    for fn in glob.glob(prefix + '-*.html'):
+        if fn != path:
+            try:
+                os.remove(fn)
+            except OSError:
+                pass
+
+
+def prerender(library, fileid, contents):
+    """Start converting a notebook in the process pool, if its HTML isn't cached or being converted
+    already. Returns the AsyncResult for the conversion, or None if the HTML is cached. """
+
+    path = cache_path(library, fileid, contents)
+
+    if os.path.exists(path):
+        return None
+
+    def done(html):
+        try:
+            _write(path, html)
+        finally:
+            with _lock:
+                _pending.pop(path, None)
+
+    with _lock:
+        pool = _get_pool()
+
+        if path not in _pending:
+            _pending[path] = pool.apply_async(convert, (contents,), callback=done)
+
+        return _pending[path]
+
+
+def render(library, fileid, contents, timeout=None):
+    """Return the HTML for a notebook, from the cache or by converting it. Returns None if the conversion
+    doesn't finish within timeout seconds, in which case it continues in the background. """
+    from multiprocessing import TimeoutError
+
+    path = cache_path(library, fileid, contents)
+
+    if not os.path.exists(path):
+        result = prerender(library, fileid, contents)
+
+        if result is not None:
+            try:
+                result.get(app_config['NOTEBOOK_RENDER_TIMEOUT'] if timeout is None else timeout)
+            except TimeoutError:
+                return None
+            except Exception:
+                with _lock:
+                    _pending.pop(path, None)
+                raise
+
+    try:
+        with open(path, 'rb') as f:
+            return f.read().decode('utf-8')
+    except IOError:  # The callback that writes the file hasn't run yet
+        return None
+
+
+def prerender_bundle(library, vid):
+    """Start converting all of the notebooks in a bundle"""
+    from ambry.orm.file import File
+
+    b = library.bundle(vid)
+
+    for f in b.build_source_files.list_records(File.BSFILE.NOTEBOOK):
+        if f.record.size:
+            prerender(library, f.record.id, f.record.unpacked_contents)
+
+
+@on_library_change
+def prerender_changed(library, event, vid):
+    if vid and event in ('checkin', 'sync'):
+        prerender_bundle(library, vid)
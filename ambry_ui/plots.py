@@ -4,7 +4,9 @@ Copyright (c) 2015 Civic Knowledge. This file is licensed under the terms of
 the Revised BSD License, included in this distribution as LICENSE.txt
 """
 
-from . import app, get_aac
+from . import app, get_aac, on_library_change
+from conditional import conditional
+from cache import memoize
 from werkzeug.local import LocalProxy
 from flask import session, request, flash, redirect, abort, url_for
 from flask_login import login_user, logout_user, login_required, current_user
@@ -15,69 +17,64 @@ import logging
 
 logger = app.logger
 
-logger = logging.getLogger('gunicorn.access')
 
+_dataframes = None
+_dataframes_generation = None
 
-def plot_df(pvid, measure_ref, **kwargs):
-    """Return a dataframe for a plot"""
 
-    primary_dimension = None
-    secondary_dimension = None
-    filtered = {}
+def dataframe_cache():
+    """Return the worker's LRU of plot dataframes, bounded by their memory usage. The LRU is cleared when
+    the library change counter changes, so no worker serves frames for a bundle that was checked in again
+    or synced through another worker. """
+    from cache import MemoryLRU
+    from catalog import generation
+    global _dataframes, _dataframes_generation
 
-    p = aac.library.partition(pvid)
+    if _dataframes is None:
+        _dataframes = MemoryLRU(app.config['DATAFRAME_CACHE_SIZE'])
 
-    md = p.measuredim
+    g = generation(aac.library)
 
-    measure = md.measure(measure_ref)
+    if g != _dataframes_generation:
+        _dataframes.clear()
+        _dataframes_generation = g
 
-    for k, v in kwargs.items():
+    return _dataframes
 
-        if k == 'primary':
-            primary_dimension = v
-        elif k == 'secondary':
-            secondary_dimension = v
-        else:
-            # The filter value need to be of the same data type as the column, or
-            # the filtering code may try to, for instance, check equality between a string
-            # and an int.
-            d = md.dimension(k)
-            filtered[k] = d.python_type(v)
 
-    df = md.dataframe(measure.name,primary_dimension,secondary_dimension,filters=filtered)
+@on_library_change
+def clear_dataframes(library, event, vid):
+    if _dataframes is not None:
+        _dataframes.clear()
 
 
-    # Hack! The dataframe datatype is not preserved across all of the operations below,
-    # so we have to manually preserve the metadata.
-    _metadata = df._metadata
-    metadata = { k:getattr(df, k)  for k in _metadata }
+def plot_df(pvid, measure_ref, **kwargs):
+    """Return a dataframe for a plot, from the cache if possible. The dataframes are shared by all of
+    the requests in the worker, so callers must not modify them. """
+    from cache import MISSING
 
-    labels = df.labels
+    primary = kwargs.pop('primary', None)
+    secondary = kwargs.pop('secondary', None)
 
-    columns = labels + [df.measure]
+    # Filter values arrive as strings from the query, so they are compared as strings in the key
+    key = (pvid, measure_ref, primary, secondary, tuple(sorted((k, unicode(v)) for k, v in kwargs.items())))
 
-    if 'gvid' in list(df.columns):
-        columns.append('gvid')
+    cache = dataframe_cache()
 
-    df = df[columns]
+    df = cache.get(key)
 
-    if secondary_dimension:
-        df = df.set_index(labels).unstack()
-        df.columns = df.columns.droplevel()
-    else:
-        df = df.set_index(labels)
+    if df is MISSING:
+        df = build_plot_df(pvid, measure_ref, primary=primary, secondary=secondary, **kwargs)
+        cache.set(key, df, int(df.memory_usage(index=True, deep=True).sum()), pvid)
 
-    df.reset_index(inplace=True)
-    df.set_index(labels[0], inplace=True)
-
-    # Total Hack!
-    df._metadata = _metadata
-    for k in _metadata:
-        setattr(df, k, metadata[k])
+    return df
 
 
-    return df
+def build_plot_df(pvid, measure_ref, primary=None, secondary=None, **filters):
+    """Return a dataframe for a plot, aggregated from the partition's cube"""
+    from cube import get_cube
 
+    return get_cube(aac.library, pvid).dataframe(measure_ref, primary, secondary, filters)
 
 
 def measure_dict(p, m):
@@ -116,15 +113,36 @@ def dimpath(p_dim, s_dim):
     return p_dim + ('/'+s_dim if s_dim else '')
 
 
+def variant_key(filters):
+    """Return the key that matches a plot's configuration to its data in the batch payload"""
+    return '&'.join(u'{}={}'.format(k, v) for k, v in sorted(filters.items()))
+
+
+def plot_filters(ds, args):
+    """Return the filters for a plot from the query arguments, keeping only the arguments that name one of the
+    dimension set's filter dimensions, so other arguments, such as a cache buster, are ignored """
+    return {k: v for k, v in args.items() if k in ds['filters']}
+
+
 def make_plot_json(pvid, measure, dimpath, filters = {}):
 
-    md = aac.library.partition(pvid).measuredim
+    ds = measuredim_summary(pvid)['dimension_sets'][dimpath]
+
+    return make_plot_config(pvid, measure, ds, filters)
 
-    ds = md.enumerate_dimension_sets()[dimpath]
+
+def make_plot_config(pvid, measure, ds, filters = {}):
+    """Return the c3 configuration for a plot of a measure, for a dimension set from
+    enumerate_dimension_sets()"""
+
+    url_args = dict(filters)
+
+    if ds['p_dim_type'] == 'time' and app.config['PLOT_MAX_POINTS']:
+        url_args['max_points'] = app.config['PLOT_MAX_POINTS']
 
     data_csv_url = url_for('get_plot_data_csv',
-                           pvid=pvid, measure=measure, dimpath=dimpath,
-                           **filters)
+                           pvid=pvid, measure=measure, dimpath=dimpath(ds['p_dim'], ds['s_dim']),
+                           **url_args)
 
     plot_config = {
 
@@ -165,21 +183,93 @@ def make_plot_json(pvid, measure, dimpath, filters = {}):
         plot_config['data']['xSort'] = 'bar'
 
     plot_config['dimension_set'] = ds
+    plot_config['key'] = variant_key(filters)
 
     return plot_config
 
 
 
-#@app.cache.memoize(timeout=300)
+# Incremented when the contents of the summaries change, so the cached ones are recomputed
+MEASUREDIM_NAMESPACE = 'measuredim-2'
+
+
+def build_measuredim_summary(p):
+    """Return the measure and dimension configuration of a partition, its dimension sets, and the names of
+    its columns and of its measures by vid"""
+
+    md = p.measuredim
+
+    return dict(
+        dict=md.dict,
+        dimension_sets=md.enumerate_dimension_sets(),
+        columns={c.vid: c.name for c in p.table.columns},
+        measures={c.vid: c.name for c in p.table.columns if c.role == 'm'}
+    )
+
+
+@memoize(MEASUREDIM_NAMESPACE)
+def measuredim_summary(pvid):
+    """Return the cached summary from build_measuredim_summary(). Partition vids are versioned, so a
+    summary only changes when its bundle is checked in again, which removes it from the cache. """
+    return build_measuredim_summary(aac.library.partition(pvid))
+
+
 def measuredim_dict(pvid):
+    return measuredim_summary(pvid)['dict']
+
+
+def check_measure(pvid, measure):
+    """Abort with a 400 unless the measure, a name or vid, is one of the partition's measures"""
+
+    measures = measuredim_summary(pvid)['measures']
+
+    if measure not in measures and measure not in measures.values():
+        abort(400)
+
+
+@on_library_change
+def warm_measuredim(library, event, vid):
+    """Compute the summaries for the partitions of a bundle that was checked in, so the first plot
+    doesn't have to. The cache listener, registered when the cache module was imported, has already
+    removed the old ones. """
+    from cache import get_cache
+
+    if not vid or event not in ('checkin', 'sync'):
+        return
 
-    md = aac.library.partition(pvid).measuredim
+    cache = get_cache(library)
 
-    d = md.dict
+    for p in library.bundle(vid).partitions:
+        try:
+            cache.set(MEASUREDIM_NAMESPACE, p.vid, build_measuredim_summary(p))
+        except Exception as e:  # Partitions without measures and dimensions
+            logger.debug("No measure and dimension summary for {}: {}".format(p.vid, e))
+
+
+def downsample_plot(df, ds, max_points, method='lttb'):
+    """Return the dataframe for a plot sorted by its index, and, for a plot of a time dimension, reduced to
+    max_points points for each series. Aborts with a 400 for an invalid max_points or method. """
+    from downsample import downsample_frame
+
+    try:
+        max_points = int(max_points or 0)
+    except ValueError:
+        abort(400)
+
+    if max_points < 0:
+        abort(400)
+
+    if not max_points or ds['p_dim_type'] != 'time':
+        return df.sort_index()
+
+    try:
+        return downsample_frame(df, max_points, method)
+    except ValueError:
+        abort(400)
 
-    return d
 
 @app.route('/plots/<pvid>/config.json')
+@conditional('pvid')
 def get_plot_partition_config(pvid):
     """Return the json configuration for a partition, including all of the
     :param pvid:
@@ -188,24 +278,32 @@ def get_plot_partition_config(pvid):
 
 
 @app.route('/plots/<pvid>/plots/<cvid>')
+@conditional('pvid', private=True)
 def get_plots(pvid, cvid):
     """A page of plots for a single partition"""
-    import json
+
+    summary = measuredim_summary(pvid)
 
     p = aac.library.partition(pvid)
     b = p.bundle
 
-    md = p.measuredim
+    if cvid in summary['columns']:
+        measure = dict(vid=cvid, name=summary['columns'][cvid])
+    elif cvid in summary['columns'].values():
+        measure = dict(vid=None, name=cvid)
+    else:
+        abort(404)
 
-    measure = md.measure(cvid)
+    check_measure(pvid, cvid)
 
     return aac.render('bundle/plots.html',
                       p=p, b=b,
                       measure=measure,
-                      md=md.dict,
+                      md=summary['dict'],
                       **aac.cc)
 
 @app.route('/plots/<pvid>/data/<path:dimpath>/<measure>.csv')
+@conditional('pvid')
 def get_plot_data_csv(pvid, dimpath, measure):
     """Return the CSV file for the data for a plot
     :param pvid:
@@ -216,19 +314,23 @@ def get_plot_data_csv(pvid, dimpath, measure):
     from cStringIO import StringIO
 
     buf = StringIO()
-    p = aac.library.partition(pvid)
 
-    md = p.measuredim.dict
-    dim_set = md['dimension_sets'][dimpath]
+    check_measure(pvid, measure)
+
+    dim_set = measuredim_dict(pvid)['dimension_sets'][dimpath]
+
+    filters = plot_filters(dim_set, request.args)
+    max_points = request.args.get('max_points')
+    method = request.args.get('downsample', 'lttb')
 
-    df = plot_df(pvid, measure, primary=dim_set['p_dim'], secondary =dim_set['s_dim'],
-                 **dict(request.args.items()))  # Convert from MultiDict to dict
+    df = plot_df(pvid, measure, primary=dim_set['p_dim'], secondary =dim_set['s_dim'], **filters)
 
-    df.sort_index().to_csv(buf)
+    downsample_plot(df, dim_set, max_points, method).to_csv(buf)
     return Response(buf.getvalue(), mimetype='text/csv')
 
 
 @app.route('/plots/<pvid>/data/<path:dimpath>/<measure>.json')
+@conditional('pvid')
 def get_plot_data_json(pvid, dimpath, measure):
     """Return the CSV file for the data for a plot
     :param pvid:
@@ -240,6 +342,8 @@ def get_plot_data_json(pvid, dimpath, measure):
 
     b = StringIO()
 
+    check_measure(pvid, measure)
+
     df = plot_df(pvid, measure, primary=dimpath)  # Assume there is only one component of path, for maps
 
 
@@ -250,17 +354,59 @@ def get_plot_data_json(pvid, dimpath, measure):
 
 
 @app.route('/plots/<pvid>/config/<path:dimpath>/<measure>.json')
+@conditional('pvid')
 def get_plot_json(pvid, dimpath, measure):
     """Return the json configuration for a plot
     :param pvid:
     :param cvid: The measure to plot
     """
 
+    check_measure(pvid, measure)
+
     d = make_plot_json(pvid, measure, dimpath)
 
     return aac.json(**d)
 
 
+def plot_rows(df):
+    """Return a plot dataframe as a header and a list of rows, as c3 takes them in data.rows"""
+
+    df = df.sort_index().reset_index()
+
+    rows = [[unicode(c) for c in df.columns]]
+
+    for row in df.itertuples(index=False):
+        rows.append([None if isinstance(v, float) and v != v else v for v in row])  # NaN isn't valid JSON
+
+    return rows
+
+
+@app.route('/plots/<pvid>/batch/<path:dimpath>/<measure>.json')
+@conditional('pvid')
+def get_plot_batch_json(pvid, dimpath, measure):
+    """Return the data for a plot and for all of its filtered variants, so the plot page can render them
+    from one request. The data for the variants is computed with one grouped pass over the partition's
+    cube for each filter dimension.
+    :param pvid:
+    :param cvid: The measure to plot
+    """
+    from cube import get_cube
+
+    check_measure(pvid, measure)
+
+    ds = measuredim_dict(pvid)['dimension_sets'][dimpath]
+
+    variants = get_cube(aac.library, pvid).variants(measure, ds['p_dim'], ds['s_dim'], ds['filters'])
+
+    max_points = request.args.get('max_points', app.config['PLOT_MAX_POINTS'])
+    method = request.args.get('downsample', 'lttb')
+
+    return aac.json(dimension_set=ds,
+                    plots=[dict(key=variant_key(f), filters=f,
+                                rows=plot_rows(downsample_plot(df, ds, max_points, method)))
+                           for f, df in variants])
+
+
 @app.route('/plots/<pvid>/config/map/measure.json')
 def get_map_json(pvid, measure):
     """Return the json configuration for a map
@@ -276,24 +422,24 @@ def get_map_json(pvid, measure):
 
 
 @app.route('/plots/<pvid>/plot/<path:dimpath>/<measure>')
+@conditional('pvid', private=True)
 def get_plot(pvid, dimpath, measure):
     """A single plot page"""
-    import json
-    import copy
 
-    plot_config = make_plot_json(pvid, measure, dimpath)
+    check_measure(pvid, measure)
 
     p = aac.library.partition(pvid)
     b = p.bundle
 
-    md = p.measuredim
-    ds = plot_config['dimension_set']
+    ds = measuredim_summary(pvid)['dimension_sets'][dimpath]
+
+    plot_config = make_plot_config(pvid, measure, ds)
 
     variants = []
 
-    for filter_col, filter_vals in ds['filters'].items():
+    for filter_col, filter_vals in sorted(ds['filters'].items()):
         for filter_val in filter_vals:
-            d = make_plot_json(pvid, measure, dimpath, {filter_col:filter_val})
+            d = make_plot_config(pvid, measure, ds, {filter_col:filter_val})
             d['subtitle'] = "Filter: {}={}".format(filter_col,filter_val)
             variants.append(d)
 
@@ -301,14 +447,16 @@ def get_plot(pvid, dimpath, measure):
                       config=plot_config,
                       dimension_set=ds,
                       variants=variants,
+                      data_url=url_for('get_plot_batch_json', pvid=pvid, dimpath=dimpath, measure=measure),
                       vid=b.identity.vid, b=b, p=p, **aac.cc)
 
 
 @app.route('/plots/<pvid>/map/<measure>')
+@conditional('pvid', private=True)
 def get_map(pvid, measure):
     import json
 
-    app.cache.set('foobar', 'foobtz')
+    check_measure(pvid, measure)
 
     json_data_url = url_for('get_plot_data_json',
                             pvid=pvid, measure=measure,
@@ -330,6 +478,7 @@ def get_map(pvid, measure):
 
 
 @app.route('/boundaries/<gvid>/<sl>')
+@conditional()
 def get_boundaries(gvid, sl):
     """
     Return a cached, static geojson file of boundaries for a region
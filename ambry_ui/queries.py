@@ -0,0 +1,188 @@
+"""Counting and timing the SQL statements executed for each request.
+
+Listeners on the library's engine record the number of statements, the time spent in them, and the
+number of times each statement shape -- the statement with its literals and parameters replaced -- is
+executed. At the end of a request, the totals are added to the response in a Server-Timing header, and
+statement shapes repeated more than QUERY_REPEAT_THRESHOLD times, which usually come from lazy loading a
+relationship in a loop, are logged as N+1 query warnings. The access log can include the header with
+gunicorn's %({Server-Timing}o)s format variable.
+
+Statements executed while a streamed response body is generated, after the headers are sent, are not
+included.
+
+Copyright (c) 2015 Civic Knowledge. This file is licensed under the terms of
+the Revised BSD License, included in this distribution as LICENSE.txt
+"""
+
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+_local = threading.local()
+
+_literal_re = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b|%\(\w+\)s|:\w+|\?")
+_in_list_re = re.compile(r'\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)', re.IGNORECASE)
+_space_re = re.compile(r'\s+')
+
+
+def statement_shape(statement):
+    """Return a statement with literals and parameters replaced by '?', so statements that differ
+    only in their values have the same shape"""
+
+    s = _literal_re.sub('?', statement)
+    s = _in_list_re.sub('IN (?)', s)
+
+    return _space_re.sub(' ', s).strip()
+
+
+class QueryStats(object):
+    """The statements executed during a request or a test"""
+
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+        self.shapes = {}
+
+    def add(self, statement, elapsed):
+        self.count += 1
+        self.time += elapsed
+
+        shape = statement_shape(statement)
+        self.shapes[shape] = self.shapes.get(shape, 0) + 1
+
+    def repeated(self, threshold):
+        """Return (count, shape) for the statement shapes executed more than threshold times, most
+        frequent first"""
+        return sorted(((n, s) for s, n in self.shapes.items() if n > threshold), reverse=True)
+
+    def server_timing(self):
+        return 'db;dur={:.1f};desc="{} queries"'.format(self.time * 1000, self.count)
+
+
+def _active():
+    return getattr(_local, 'stack', None) or []
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _active():
+        conn.info.setdefault('query_start', []).append(time.time())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stack = _active()
+
+    if stack:
+        starts = conn.info.get('query_start')
+        elapsed = time.time() - starts.pop() if starts else 0.0
+
+        for stats in stack:
+            stats.add(statement, elapsed)
+
+
+def instrument(engine):
+    """Add the statement counting listeners to an engine"""
+    from sqlalchemy import event
+
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+def start():
+    """Start recording statements executed by this thread, and return the QueryStats they are
+    recorded in"""
+    stats = QueryStats()
+
+    if getattr(_local, 'stack', None) is None:
+        _local.stack = []
+
+    _local.stack.append(stats)
+
+    return stats
+
+
+def stop(stats):
+    """Stop recording statements in stats"""
+    stack = _active()
+
+    if stats in stack:
+        stack.remove(stats)
+
+    return stats
+
+
+@contextmanager
+def recording():
+    """Context manager that records the statements executed by this thread in the QueryStats it
+    yields"""
+    stats = start()
+
+    try:
+        yield stats
+    finally:
+        stop(stats)
+
+
+class QueryBudgetExceeded(AssertionError):
+    """More statements were executed than a test allowed"""
+
+
+@contextmanager
+def query_budget(n, max_repeats=None):
+    """Context manager for tests that fails with QueryBudgetExceeded if more than n statements, or
+    more than max_repeats statements with the same shape, are executed in its block.
+
+        with query_budget(10):
+            self.client.get('/json/bundle/' + vid)
+    """
+
+    with recording() as stats:
+        yield stats
+
+    if stats.count > n:
+        raise QueryBudgetExceeded('{} queries, over the budget of {}. Most frequent:\n{}'.format(
+            stats.count, n, format_shapes(sorted(((c, s) for s, c in stats.shapes.items()), reverse=True)[:5])))
+
+    if max_repeats is not None and stats.repeated(max_repeats):
+        raise QueryBudgetExceeded('Statements repeated more than {} times:\n{}'.format(
+            max_repeats, format_shapes(stats.repeated(max_repeats))))
+
+
+def format_shapes(shapes):
+    return '\n'.join('{:6d} {}'.format(n, s[:200]) for n, s in shapes)
+
+
+def init_app(app):
+    """Record the statements for each request of a Flask app, and report them in the response"""
+    from flask import g, request
+
+    @app.before_request
+    def start_query_stats():
+        g.query_stats = start()
+
+    @app.after_request
+    def report_query_stats(response):
+        stats = getattr(g, 'query_stats', None)
+
+        if stats is None:
+            return response
+
+        stop(stats)
+
+        response.headers['Server-Timing'] = stats.server_timing()
+
+        threshold = app.config['QUERY_REPEAT_THRESHOLD']
+        repeated = stats.repeated(threshold) if threshold else []
+
+        if repeated:
+            app.logger.warning('Possible N+1 queries in {} {}:\n{}'.format(
+                request.method, request.path, format_shapes(repeated)))
+
+        return response
+
+    @app.teardown_request
+    def stop_query_stats(exception=None):
+        stats = getattr(g, 'query_stats', None)
+
+        if stats is not None:
+            stop(stats)
@@ -0,0 +1,206 @@
+"""Single-flight execution of expensive, idempotent operations, such as localizing a partition.
+
+When many requests need the same operation at once, the first one to arrive runs it, and the others wait for it
+to finish before running their own call, which then finds the work already done. Waiting is coordinated
+between threads with an in-process registry, and between worker processes with a file lock.
+
+Copyright (c) 2015 Civic Knowledge. This file is licensed under the terms of
+the Revised BSD License, included in this distribution as LICENSE.txt
+"""
+
+import os
+import threading
+import time
+
+from cache import MemoryLRU, MISSING
+
+MAX_DONE = 10000  # Number of completed operations remembered in each process
+
+_lock = threading.Lock()
+_inflight = {}  # (name, key) -> _Flight for operations currently running in this process
+_done = MemoryLRU(MAX_DONE)  # (name, key) for the most recent operations completed in this process
+_stats = {}
+
+
+class _Flight(object):
+    """An operation in progress, which other threads can wait on"""
+
+    def __init__(self):
+        self.event = threading.Event()
+
+
+def _counters(name):
+    if name not in _stats:
+        _stats[name] = dict(calls=0, leaders=0, hits=0, waits=0, lock_waits=0, errors=0, wait_time=0.0)
+    return _stats[name]
+
+
+def stats(name=None):
+    """Return a copy of the counters for one operation name, or for all of them"""
+    with _lock:
+        if name:
+            return dict(_counters(name))
+        return {k: dict(v) for k, v in _stats.items()}
+
+
+def _lock_file(lock_dir, name, key):
+    import re
+
+    fn = '{}-{}.lock'.format(name, re.sub(r'[^\w\-\.]', '_', str(key)))
+
+    return os.path.join(lock_dir, fn)
+
+
+def _open_locked(path, wait, c):
+    """Open and lock the lock file at path, returning the open file, or None if wait is False and another
+    process holds the lock. Lock files are removed after a successful run, so if the file was removed while
+    this process waited for the lock, it locks the new file instead. """
+    import fcntl
+
+    while True:
+        f = open(path, 'a')
+
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            if not wait:
+                f.close()
+                return None
+
+            # Another worker is running the operation; wait for it.
+            t = time.time()
+            fcntl.flock(f, fcntl.LOCK_EX)
+            with _lock:
+                c['lock_waits'] += 1
+                c['wait_time'] += time.time() - t
+
+        try:
+            if os.stat(path).st_ino == os.fstat(f.fileno()).st_ino:
+                return f
+        except OSError:
+            pass
+
+        f.close()
+
+
+def _run_locked(name, key, fn, lock_dir, wait=True):
+    """Run fn while holding the cross-process file lock for the key. If wait is False and another process
+    holds the lock, return None without running fn. The lock file is removed when fn succeeds. """
+
+    path = _lock_file(lock_dir, name, key)
+
+    f = _open_locked(path, wait, _counters(name))
+
+    if f is None:
+        return None
+
+    try:
+        r = fn()
+        os.remove(path)  # While still locked, so waiting processes see that it was removed
+        return r
+    finally:
+        f.close()  # Releases the lock
+
+
+def run(name, key, fn, lock_dir=None):
+    """Call fn(), allowing only one call for each name and key to be in progress at a time.
+
+    :param name: Name of the operation, such as 'localize'. Used for the statistics and lock file names
+    :param key: Key for the object the operation is applied to, usually a partition vid
+    :param fn: Idempotent function to call. It is called once per caller, but callers that arrive while
+        another call is running wait for it to complete first.
+    :param lock_dir: If set, directory for lock files used to coordinate with other processes.
+    :return: the return value of fn()
+    """
+
+    fk = (name, key)
+
+    with _lock:
+        c = _counters(name)
+        c['calls'] += 1
+
+        if _done.get(fk) is not MISSING:
+            c['hits'] += 1
+            flight = None
+            leader = False
+        elif fk in _inflight:
+            flight = _inflight[fk]
+            leader = False
+        else:
+            flight = _inflight[fk] = _Flight()
+            c['leaders'] += 1
+            leader = True
+
+    if not leader:
+        if flight is not None:
+            t = time.time()
+            flight.event.wait()
+            with _lock:
+                c['waits'] += 1
+                c['wait_time'] += time.time() - t
+
+        return fn()
+
+    try:
+        if lock_dir:
+            r = _run_locked(name, key, fn, lock_dir)
+        else:
+            r = fn()
+
+        with _lock:
+            _done.set(fk, True, 1)
+
+        return r
+
+    except Exception:
+        with _lock:
+            c['errors'] += 1
+        raise
+
+    finally:
+        with _lock:
+            del _inflight[fk]
+        flight.event.set()
+
+
+def start(name, key, fn, lock_dir=None):
+    """Call fn() on a background thread, unless a call for the name and key is already in progress in this
+    process or, with lock_dir, in another process. For requests that shouldn't wait for the operation.
+
+    The thread isn't a daemon, so a worker that is shutting down finishes the operation before it exits.
+
+    :return: The thread, or None if a call was already in progress in this process
+    """
+
+    fk = (name, key)
+
+    with _lock:
+        c = _counters(name)
+        c['calls'] += 1
+
+        if fk in _inflight:
+            c['hits'] += 1
+            return None
+
+        flight = _inflight[fk] = _Flight()
+        c['leaders'] += 1
+
+    def target():
+        try:
+            if lock_dir:
+                _run_locked(name, key, fn, lock_dir, wait=False)
+            else:
+                fn()
+        except Exception:
+            with _lock:
+                c['errors'] += 1
+            raise
+        finally:
+            with _lock:
+                del _inflight[fk]
+            flight.event.set()
+
+    t = threading.Thread(target=target, name='{}-{}'.format(name, key))
+    t.start()
+
+    return t
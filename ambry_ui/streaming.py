@@ -0,0 +1,368 @@
+"""Encoders for streaming partition rows in download formats.
+
+Copyright (c) 2015 Civic Knowledge. This file is licensed under the terms of
+the Revised BSD License, included in this distribution as LICENSE.txt
+"""
+
+DEFAULT_FLUSH_SIZE = 128 * 1024
+
+
+class FilterError(ValueError):
+    """A bad column name or filter term in a RowFilter"""
+
+
+class CsvEncoder(object):
+    """Encode rows as CSV, yielding blocks of about flush_size bytes rather than one chunk per row.
+
+    All of the rows are written through a single csv writer into one buffer, which is emptied
+    and reused each time a block is yielded.
+
+    If index_interval is set, the encoder records the byte offset of the start of every
+    index_interval'th row in the offsets list, starting with the first row after the header,
+    and the number of rows in n_rows.
+    """
+
+    def __init__(self, flush_size=DEFAULT_FLUSH_SIZE, index_interval=None):
+        self.flush_size = flush_size
+        self.index_interval = index_interval
+        self.offsets = []
+        self.n_rows = 0
+
+    def encode(self, headers, rows):
+        """Generate CSV blocks for the header row, if it is not None, followed by the rows"""
+        from cStringIO import StringIO
+        import unicodecsv as csv
+
+        flush_size = self.flush_size
+        interval = self.index_interval
+
+        buf = StringIO()
+        writerow = csv.writer(buf).writerow
+        tell = buf.tell
+
+        flushed = 0  # Bytes yielded so far
+        offsets = self.offsets = []
+        n = 0
+
+        if headers is not None:
+            writerow(headers)
+
+        for row in rows:
+            if interval and n % interval == 0:
+                offsets.append(flushed + tell())
+
+            writerow(row)
+            n += 1
+
+            if tell() >= flush_size:
+                flushed += tell()
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+
+        self.n_rows = n
+
+        if tell():
+            yield buf.getvalue()
+
+    __call__ = encode
+
+
+class MsgpackEncoder(object):
+    """Encode the header and each row as a msgpack array, packing batches of batch_size rows
+    with one reused packer and yielding each batch as a single block. """
+
+    def __init__(self, batch_size=10000):
+        self.batch_size = batch_size
+
+    def encode(self, headers, rows):
+        import msgpack
+
+        batch_size = self.batch_size
+
+        packer = msgpack.Packer(autoreset=False)
+        pack = packer.pack
+
+        pack(headers)
+
+        n = 0
+        for row in rows:
+            pack(row)
+            n += 1
+
+            if n == batch_size:
+                yield packer.bytes()
+                packer.reset()
+                n = 0
+
+        data = packer.bytes()
+
+        if data:
+            yield data
+
+    __call__ = encode
+
+
+class ColumnarMsgpackEncoder(MsgpackEncoder):
+    """Encode rows as a stream of column-oriented msgpack record batches.
+
+    The first object in the stream is a map describing the file:
+
+        {'format': 'columnar', 'headers': [...]}
+
+    Each following object is a map for a batch of up to batch_size rows, with the values of each
+    column in a separate array, in the same order as the headers:
+
+        {'offset': <row number of the first row>, 'n': <number of rows>, 'columns': [[...], [...], ...]}
+    """
+
+    def encode(self, headers, rows):
+        import msgpack
+        from itertools import islice
+
+        packer = msgpack.Packer()
+
+        yield packer.pack({'format': 'columnar', 'headers': headers})
+
+        rows = iter(rows)
+        offset = 0
+
+        while True:
+            batch = list(islice(rows, self.batch_size))
+
+            if not batch:
+                break
+
+            yield packer.pack({'offset': offset, 'n': len(batch), 'columns': list(zip(*batch))})
+
+            offset += len(batch)
+
+    __call__ = encode
+
+
+def parse_where(term):
+    """Parse a row filter term into a (column, op, value) tuple. The value is a string for the
+    'eq' op and a list of strings for 'in' and 'range'. Terms have one of these forms:
+
+        column:value, column:eq:value   Column equals the value
+        column:in:v1,v2,...             Column is one of the values
+        column:range:low,high           Column is between low and high, inclusive. Either may be empty.
+    """
+
+    try:
+        column, value = term.split(':', 1)
+    except ValueError:
+        raise FilterError("Bad where term '{}'; expected column:value".format(term))
+
+    op, _, rest = value.partition(':')
+
+    if op in ('eq', 'in', 'range') and _:
+        value = rest
+    else:
+        op = 'eq'
+
+    if op == 'eq':
+        return column, op, value
+
+    values = value.split(',')
+
+    if op == 'range' and len(values) != 2:
+        raise FilterError("Bad range in where term '{}'; expected column:range:low,high".format(term))
+
+    return column, op, values
+
+
+DATETIME_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S',
+                    '%Y-%m-%dT%H:%M', '%Y-%m-%d %H:%M', '%Y-%m-%d')
+
+
+def parse_datetime(v):
+    """Parse an ISO 8601 date or date and time, without a timezone"""
+    from datetime import datetime
+
+    for fmt in DATETIME_FORMATS:
+        try:
+            return datetime.strptime(v, fmt)
+        except ValueError:
+            pass
+
+    raise ValueError("Bad date or time '{}'".format(v))
+
+
+def parse_time(v):
+    """Parse an ISO 8601 time of day"""
+    from datetime import datetime
+
+    for fmt in ('%H:%M:%S.%f', '%H:%M:%S', '%H:%M'):
+        try:
+            return datetime.strptime(v, fmt).time()
+        except ValueError:
+            pass
+
+    raise ValueError("Bad time '{}'".format(v))
+
+
+def converter(typ):
+    """Return a function that converts a filter value from the query string to the python type of a
+    column. Strings are converted to unicode, since str() fails on non-ASCII values, and dates and times
+    are parsed from ISO 8601. """
+    import datetime
+
+    if typ is None:
+        return lambda v: v
+    elif typ in (str, unicode, basestring):
+        return unicode
+    elif typ is datetime.datetime:
+        return parse_datetime
+    elif typ is datetime.date:
+        return lambda v: parse_datetime(v).date()
+    elif typ is datetime.time:
+        return parse_time
+    else:
+        return typ
+
+
+class RowFilter(object):
+    """Project columns and select rows from a stream of rows, before they are encoded.
+
+    :param headers: Names of the columns in the rows
+    :param columns: Names of the columns to return, or None for all of them
+    :param where: List of filter terms, in the form accepted by parse_where(). Rows must match all of them.
+    :param types: Dict mapping column names to the python types used to convert filter values, so
+        they can be compared to the values in the rows.
+
+    Raises FilterError for unknown columns and values that can't be converted.
+    """
+
+    def __init__(self, headers, columns=None, where=None, types=None):
+        import operator
+
+        types = types or {}
+        index = {h: i for i, h in enumerate(headers)}
+
+        def col_index(c):
+            try:
+                return index[c]
+            except KeyError:
+                raise FilterError("Unknown column '{}'".format(c))
+
+        if columns:
+            idx = [col_index(c) for c in columns]
+            self.headers = [headers[i] for i in idx]
+            if len(idx) == 1:
+                i = idx[0]
+                self.project = lambda row: (row[i],)
+            else:
+                self.project = operator.itemgetter(*idx)
+        else:
+            self.headers = list(headers)
+            self.project = None
+
+        self.predicates = []
+
+        for term in (where or []):
+            column, op, value = parse_where(term)
+            self.predicates.append(self._predicate(col_index(column), op, value, types.get(column)))
+
+    @staticmethod
+    def _predicate(i, op, value, typ):
+
+        convert = converter(typ)
+
+        def coerce(v):
+            if v == '':
+                return None
+            try:
+                return convert(v)
+            except (TypeError, ValueError, UnicodeError):
+                raise FilterError("Can't convert {!r} to {}".format(v, typ.__name__))  # repr() is ASCII safe
+
+        if op == 'eq':
+            v = coerce(value)
+            return lambda row: row[i] == v
+
+        elif op == 'in':
+            vs = frozenset(coerce(v) for v in value)
+            return lambda row: row[i] in vs
+
+        else:
+            low, high = [coerce(v) for v in value]
+
+            def in_range(row):
+                v = row[i]
+                return (v is not None and
+                        (low is None or v >= low) and
+                        (high is None or v <= high))
+
+            return in_range
+
+    def __call__(self, rows):
+        """Generate the selected rows, with the projected columns"""
+
+        project = self.project
+        predicates = self.predicates
+
+        if len(predicates) == 1:
+            match = predicates[0]
+            rows = (row for row in rows if match(row))
+        elif predicates:
+            rows = (row for row in rows if all(p(row) for p in predicates))
+
+        if project:
+            rows = (project(row) for row in rows)
+
+        return rows
+
+
+def head_and_sample(rows, n, seed=None):
+    """Return the first n rows, a uniform random sample of n rows, and the total number of rows, in
+    one pass over the rows. The sample is selected with reservoir sampling, and is in row order.
+
+    :param rows: Iterable of rows
+    :param n: Number of rows in the head and the sample
+    :param seed: Seed for the random number generator, so the same rows give the same sample
+    """
+    import random
+
+    rand = random.Random(seed).random
+
+    head = []
+    reservoir = []  # (row number, row)
+    i = -1
+
+    for i, row in enumerate(rows):
+        if i < n:
+            head.append(row)
+            reservoir.append((i, row))
+        else:
+            j = int(rand() * (i + 1))
+            if j < n:
+                reservoir[j] = (i, row)
+
+    return head, [row for _, row in sorted(reservoir, key=lambda e: e[0])], i + 1
+
+
+def gzip_chunks(chunks, level=6, flush_size=DEFAULT_FLUSH_SIZE):
+    """Compress an iterable of byte strings into a gzip stream. The compressor is flushed whenever
+    flush_size bytes of input have accumulated, so the client receives data while the input is still
+    being generated. """
+    import zlib
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # gzip header and trailer
+    pending = 0
+
+    for chunk in chunks:
+        if not chunk:
+            continue
+
+        data = compressor.compress(chunk)
+        pending += len(chunk)
+
+        if pending >= flush_size:
+            data += compressor.flush(zlib.Z_SYNC_FLUSH)
+            pending = 0
+
+        if data:
+            yield data
+
+    yield compressor.flush()
@@ -4,7 +4,7 @@ Copyright (c) 2015 Civic Knowledge. This file is licensed under the terms of
 the Revised BSD License, included in this distribution as LICENSE.txt
 """
 
-from . import app, get_aac
+from . import app, get_aac, library_changed
 from werkzeug.local import LocalProxy
 from flask import session,  request, flash, redirect, abort, url_for
 from flask_login import login_user, logout_user, login_required, current_user
@@ -15,8 +15,6 @@ import logging
 
 logger = app.logger
 
-logger = logging.getLogger('gunicorn.access')
-
 @app.login_manager.user_loader
 def load_user(user_id):
     from ambry.orm.exc import NotFoundError
@@ -262,6 +260,7 @@ def admin_remotes():
         if request.form.get('install'):
             aac.library.checkin_remote_bundle(request.form['install'])
             b = aac.library.bundle(request.form['install'])
+            library_changed(aac.library, 'sync', b.identity.vid)
             flash("Installed bundle {}".format(b.identity.vname), 'success')
 
     cxt = dict(
@@ -319,6 +318,7 @@ def admin_bundles():
     if request.method == 'POST' and request.form.get('delete'):
         aac.library.remove(request.form['delete'])
         aac.library.commit()
+        library_changed(aac.library, 'remove', request.form['delete'])
 
     cxt = dict(
         bundles=[b for b in aac.library.bundles],
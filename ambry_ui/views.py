@@ -6,6 +6,7 @@ the Revised BSD License, included in this distribution as LICENSE.txt
 
 import os
 from . import app, get_aac
+from conditional import conditional
 from flask import g, current_app, send_from_directory, send_file, request, abort, url_for
 from werkzeug.local import LocalProxy
 import logging
@@ -20,9 +21,12 @@ def page_not_found(e):
 
 @app.route('/')
 @app.route('/index')
+@conditional(listing=True, private=True)
 def index():
+    from catalog import catalog
+
     cxt = dict(
-        bundles=[b for b in aac.library.bundles],
+        bundles=catalog.records(aac.library),
         **aac.cc
     )
 
@@ -30,6 +34,7 @@ def index():
 
 
 @app.route('/bundles/<vid>')
+@conditional('vid', private=True)
 def bundle_main(vid):
     cxt = dict(
         vid=vid,
@@ -42,6 +47,7 @@ def bundle_main(vid):
 
 
 @app.route('/bundles/<vid>/meta')
+@conditional('vid', private=True)
 def bundle_meta(vid):
     def flatten_dict(d):
         def expand(key, value):
@@ -69,6 +75,7 @@ def bundle_meta(vid):
 
 
 @app.route('/bundles/<vid>/files')
+@conditional('vid', private=True)
 def bundle_files(vid):
     cxt = dict(
         vid=vid,
@@ -80,6 +87,7 @@ def bundle_files(vid):
 
 
 @app.route('/bundles/<vid>/file/<name>')
+@conditional('vid', listing=True)  # Build source files can be edited
 def bundle_file(vid, name):
     """Return a file from the bundle"""
     from cStringIO import StringIO
@@ -97,6 +105,7 @@ def bundle_file(vid, name):
 
 
 @app.route('/bundles/<vid>/notebooks')
+@conditional('vid', private=True, listing=True)  # Notebooks can be edited
 def bundle_notebooks(vid):
     """Return a file from the bundle"""
     from ambry.orm.file import File
@@ -115,23 +124,18 @@ def bundle_notebooks(vid):
 
 
 @app.route('/bundles/<vid>/notebooks/<fileid>')
+@conditional('vid', private=True, listing=True)  # Notebooks can be edited
 def bundle_notebook(vid, fileid):
-    """Return a file from the bundle"""
+    """Return a notebook, rendered as HTML. The HTML is cached, and if it isn't cached yet, it is rendered
+    in a separate process. If that takes too long, return a 503 page that asks the user to retry. """
     from ambry.orm.file import File
-    import nbformat
-    from traitlets.config import Config
-    from nbconvert import HTMLExporter
+    from notebooks import render
 
     b = aac.library.bundle(vid)
 
     nbfile = b.build_source_files.file_by_id(fileid)
 
-    notebook = nbformat.reads(nbfile.unpacked_contents, as_version=4)
-
-    html_exporter = HTMLExporter()
-    html_exporter.template_file = 'basic'
-
-    (body, resources) = html_exporter.from_notebook_node(notebook)
+    notebook_html = render(aac.library, fileid, nbfile.unpacked_contents)
 
     cxt = dict(
         vid=vid,
@@ -139,16 +143,21 @@ def bundle_notebook(vid, fileid):
         fileid=fileid,
         nbfile=nbfile,
         notebooks=b.build_source_files.list_records(File.BSFILE.NOTEBOOK),
-        notebook=notebook,
-        notebook_html=body,
+        notebook_html=notebook_html,
         **aac.cc
 
     )
 
+    if notebook_html is None:
+        r = app.make_response((aac.render('bundle/notebook.html', rendering=True, **cxt), 503))
+        r.headers['Retry-After'] = '5'
+        return r
+
     return aac.render('bundle/notebook.html', **cxt)
 
 
 @app.route('/search')
+@conditional(listing=True, private=True)
 def search():
     """Search for a datasets and partitions, using a structured JSON term."""
 
@@ -166,6 +175,7 @@ def search():
 
 
 @app.route('/bundles/<vid>/tables/<tvid>')
+@conditional('vid', private=True)
 def get_table(vid, tvid):
     b = aac.library.bundle(vid)
 
@@ -182,6 +192,7 @@ def get_table(vid, tvid):
 
 
 @app.route('/partitions/<pvid>')
+@conditional('pvid', private=True)
 def get_partition(pvid):
 
     p = aac.library.partition(pvid)
@@ -209,6 +220,60 @@ def get_partition(pvid):
 
     return aac.render('bundle/partition.html', **cxt)
 
+@app.route('/partitions/<pvid>/preview')
+@conditional('pvid', private=True, access='partition')
+def get_partition_preview(pvid):
+    """Return the first rows of a partition and a uniform random sample of its rows, as JSON. Both are
+    computed in one pass over the partition, and cached by partition vid and sample size. """
+    from flask import Response
+    from ambry.orm.exc import NotFoundError
+    from singleflight import run
+    from os.path import join, exists
+
+    try:
+        n = min(max(int(request.args.get('n', 20)), 1), 1000)
+    except ValueError:
+        abort(400)
+
+    try:
+        p = aac.library.partition(pvid)
+    except NotFoundError:
+        abort(404)
+
+    check_access(p)
+
+    cache_dir = aac.library.filesystem.cache('ui/preview')
+    path = join(cache_dir, '{}-{}.json'.format(p.vid, n))
+
+    def build():
+        from streaming import head_and_sample
+        import os
+
+        if exists(path):
+            return
+
+        localize(p)
+
+        reader = p.reader
+
+        head, sample, count = head_and_sample(reader.rows, n, seed=p.vid)
+
+        data = aac.json(partition=p.vid, headers=reader.headers, count=count, head=head, sample=sample).data
+
+        tmp = path + '.' + str(os.getpid())
+
+        with open(tmp, 'wb') as f:
+            f.write(data)
+
+        os.rename(tmp, path)
+
+    if not exists(path):
+        run('preview', '{}-{}'.format(p.vid, n), build, lock_dir=aac.library.filesystem.cache('ui/locks'))
+
+    with open(path, 'rb') as f:
+        return Response(f.read(), mimetype='application/json')
+
+
 @app.route('/bundles/<bvid>/process')
 def bundle_process(bvid):
     b = aac.library.bundle(bvid)
@@ -230,8 +295,8 @@ def bundle_process(bvid):
 @app.route('/file/<pvid>.<ct>')
 def stream_file(pvid, ct):
     from flask import abort
-    from flask.ext.login import current_user
     from ambry.orm.exc import NotFoundError
+    from streaming import FilterError
 
     try:
         p = aac.library.partition(pvid)
@@ -239,17 +304,18 @@ def stream_file(pvid, ct):
         app.logger.error("Stream file: failed to find partition: {}".format(e))
         return abort(404)
 
-    if p.bundle.metadata.about.access != 'public' and not current_user.is_authenticated:
-        from api import jwt_auth
-        r = jwt_auth()
-        if r != 0:
-            return abort(r)
+    check_access(p)
 
     try:
         if ct == 'csv':
             return stream_csv(pvid)
         elif ct == 'mpack':
             return stream_mpack(pvid)
+        elif ct == 'mpackc':
+            return stream_mpack(pvid, columnar=True)
+    except FilterError as e:
+        app.logger.info("Stream file: bad columns or where parameters: {}".format(e))
+        return abort(400)
     except NotFoundError as e:
         app.logger.error("Stream file: failed to get file: {}".format(e))
         pass
@@ -257,52 +323,288 @@ def stream_file(pvid, ct):
     return abort(404)
 
 
+def check_access(p):
+    """Abort unless the partition's bundle is public, or the user is logged in or has a valid API token"""
+
+    check_bundle_access(p.bundle)
+
+
+def check_bundle_access(b):
+    """Abort unless the bundle is public, or the user is logged in or has a valid API token"""
+    from flask.ext.login import current_user
+
+    if b.metadata.about.access != 'public' and not current_user.is_authenticated:
+        from api import jwt_auth
+        r = jwt_auth()
+        if r != 0:
+            abort(r)
+
+
+def localize(p):
+    """Localize a partition's data file. Concurrent requests for the same partition, in this and other
+    workers, wait for the first one to fetch the file, rather than all fetching it at once. """
+    from singleflight import run
+
+    run('localize', p.vid, p.localize, lock_dir=aac.library.filesystem.cache('ui/locks'))
+
+
+def filtered_rows(p, reader):
+    """Return the headers and rows from a partition reader, restricted by the 'columns' and 'where'
+    request parameters. Filter values are converted to the python type of their columns.
+
+        columns=name1,name2,...     Only return these columns, in this order
+        where=column:value          Only return rows where column equals value. Also column:in:v1,v2,...
+                                    and column:range:low,high. Repeat for multiple conditions.
+    """
+    from streaming import RowFilter
+
+    columns = request.args.get('columns')
+    where = request.args.getlist('where')
+
+    if not columns and not where:
+        return reader.headers, reader.rows
+
+    rf = RowFilter(reader.headers,
+                   columns=columns.split(',') if columns else None,
+                   where=where,
+                   types={c.name: c.python_type for c in p.table.columns})
+
+    return rf.headers, rf(reader.rows)
+
+
+def artifact_cache():
+    """Return the cache of materialized CSV files, or None if it is disabled"""
+    from artifacts import ArtifactCache
+
+    if not app.config['ARTIFACT_CACHE_SIZE']:
+        return None
+
+    return ArtifactCache(aac.library, max_size=app.config['ARTIFACT_CACHE_SIZE'],
+                         flush_size=app.config['CSV_FLUSH_SIZE'])
+
+
+def send_file_range(path, mimetype, etag):
+    """Send a file, or the single byte range of it requested with a Range header. The range is
+    ignored if an If-Range header has a different etag. Dates in If-Range are always accepted, because
+    the file for a partition version never changes. """
+    from flask import Response
+    from werkzeug.datastructures import ContentRange
+
+    rng = request.range
+
+    if rng is not None and (rng.units != 'bytes' or len(rng.ranges) != 1):
+        rng = None  # Multiple ranges are allowed to get the whole file
+
+    if rng is not None and request.if_range.etag not in (None, etag):
+        rng = None
+
+    if rng is None:
+        return send_file(path, mimetype=mimetype, add_etags=False)
+
+    size = os.path.getsize(path)
+
+    byte_range = rng.range_for_length(size)
+
+    if byte_range is None:
+        r = Response(status=416)
+        r.headers['Content-Range'] = 'bytes */{}'.format(size)
+        return r
+
+    start, stop = byte_range
+
+    def read_range(chunk_size=64 * 1024):
+        with open(path, 'rb') as f:
+            f.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                data = f.read(min(chunk_size, remaining))
+                if not data:
+                    break
+                remaining -= len(data)
+                yield data
+
+    r = Response(read_range(), 206, mimetype=mimetype, direct_passthrough=True)
+    r.content_length = stop - start
+    r.content_range = ContentRange('bytes', start, stop, size)
+
+    return r
+
+
+def send_artifact(p):
+    """Send the materialized CSV file for a partition, gzipped if the client accepts it, with support
+    for range requests. Returns None if the file can't be cached, or, if it doesn't exist yet, after
+    starting to build it in the background, so the caller streams the partition instead of making the
+    client wait for the build, which can take longer than the server's timeout. """
+
+    ac = artifact_cache()
+
+    paths = ac.get(p, wait=False) if ac else None
+
+    if not paths:
+        return None
+
+    csv_path, gz_path = paths
+
+    gzipped = request.accept_encodings.quality('gzip') > 0
+
+    path = gz_path if gzipped else csv_path
+    etag = p.vid + ('-gz' if gzipped else '')  # The two encodings are different representations
+
+    if app.use_x_sendfile:
+        r = send_file(path, mimetype='text/csv', add_etags=False)  # The front-end server handles ranges
+    else:
+        r = send_file_range(path, 'text/csv', etag)
+
+    if gzipped:
+        r.headers['Content-Encoding'] = 'gzip'
+
+    r.headers['Accept-Ranges'] = 'bytes'
+    r.vary.add('Accept-Encoding')
+    r.set_etag(etag)
+
+    return r.make_conditional(request)
+
+
 def stream_csv(pvid):
     from flask import Response
-    import cStringIO as StringIO
-    import unicodecsv as csv
+    from streaming import CsvEncoder
 
     p = aac.library.partition(pvid)
 
-    p.localize()
+    if not request.args.get('columns') and not request.args.getlist('where'):
+        r = send_artifact(p)
+        if r is not None:
+            return r
+
+    localize(p)
 
     reader = p.reader
 
-    def yield_csv_row(w, b, row):
-        w.writerow(row)
-        b.seek(0)
-        data = b.read()
-        b.seek(0)
-        b.truncate()
-        return data
+    headers, rows = filtered_rows(p, reader)
+
+    encoder = CsvEncoder(app.config['CSV_FLUSH_SIZE'])
+
+    return Response(encoder(headers, rows), mimetype='text/csv')
+
+
+class Prefetcher(object):
+    """Localize partitions on a background thread, ahead of a request that streams them in order.
+
+    The thread uses the worker's library, and so its connection pool, with its own thread-local session,
+    which it removes when it is done. Localization goes through the same single-flight registry as
+    localize(), so when the request gets to a partition, it either finds the file already local or waits for
+    the prefetch to finish.
+    """
+
+    def __init__(self, lock_dir):
+        import threading
+        import Queue
+
+        self.lock_dir = lock_dir
+        self.queue = Queue.Queue()
+        self.thread = threading.Thread(target=self.run, name='prefetch')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def prefetch(self, vid):
+        self.queue.put(vid)
+
+    def stop(self):
+        self.queue.put(None)
+
+    def run(self):
+        from singleflight import run
+        from . import get_library
 
-    def stream_csv():
-        b = StringIO.StringIO()
-        writer = csv.writer(b)
+        l = get_library()
 
-        yield yield_csv_row(writer, b, reader.headers)
+        try:
+            for vid in iter(self.queue.get, None):
+                try:
+                    run('localize', vid, l.partition(vid).localize, lock_dir=self.lock_dir)
+                except Exception as e:
+                    app.logger.error("Prefetch: failed to localize {}: {}".format(vid, e))
+        finally:
+            l.database.session.remove()
 
-        for row in reader.rows:
-            yield yield_csv_row(writer, b, row)
 
-    return Response(stream_csv(), mimetype='text/csv')
+@app.route('/bundles/<vid>/download.zip')
+def bundle_download_zip(vid):
+    """Stream all of the partitions in a bundle, as CSV files in a ZIP archive. With sources=true, include
+    the bundle's build source files. """
+    from flask import Response, stream_with_context
+    from streaming import CsvEncoder
+    from zipstream import ZipStream
 
+    b = aac.bundle(vid)
 
-def stream_mpack(pvid):
+    check_bundle_access(b)
+
+    name = b.identity.vname
+    include_sources = request.args.get('sources', '').lower() in ('1', 'true', 'yes')
+    partitions = sorted(b.partitions, key=lambda p: p.identity.name)
+    ac = artifact_cache()
+
+    def csv_blocks(p):
+        if ac and ac.exists(p.vid):
+            with open(ac.path(p.vid, 'csv'), 'rb') as f:
+                for block in iter(lambda: f.read(app.config['CSV_FLUSH_SIZE']), ''):
+                    yield block
+        else:
+            localize(p)
+            reader = p.reader
+            for block in CsvEncoder(app.config['CSV_FLUSH_SIZE'])(reader.headers, reader.rows):
+                yield block
+
+    def generate():
+        zs = ZipStream()
+
+        if len(partitions) > 1:
+            prefetcher = Prefetcher(aac.library.filesystem.cache('ui/locks')).start()
+        else:
+            prefetcher = None
+
+        try:
+            for i, p in enumerate(partitions):
+                # Localize the next partition while this one streams.
+                if prefetcher and i + 1 < len(partitions):
+                    prefetcher.prefetch(partitions[i + 1].vid)
+
+                for data in zs.write_iter('{}/{}.csv'.format(name, p.identity.name), csv_blocks(p)):
+                    yield data
+        finally:
+            if prefetcher:
+                prefetcher.stop()
+
+        if include_sources:
+            for f in b.build_source_files:
+                for data in zs.write_str('{}/sources/{}'.format(name, f.record.path), f.getcontent() or ''):
+                    yield data
+
+        for data in zs.close():
+            yield data
+
+    r = Response(stream_with_context(generate()), mimetype='application/zip')
+    r.headers['Content-Disposition'] = 'attachment; filename="{}.zip"'.format(name)
+
+    return r
+
+
+def stream_mpack(pvid, columnar=False):
     from flask import Response
-    import cStringIO as StringIO
-    import unicodecsv as csv
-    import msgpack
+    from streaming import MsgpackEncoder, ColumnarMsgpackEncoder
 
     p = aac.library.partition(pvid)
 
-    p.localize()
+    localize(p)
 
     reader = p.reader
 
-    def stream_msgp():
-        yield msgpack.packb(reader.headers)
-        for row in reader.rows:
-            yield msgpack.packb(row)
+    headers, rows = filtered_rows(p, reader)
+
+    encoder = (ColumnarMsgpackEncoder if columnar else MsgpackEncoder)(app.config['MPACK_BATCH_ROWS'])
 
-    return Response(stream_msgp(), mimetype='application/msgpack')
+    return Response(encoder(headers, rows), mimetype='application/msgpack')
@@ -0,0 +1,157 @@
+"""A constant-memory, streaming ZIP64 archive writer.
+
+The standard library's zipfile module needs a seekable file to write an archive, so it can't be used to
+stream one in a response. This writer generates the archive as a sequence of byte strings. Entries are
+written with data descriptors, so their sizes and checksums don't have to be known in advance, and always
+with ZIP64 sizes and offsets, so entries and archives can be larger than 4GB.
+
+Copyright (c) 2015 Civic Knowledge. This file is licensed under the terms of
+the Revised BSD License, included in this distribution as LICENSE.txt
+"""
+
+import struct
+import time
+import zlib
+
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP64_VERSION = 45
+DEFLATED = 8
+STORED = 0
+
+FLAG_DATA_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+
+
+def dos_date_time(t=None):
+    """Return the DOS (date, time) fields for a unix time"""
+    tt = time.localtime(t)
+
+    return (((max(tt.tm_year, 1980) - 1980) << 9) | (tt.tm_mon << 5) | tt.tm_mday,
+            (tt.tm_hour << 11) | (tt.tm_min << 5) | (tt.tm_sec // 2))
+
+
+class _Entry(object):
+
+    def __init__(self, name, offset, compression, date, time):
+        self.name = name
+        self.offset = offset
+        self.compression = compression
+        self.date = date
+        self.time = time
+        self.crc = 0
+        self.size = 0
+        self.compressed_size = 0
+
+
+class ZipStream(object):
+    """Write a ZIP archive as a stream of byte strings.
+
+    Add entries with write_iter() or write_str(), which are generators of the bytes for the entry, then
+    finish the archive with close(), which generates the central directory:
+
+        zs = ZipStream()
+
+        def generate():
+            for data in zs.write_iter('data.csv', csv_blocks):
+                yield data
+            for data in zs.close():
+                yield data
+
+    :param compression: DEFLATED or STORED
+    :param level: zlib compression level
+    """
+
+    def __init__(self, compression=DEFLATED, level=zlib.Z_DEFAULT_COMPRESSION):
+        self.compression = compression
+        self.level = level
+        self.entries = []
+        self.offset = 0
+
+    def _emit(self, data):
+        self.offset += len(data)
+        return data
+
+    def write_iter(self, name, chunks, mtime=None):
+        """Generate an entry for a file with the contents from an iterable of byte strings"""
+
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+
+        date, tm = dos_date_time(mtime)
+        e = _Entry(name, self.offset, self.compression, date, tm)
+
+        # Sizes are in the data descriptor. The ZIP64 extra field has placeholders.
+        extra = struct.pack('<HHQQ', 1, 16, 0, 0)
+
+        yield self._emit(struct.pack('<IHHHHHIIIHH', 0x04034b50, ZIP64_VERSION, FLAG_DATA_DESCRIPTOR | FLAG_UTF8,
+                                     e.compression, e.time, e.date, 0, ZIP64_LIMIT, ZIP64_LIMIT,
+                                     len(name), len(extra)) + name + extra)
+
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15) if e.compression == DEFLATED else None
+
+        crc = 0
+        size = 0
+        compressed_size = 0
+
+        for chunk in chunks:
+            if not chunk:
+                continue
+
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+
+            if compressor:
+                chunk = compressor.compress(chunk)
+                if not chunk:
+                    continue
+
+            compressed_size += len(chunk)
+            yield self._emit(chunk)
+
+        if compressor:
+            chunk = compressor.flush()
+            compressed_size += len(chunk)
+            yield self._emit(chunk)
+
+        e.crc = crc & 0xFFFFFFFF
+        e.size = size
+        e.compressed_size = compressed_size
+
+        yield self._emit(struct.pack('<IIQQ', 0x08074b50, e.crc, e.compressed_size, e.size))
+
+        self.entries.append(e)
+
+    def write_str(self, name, data, mtime=None):
+        """Generate an entry for a file with the contents of a string"""
+
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+
+        return self.write_iter(name, [data], mtime)
+
+    def close(self):
+        """Generate the central directory, which ends the archive"""
+
+        cd_offset = self.offset
+
+        for e in self.entries:
+            extra = struct.pack('<HHQQQ', 1, 24, e.size, e.compressed_size, e.offset)
+
+            yield self._emit(struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50,
+                                         (3 << 8) | ZIP64_VERSION, ZIP64_VERSION,  # Made on Unix
+                                         FLAG_DATA_DESCRIPTOR | FLAG_UTF8, e.compression, e.time, e.date,
+                                         e.crc, ZIP64_LIMIT, ZIP64_LIMIT,
+                                         len(e.name), len(extra), 0, 0, 0,
+                                         0o100644 << 16, ZIP64_LIMIT) + e.name + extra)
+
+        cd_size = self.offset - cd_offset
+        zip64_eocd_offset = self.offset
+        n = len(self.entries)
+
+        yield self._emit(struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, ZIP64_VERSION, ZIP64_VERSION, 0, 0,
+                                     n, n, cd_size, cd_offset))
+
+        yield self._emit(struct.pack('<IIQI', 0x07064b50, 0, zip64_eocd_offset, 1))
+
+        yield self._emit(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, min(n, 0xFFFF), min(n, 0xFFFF),
+                                     ZIP64_LIMIT, ZIP64_LIMIT, 0))
@@ -0,0 +1,66 @@
+"""Benchmark the streaming encoders against the original one-chunk-per-row CSV path
+
+Run with:
+
+    python test/bench_streaming.py [n_rows]
+"""
+
+import sys
+import time
+
+
+def make_rows(n):
+    return ([i, 'Row number {}'.format(i), i * 1.5, i % 58, '2015-01-01'] for i in xrange(n))
+
+
+headers = ['id', 'name', 'value', 'county', 'date']
+
+
+def per_row_csv(headers, rows):
+    """The original stream_csv implementation, which yields one chunk per row"""
+    import cStringIO as StringIO
+    import unicodecsv as csv
+
+    def yield_csv_row(w, b, row):
+        w.writerow(row)
+        b.seek(0)
+        data = b.read()
+        b.seek(0)
+        b.truncate()
+        return data
+
+    b = StringIO.StringIO()
+    writer = csv.writer(b)
+
+    yield yield_csv_row(writer, b, headers)
+
+    for row in rows:
+        yield yield_csv_row(writer, b, row)
+
+
+def bench(name, f, n):
+    t = time.time()
+    chunks = 0
+    size = 0
+
+    for chunk in f(headers, make_rows(n)):
+        chunks += 1
+        size += len(chunk)
+
+    dt = time.time() - t
+
+    print '{:<24} {:>12,.0f} rows/s {:>10,.1f} MB/s {:>10,} chunks {:>8.2f}s'.format(
+        name, n / dt, size / dt / 1e6, chunks, dt)
+
+
+def main(n):
+    from ambry_ui.streaming import CsvEncoder
+
+    bench('csv, per row', per_row_csv, n)
+
+    for flush_size in (64 * 1024, 128 * 1024, 256 * 1024):
+        bench('csv, {}K blocks'.format(flush_size / 1024), CsvEncoder(flush_size), n)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
@@ -0,0 +1,35 @@
+"""Stand-ins for the library, its filesystem and other ORM objects, for tests of modules that only use
+a few of their attributes."""
+
+
+class Obj(object):
+    """An object with the keyword arguments as attributes"""
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeFilesystem(object):
+    """A library filesystem whose cache directories are in a temporary root"""
+
+    def __init__(self, root):
+        self.root = root
+
+    def cache(self, name):
+        import os
+
+        path = os.path.join(self.root, name)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        return path
+
+
+class FakeLibrary(object):
+    """A library with a filesystem and, optionally, partitions that can be found by vid"""
+
+    def __init__(self, root, partitions=()):
+        self.filesystem = FakeFilesystem(root)
+        self.partitions = {p.vid: p for p in partitions}
+
+    def partition(self, vid):
+        return self.partitions[vid]
@@ -0,0 +1,163 @@
+import unittest
+
+from .fakes import FakeLibrary
+
+
+class FakeReader(object):
+
+    headers = ['id', 'name']
+
+    def __init__(self, n):
+        self.n = n
+
+    @property
+    def rows(self):
+        return ([i, 'row {}'.format(i)] for i in range(self.n))
+
+
+class FakePartition(object):
+
+    def __init__(self, vid, n):
+        self.vid = vid
+        self.reader = FakeReader(n)
+
+    def localize(self):
+        pass
+
+
+class ArtifactCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+
+        shutil.rmtree(self.root)
+
+    def test_build_and_evict(self):
+        from ambry_ui.artifacts import ArtifactCache
+        import gzip
+        import os
+        import time
+
+        ac = ArtifactCache(FakeLibrary(self.root), flush_size=1024)
+
+        csv_path, gz_path = ac.get(FakePartition('p00001', 1000))
+
+        with open(csv_path) as f:
+            csv = f.read()
+
+        self.assertTrue(csv.startswith('id,name\r\n0,row 0\r\n'))
+        self.assertEqual(csv, gzip.open(gz_path).read())
+        self.assertFalse(ac.build(FakePartition('p00001', 1000)))
+
+        ac.get(FakePartition('p00002', 1000))
+
+        # Make the first partition's files the oldest, then use them so they become the most recent.
+        for vid, age in (('p00001', 200), ('p00002', 100)):
+            for ext in ('csv', 'csv.gz'):
+                os.utime(ac.path(vid, ext), (time.time() - age, time.time() - age))
+
+        ac.get(FakePartition('p00001', 1000))
+
+        ac.evict(ac.size - 1)
+
+        self.assertTrue(ac.exists('p00001'))
+        self.assertFalse(ac.exists('p00002'))
+
+        ac.max_size = 10
+        self.assertIsNone(ac.get(FakePartition('p00003', 1000)))
+
+    def test_too_large(self):
+        """A partition that doesn't fit is built once, and later requests skip straight to streaming"""
+        from ambry_ui.artifacts import ArtifactCache
+        import os
+
+        ac = ArtifactCache(FakeLibrary(self.root), max_size=5000, flush_size=1024)
+
+        self.assertIsNone(ac.get(FakePartition('p00001', 10000)))
+        self.assertTrue(ac.too_large('p00001'))
+        self.assertEqual([], [fn for fn in os.listdir(ac.root) if fn.startswith('.')])
+
+        p = FakePartition('p00001', 10000)
+        p.reader = None  # Would fail if the build were tried again
+        self.assertIsNone(ac.get(p))
+
+        ac.max_size = 10 ** 7  # Tried again when the cache grows
+        self.assertFalse(ac.too_large('p00001'))
+        self.assertTrue(ac.get(FakePartition('p00001', 10000)))
+
+    def test_build_in_background(self):
+        """Without waiting, a missing partition is built on another thread, and is ready for later requests"""
+        from ambry_ui.artifacts import ArtifactCache
+        import threading
+
+        p1, p2 = FakePartition('p00001', 1000), FakePartition('p00002', 1000)
+        ac = ArtifactCache(FakeLibrary(self.root, [p1, p2]), flush_size=1024)
+
+        t = ac.start_build(p1.vid)
+        t.join()
+
+        self.assertTrue(ac.exists(p1.vid))
+        self.assertTrue(ac.get(p1, wait=False))
+
+        self.assertIsNone(ac.get(p2, wait=False))  # Returns at once, while the build goes on
+
+        for t in threading.enumerate():
+            if t.name == 'artifact-p00002':
+                t.join()
+
+        self.assertTrue(ac.exists(p2.vid))
+
+    def test_evict_keeps_new_and_recent(self):
+        from ambry_ui.artifacts import ArtifactCache
+        import os
+        import time
+
+        ac = ArtifactCache(FakeLibrary(self.root), flush_size=1024)
+        ac.get(FakePartition('p00001', 1000))
+
+        for ext in ('csv', 'csv.gz', 'csv.idx'):
+            os.utime(ac.path('p00001', ext), (time.time() - 3600, time.time() - 3600))
+
+        ac.max_size = ac.size + 10  # Room for the first partition, but not the second
+        ac.get(FakePartition('p00002', 1000))
+
+        self.assertTrue(ac.exists('p00002'))  # Just built
+        self.assertFalse(ac.exists('p00001'))
+
+        ac.get(FakePartition('p00003', 1000))
+
+        self.assertTrue(ac.exists('p00002'))  # Used within EVICT_GRACE
+        self.assertTrue(ac.exists('p00003'))
+
+    def test_rows(self):
+        from ambry_ui import artifacts
+        from ambry_ui.artifacts import ArtifactCache
+
+        interval = artifacts.INDEX_INTERVAL
+        artifacts.INDEX_INTERVAL = 7
+
+        try:
+            ac = ArtifactCache(FakeLibrary(self.root), flush_size=100)
+            p = FakePartition('p00001', 100)
+
+            headers, count, rows = ac.rows(p, 0, 3)
+            self.assertEqual(['id', 'name'], headers)
+            self.assertEqual(100, count)
+            self.assertEqual([['0', 'row 0'], ['1', 'row 1'], ['2', 'row 2']], rows)
+
+            for offset in (6, 7, 8, 50, 98):
+                headers, count, rows = ac.rows(p, offset, 2)
+                self.assertEqual([[str(i), 'row {}'.format(i)] for i in range(offset, min(offset + 2, 100))], rows)
+
+            self.assertEqual([], ac.rows(p, 100, 10)[2])
+        finally:
+            artifacts.INDEX_INTERVAL = interval
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -56,5 +56,213 @@ class MyTestCase(TestCase):
 
         self.assertEqual('bar',r.json['foo'])
 
+    def test_conditional(self):
+
+        r = self.client.get('/json')
+        self.assert200(r)
+
+        etag = r.headers['ETag']
+        self.assertIn('max-age', r.headers['Cache-Control'])
+
+        r = self.client.get('/json', headers={'If-None-Match': etag})
+        self.assertStatus(r, 304)
+        self.assertEqual(etag, r.headers['ETag'])
+
+        r = self.client.get('/json', headers={'If-None-Match': '"other"'})
+        self.assert200(r)
+
+    def test_conditional_access(self):
+        """A matching If-None-Match doesn't skip the access check for a bundle that isn't public"""
+
+        b = self.make_bundle(n_partitions=1)
+        p = list(b.partitions)[0]
+
+        r = self.client.get('/json/partition/{}/rows'.format(p.vid), headers={'If-None-Match': '*'})
+        self.assertIn(r.status_code, (401, 403))
+
+    def test_conditional_max_age(self):
+        """Checking a bundle in again keeps its vid, so bundle documents are revalidated after a few minutes"""
+        from ambry_ui import get_library, library_changed
+
+        b = self.make_bundle(n_partitions=1)
+        url = '/json/bundle/{}'.format(b.identity.vid)
+
+        r = self.client.get(url)
+        self.assertEqual('public, max-age=300, must-revalidate', r.headers['Cache-Control'])
+
+        library_changed(get_library(), 'checkin', b.identity.vid)
+
+        self.assertNotEqual(r.headers['ETag'], self.client.get(url).headers['ETag'])
+
+    def test_conditional_outside_changes(self):
+        """A bundle added outside of the UI changes the tag of listings once the catalog is reloaded"""
+        from ambry_ui import catalog as catalog_module
+
+        r = self.client.get('/json')
+        etag = r.headers['ETag']
+
+        load_records = catalog_module.load_records
+
+        def load_with_new_bundle(library):
+            return load_records(library) + [dict(vid='d000outside001', state='finalized', updated_time=1)]
+
+        catalog_module.load_records = load_with_new_bundle
+        catalog_module.catalog._loaded = 0  # As if CATALOG_TTL has passed
+
+        try:
+            r = self.client.get('/json', headers={'If-None-Match': etag})
+            self.assertNotEqual(etag, r.headers['ETag'])
+        finally:
+            catalog_module.load_records = load_records
+            catalog_module.catalog.invalidate()
+
+    def make_bundle(self, n_partitions=4, n_columns=6, dataset='querytest'):
+        """Add a bundle with several partitions, columns and column stats to the library, and remove it
+        when the test ends"""
+        from ambry_ui import get_library, library_changed
+
+        l = get_library()
+
+        b = l.new_bundle(source='example.com', dataset=dataset, assignment_class='self')
+
+        t = b.dataset.new_table('measures')
+
+        for i in range(n_columns):
+            t.add_column('col{}'.format(i), datatype='int', description='Column {}'.format(i))
+
+        for i in range(n_partitions):
+            p = b.dataset.new_partition(t, time=str(2010 + i))
+
+            for c in t.columns:
+                p.add_stat(c.vid, dict(count=100, nuniques=10, min=0, max=99, mean=49.5))
+
+        l.commit()
+
+        vid = b.identity.vid
+        library_changed(l, 'checkin', vid)
+
+        def remove():
+            l.remove(l.bundle(vid))
+            l.commit()
+            library_changed(l, 'remove', vid)
+
+        self.addCleanup(remove)
+
+        return l.bundle(vid)
+
+    def test_bundle_json_queries(self):
+        """The bundle and partition documents use the same number of queries, however many partitions,
+        columns and stats there are"""
+        from ambry_ui.queries import query_budget
+
+        small = self.make_bundle(n_partitions=2, n_columns=3, dataset='querytest-small')
+        large = self.make_bundle(n_partitions=6, n_columns=8, dataset='querytest-large')
+
+        self.assertEqual(2, len(list(small.partitions)))
+        self.assertEqual(6, len(list(large.partitions)))
+
+        self.assert200(self.client.get('/json'))  # Load the catalog, so neither bundle pays for it
+
+        counts = {}
+
+        for b in (small, large):
+            with query_budget(15, max_repeats=3) as stats:
+                self.assert200(self.client.get('/json/bundle/{}'.format(b.identity.vid)))
+
+            counts[b.identity.vid] = [stats.count]
+
+            for p in b.partitions:
+                with query_budget(15, max_repeats=3) as stats:
+                    r = self.client.get('/json/partition/{}'.format(p.vid))
+                    self.assert200(r)
+
+                counts[b.identity.vid].append(stats.count)
+
+                columns = json.loads(r.data)['partition']['table']['columns']
+                self.assertTrue(all(c['stats'] for c in columns))
+
+        small_counts, large_counts = counts[small.identity.vid], counts[large.identity.vid]
+
+        self.assertEqual(small_counts[0], large_counts[0])  # Bundle documents
+        self.assertEqual(set(small_counts[1:]), set(large_counts[1:]))  # Partition documents
+
+    def test_metrics_access(self):
+        """The metrics are only served to allowed addresses"""
+
+        for url in ('/metrics', '/json/stats'):
+            self.assert200(self.client.get(url))  # The test client's address is 127.0.0.1
+            self.assert403(self.client.get(url, environ_base={'REMOTE_ADDR': '192.0.2.1'}))
+
+    def test_server_timing(self):
+
+        r = self.client.get('/json')
+        self.assert200(r)
+        self.assertIn('db;dur=', r.headers['Server-Timing'])
+
+    def test_session_per_thread(self):
+        """Requests in different threads share the library, but not the database session"""
+        import threading
+        from ambry_ui import get_library
+
+        l = get_library()
+        found = {}
+
+        def run():
+            found['library'] = get_library()
+            found['session'] = l.database.session()
+            l.database.session.remove()
+
+        t = threading.Thread(target=run)
+        t.start()
+        t.join()
+
+        self.assertIs(l, found['library'])
+        self.assertIsNot(l.database.session(), found['session'])
+
+        # The contract scope_sessions() relies on: ambry's Database.session returns Database._session
+        from sqlalchemy.orm import scoped_session
+        self.assertIsInstance(l.database.session, scoped_session)
+        self.assertIs(l.database._session, l.database.session)
+
+    def test_cache_per_process(self):
+        """Threads that get the object cache at the same time, before it exists, get the same cache"""
+        import threading
+        from ambry_ui import cache
+
+        cache._cache = None
+        found = []
+
+        threads = [threading.Thread(target=lambda: found.append(cache.get_cache())) for i in range(8)]
+
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(8, len(found))
+        self.assertEqual(1, len(set(id(c) for c in found)))
+        self.assertIs(found[0], cache.get_cache())
+
+    def test_bounded_pool(self):
+        """The replacement pool keeps the listeners and dialect of the engine's pool"""
+        from sqlalchemy import create_engine, event
+        from ambry_ui import bounded_pool
+
+        engine = create_engine('sqlite:////tmp/bounded_pool.db')
+        connects = []
+
+        event.listen(engine, 'connect', lambda conn, record: connects.append(conn))
+
+        old_pool = engine.pool
+        engine.pool = bounded_pool(old_pool, dict(LIBRARY_POOL_SIZE=2, LIBRARY_POOL_OVERFLOW=1,
+                                                  LIBRARY_POOL_RECYCLE=60))
+        old_pool.dispose()
+
+        self.assertEqual(2, engine.pool.size())
+        self.assertIs(old_pool._dialect, engine.pool._dialect)
+
+        engine.execute('SELECT 1')
+        self.assertEqual(1, len(connects))
+
 if __name__ == '__main__':
     unittest.main()
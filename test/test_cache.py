@@ -0,0 +1,136 @@
+import unittest
+
+
+class CacheTest(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+
+        shutil.rmtree(self.root)
+
+    def new_cache(self, max_bytes=10000, generation=None):
+        from ambry_ui.cache import TieredCache
+
+        return TieredCache(self.root, max_bytes, generation=generation, group=lambda vid: vid or '_global',
+                           check_interval=0)
+
+    def test_memory_lru(self):
+        from ambry_ui.cache import MemoryLRU, MISSING
+
+        m = MemoryLRU(100)
+
+        m.set('a', 1, 40)
+        m.set('b', 2, 40)
+        self.assertEqual(1, m.get('a'))  # b is now the least recently used
+
+        m.set('c', 3, 40)
+
+        self.assertIs(MISSING, m.get('b'))
+        self.assertEqual(1, m.get('a'))
+        self.assertEqual(3, m.get('c'))
+        self.assertEqual(80, m.size)
+        self.assertEqual(1, m.evictions)
+        self.assertEqual(dict(items=2, bytes=80, hits=3, misses=1, evictions=1), m.stats())
+
+        self.assertFalse(m.set('d', 4, 101))
+        self.assertIs(MISSING, m.get('d'))
+
+    def test_tiers(self):
+        from ambry_ui.cache import MISSING
+
+        c = self.new_cache()
+
+        self.assertIs(MISSING, c.get('md', 'd001', 'x'))
+
+        c.set('md', 'd001', {'a': 1}, 'x')
+        self.assertEqual({'a': 1}, c.get('md', 'd001', 'x'))
+        self.assertIs(MISSING, c.get('md', 'd001', 'y'))
+        self.assertIs(MISSING, c.get('other', 'd001', 'x'))
+
+        # Another worker, with an empty memory tier, reads the value from disk
+        c2 = self.new_cache()
+        self.assertEqual({'a': 1}, c2.get('md', 'd001', 'x'))
+        self.assertEqual({'a': 1}, c2.get('md', 'd001', 'x'))
+
+        s = c2.stats()
+        self.assertEqual(1, s['disk_hits'])
+        self.assertEqual(1, s['memory_hits'])
+
+        s = c.stats()
+        self.assertEqual(1, s['memory_hits'])
+        self.assertEqual(3, s['misses'])
+
+    def test_get_or_set(self):
+        c = self.new_cache()
+
+        calls = []
+
+        def f(vid, n):
+            calls.append(n)
+            return [vid] * n
+
+        self.assertEqual(['d001'] * 3, c.get_or_set('f', 'd001', f, 3))
+        self.assertEqual(['d001'] * 3, c.get_or_set('f', 'd001', f, 3))
+        self.assertEqual(['d001'] * 2, c.get_or_set('f', 'd001', f, 2))
+        self.assertEqual([3, 2], calls)
+
+    def test_invalidate(self):
+        from ambry_ui.cache import MISSING
+
+        c = self.new_cache()
+
+        c.set('md', 'd001', 1)
+        c.set('md', 'd002', 2)
+
+        c.invalidate('d001')
+
+        self.assertIs(MISSING, c.get('md', 'd001'))
+        self.assertEqual(2, c.get('md', 'd002'))
+        self.assertIs(MISSING, self.new_cache().get('md', 'd001'))
+
+        c.invalidate()
+        self.assertIs(MISSING, c.get('md', 'd002'))
+
+    def test_generation(self):
+        from ambry_ui.cache import MISSING
+
+        gen = [1]
+
+        c = self.new_cache(generation=lambda: gen[0])
+        c.set('md', 'd001', 1)
+        self.assertEqual(1, c.get('md', 'd001'))
+
+        # Another worker invalidated the bundle, which removed the file and bumped the generation.
+        self.new_cache().disk.remove_group('d001')
+        gen[0] = 2
+
+        self.assertIs(MISSING, c.get('md', 'd001'))
+
+    def test_disk_eviction(self):
+        import os
+        from ambry_ui.cache import DiskCache
+
+        d = DiskCache(self.root, max_bytes=2500)
+
+        for i, key in enumerate(['a', 'b', 'c']):
+            DiskCache(self.root).set('d001', key, 'x' * 1000)  # Written by another worker
+            os.utime(d.path('d001', key), (1000 + i, 1000 + i))
+
+        self.assertEqual('x' * 1000, d.get('d001', 'a'))  # Now the most recently used
+
+        # Writing more than a tenth of the limit checks the size, and removes the least recently used files
+        d.set('d002', 'd', 'x' * 1000)
+
+        self.assertEqual(2, d.evictions)
+        self.assertIsNone(d.get('d001', 'b'))
+        self.assertIsNone(d.get('d001', 'c'))
+        self.assertEqual(['a', 'd'], sorted(os.path.basename(p)[:-4] for _, _, p in d.files()))
+
+
+if __name__ == '__main__':
+    unittest.main()
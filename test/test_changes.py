@@ -0,0 +1,176 @@
+import unittest
+
+
+def record(vid, created, updated):
+    return dict(vid=vid, created_time=str(created), updated_time=str(updated))
+
+
+class ChangesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.records = [
+            record('d001', 100, 200),
+            record('d002', 150, 300),
+            record('d003', 250, 300),
+        ]
+
+        self.events = [
+            dict(time=400.0, event='remove', vid='d004'),
+            dict(time=500.0, event='checkin', vid='d001'),  # Checked in with an old build time
+            dict(time=600.0, event='remove', vid='d002'),  # Still exists, so it was added back outside the UI
+        ]
+
+    def all_changes(self, since=None, limit=2):
+        from ambry_ui.changes import changes
+
+        out = []
+
+        while True:
+            page, since, more = changes(self.records, self.events, since=since, limit=limit)
+            out += page
+            if not more:
+                return out, since
+
+    def test_changes(self):
+        from ambry_ui.changes import changes
+
+        out, cursor = self.all_changes()
+
+        # d001 was created before the cursor for the second page
+        self.assertEqual([('d002', 'added', 300), ('d003', 'added', 300), ('d004', 'removed', 400),
+                          ('d001', 'updated', 500)],
+                         [(c['vid'], c['event'], c['time']) for c in out])
+
+        self.assertIsNone(out[2]['record'])
+        self.assertEqual('d001', out[3]['record']['vid'])
+
+        # Nothing after the last cursor
+        self.assertEqual(([], cursor, False), changes(self.records, self.events, since=cursor))
+
+        # Changes after a time are updates for bundles created before it
+        out, _ = self.all_changes(since='300')
+
+        self.assertEqual([('d004', 'removed'), ('d001', 'updated')], [(c['vid'], c['event']) for c in out])
+
+    def test_page_boundary(self):
+        from ambry_ui.changes import changes
+
+        # The page ends between two changes with the same time
+        page, cursor, more = changes(self.records, self.events, since='250', limit=1)
+
+        self.assertEqual(['d002'], [c['vid'] for c in page])
+        self.assertTrue(more)
+
+        page, cursor, more = changes(self.records, self.events, since=cursor, limit=1)
+        self.assertEqual(['d003'], [c['vid'] for c in page])
+
+    def test_bad_cursor(self):
+        from ambry_ui.changes import changes, CursorError
+
+        with self.assertRaises(CursorError):
+            changes(self.records, self.events, since='abc')
+
+    def test_log(self):
+        import tempfile
+        import shutil
+        from ambry_ui.changes import record_event, read_events
+        from .fakes import FakeLibrary
+
+        root = tempfile.mkdtemp()
+
+        try:
+            l = FakeLibrary(root)
+
+            self.assertEqual([], read_events(l))
+
+            record_event(l, 'checkin', 'd001', t=1.0)
+            record_event(l, 'remove', 'd002', t=2.0)
+
+            self.assertEqual([dict(time=1.0, event='checkin', vid='d001'), dict(time=2.0, event='remove', vid='d002')],
+                             read_events(l))
+        finally:
+            shutil.rmtree(root)
+
+    def test_read_since(self):
+        """Reading events after a time seeks into the log, and gives the same changes as reading all of it"""
+        import tempfile
+        import shutil
+        from ambry_ui.changes import record_event, read_events, changes
+        from .fakes import FakeLibrary
+
+        root = tempfile.mkdtemp()
+
+        try:
+            l = FakeLibrary(root)
+
+            for i in range(200):
+                record_event(l, 'remove', 'd{:03d}'.format(i), t=1000.0 + i)
+
+            for t in (0, 999.5, 1000.0, 1000.5, 1100.0, 1199.0, 1199.5, 5000.0):
+                self.assertEqual([e for e in read_events(l) if e['time'] >= t], read_events(l, since=t))
+
+            since = changes([], read_events(l), limit=150)[1]
+
+            self.assertEqual(changes([], read_events(l), since=since),
+                             changes([], read_events(l, since=1149.0), since=since))
+
+            with open(l.filesystem.cache('ui') + '/changes.ndjson', 'a') as f:
+                f.write('{"time": 1')  # Being written by another worker
+
+            self.assertEqual(1, len(read_events(l, since=1199.0)))
+        finally:
+            shutil.rmtree(root)
+
+
+    def test_partitions(self):
+        import tempfile
+        import shutil
+        from ambry_ui.changes import partition_changes, record_event, read_events, changes
+        from .fakes import FakeLibrary
+
+        root = tempfile.mkdtemp()
+
+        try:
+            l = FakeLibrary(root)
+
+            # No partitions were recorded for the bundle, so the current ones are taken as updated
+            p = partition_changes(l, 'd001', ['p001', 'p002'])
+            self.assertEqual(dict(added=[], updated=['p001', 'p002'], removed=[]), p)
+            record_event(l, 'checkin', 'd001', t=100.0, partitions=p)
+
+            p = partition_changes(l, 'd001', ['p002', 'p003'])
+            self.assertEqual(dict(added=['p003'], updated=['p002'], removed=['p001']), p)
+            record_event(l, 'checkin', 'd001', t=200.0, partitions=p)
+
+            record_event(l, 'save', 'd001', t=250.0)
+
+            records = [record('d001', 50, 60)]
+
+            page = changes(records, read_events(l), since='150')[0]
+            self.assertEqual({'p001': 'removed', 'p002': 'updated', 'p003': 'added'}, page[0]['partitions'])
+
+            # Removed after being added, then added back, since the cursor
+            p = partition_changes(l, 'd001', ['p002'])
+            record_event(l, 'sync', 'd001', t=300.0, partitions=p)
+            p = partition_changes(l, 'd001', ['p002', 'p003'])
+            record_event(l, 'sync', 'd001', t=400.0, partitions=p)
+
+            page = changes(records, read_events(l), since='150')[0]
+            self.assertEqual({'p001': 'removed', 'p002': 'updated', 'p003': 'added'}, page[0]['partitions'])
+
+            p = partition_changes(l, 'd001', [])
+            self.assertEqual(dict(added=[], updated=[], removed=['p002', 'p003']), p)
+            record_event(l, 'remove', 'd001', t=500.0, partitions=p)
+
+            page = changes([], read_events(l), since='450')[0]
+            self.assertEqual('removed', page[0]['event'])
+            self.assertEqual({'p002': 'removed', 'p003': 'removed'}, page[0]['partitions'])
+
+            # Bundles changed outside of the UI have no logged partition changes
+            self.assertIsNone(changes([record('d002', 50, 600)], [], since='550')[0][0]['partitions'])
+        finally:
+            shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    unittest.main()
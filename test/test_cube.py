@@ -0,0 +1,156 @@
+import unittest
+
+from .fakes import Obj, FakeLibrary
+
+
+headers = ['id', 'year', 'county', 'county_name', 'sex', 'population', 'comment']
+
+rows = [
+    [1, 2010, 'c1', 'Alpha', 'm', 10, 'row 1'],
+    [2, 2010, 'c1', 'Alpha', 'f', 12, 'row 2'],
+    [3, 2010, 'c1', 'Alpha', None, 22, 'row 3'],  # Total for both sexes
+    [4, 2010, 'c2', 'Beta', 'm', 5, 'row 4'],
+    [5, 2010, 'c2', 'Beta', 'f', 6, 'row 5'],
+    [6, 2010, 'c2', 'Beta', None, 11, 'row 6'],
+    [7, 2011, 'c1', 'Alpha', None, 25, 'row 7'],
+    [8, 2011, 'c2', 'Beta', None, None, 'row 8'],
+]
+
+
+def fake_partition(vid='p00test001001'):
+
+    dimension_sets = {
+        'year': dict(key='year', p_dim='year', p_label=None, s_dim=None, filters={'county': ['c1', 'c2']}),
+        'year/county': dict(key='year/county', p_dim='year', p_label=None, s_dim='county',
+                            s_label='county_name', filters={}),
+        'county/sex': dict(key='county/sex', p_dim='county', p_label='county_name', s_dim='sex', filters={}),
+    }
+
+    return Obj(
+        vid=vid,
+        vname=vid,
+        localize=lambda: None,
+        measuredim=Obj(dict=dict(dimension_sets=dimension_sets)),
+        reader=Obj(headers=headers, rows=iter(rows)),
+        table=Obj(columns=[Obj(vid='c00test00100{}'.format(i), name=h) for i, h in enumerate(headers)])
+    )
+
+
+class CubeTest(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+
+        self.root = tempfile.mkdtemp()
+        self.library = FakeLibrary(self.root, [fake_partition()])
+
+    def tearDown(self):
+        import shutil
+
+        shutil.rmtree(self.root)
+
+    def totals(self, cube, measure, primary, secondary=None, filters=None):
+        """Return the aggregates as a dict of dimension values to sums"""
+        p_codes, s_codes, sums, counts = cube.aggregate(measure, primary, secondary, filters)
+
+        p_values = cube.values(primary)
+
+        if secondary is None:
+            return {p_values[p]: sums[p] for p in p_codes}
+
+        s_values = cube.values(secondary)
+
+        return {(p_values[p], s_values[s]): sums[p, s] for p in p_codes for s in s_codes if counts[p, s]}
+
+    def test_aggregate(self):
+        from ambry_ui.cube import get_cube
+
+        c = get_cube(self.library, 'p00test001001')
+
+        self.assertEqual(8, c.n_rows)
+        self.assertTrue(c.columns['population']['numeric'])
+        self.assertFalse(c.columns['county']['numeric'])
+
+        # Only dimensions and labels are encoded, and other text columns are dropped
+        self.assertTrue(c.columns['county_name']['encoded'])
+        self.assertFalse(c.columns['population']['encoded'])
+        self.assertNotIn('comment', c.columns)
+
+        with self.assertRaises(ValueError):
+            c.codes('population')
+
+        # Sex isn't plotted, so its total rows are used
+        self.assertEqual({2010: 33, 2011: 25}, self.totals(c, 'population', 'year'))
+        self.assertEqual({2010: 22, 2011: 25}, self.totals(c, 'population', 'year', filters={'county': 'c1'}))
+        self.assertEqual({2010: 22, 2011: 25}, self.totals(c, 'c00test001005', 'year', filters={'county': 'c1'}))
+        self.assertEqual({}, self.totals(c, 'population', 'year', filters={'county': 'c3'}))
+
+        self.assertEqual({(2010, 'c1'): 22, (2010, 'c2'): 11, (2011, 'c1'): 25},
+                         self.totals(c, 'population', 'year', 'county'))
+
+        self.assertEqual({('c1', 'm'): 10, ('c1', 'f'): 12, ('c2', 'm'): 5, ('c2', 'f'): 6},
+                         self.totals(c, 'population', 'county', 'sex'))
+
+        # Filter values from the query string are strings
+        self.assertEqual({'c1': 10, 'c2': 5}, self.totals(c, 'population', 'county', filters={'sex': 'm',
+                                                                                            'year': '2010'}))
+
+    def test_group(self):
+        """One grouped pass over a filter dimension gives the same sums as filtering for each value"""
+        from ambry_ui.cube import get_cube
+
+        c = get_cube(self.library, 'p00test001001')
+
+        sums, counts = c.group('population', ['year', 'county'])
+
+        for county in ('c1', 'c2'):
+            p_codes, _, f_sums, f_counts = c.aggregate('population', 'year', filters={'county': county})
+
+            code = c.code('county', county)
+            self.assertEqual(list(f_sums), list(sums[:, code]))
+            self.assertEqual(list(f_counts), list(counts[:, code]))
+
+    def test_variants(self):
+        from ambry_ui.cube import get_cube
+
+        c = get_cube(self.library, 'p00test001001')
+
+        variants = c.variants('population', 'county', None, {'year': [2010, 2011, 2012]})
+
+        self.assertEqual([{}, {'year': 2010}, {'year': 2011}, {'year': 2012}], [f for f, df in variants])
+
+        df = variants[1][1]
+        self.assertEqual('county_name', df.index.name)
+        self.assertEqual({'Alpha': 22, 'Beta': 11}, df['population'].to_dict())
+
+        self.assertEqual({'Alpha': 25}, variants[2][1]['population'].to_dict())
+        self.assertEqual(0, len(variants[3][1]))
+
+    def test_labels(self):
+        from ambry_ui.cube import get_cube
+
+        c = get_cube(self.library, 'p00test001001')
+
+        self.assertEqual('county_name', c.label('county'))
+        self.assertEqual('year', c.label('year'))
+
+        codes = c._first_codes('county', 'county_name')
+        self.assertEqual(['Alpha', 'Beta'], [c.values('county_name')[i] for i in codes])
+
+    def test_remove(self):
+        import os
+        from ambry_ui.cube import get_cube, cube_path, remove
+
+        c = get_cube(self.library, 'p00test001001')
+        self.assertIs(c, get_cube(self.library, 'p00test001001'))
+
+        self.assertEqual(1, remove(self.library))
+        self.assertFalse(os.path.exists(cube_path(self.library, 'p00test001001')))
+
+        # Rebuilt on the next request
+        self.library.partitions['p00test001001'] = fake_partition()
+        self.assertIsNot(c, get_cube(self.library, 'p00test001001'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import unittest
+
+
+class DownsampleTest(unittest.TestCase):
+
+    def series(self, n=10000):
+        import numpy as np
+
+        x = np.arange(n, dtype=float)
+        y = np.sin(x / 500.0)
+        y[n // 3] = 10  # A spike, which both methods must keep
+
+        return x, y
+
+    def test_lttb(self):
+        from ambry_ui.downsample import lttb
+
+        x, y = self.series()
+
+        idx = lttb(x, y, 200)
+
+        self.assertEqual(200, len(idx))
+        self.assertEqual(0, idx[0])
+        self.assertEqual(len(x) - 1, idx[-1])
+        self.assertTrue((idx[1:] > idx[:-1]).all())
+        self.assertIn(len(x) // 3, idx)
+
+        self.assertEqual(list(range(10)), list(lttb(x[:10], y[:10], 200)))
+
+    def test_minmax(self):
+        from ambry_ui.downsample import minmax
+
+        x, y = self.series()
+
+        idx = minmax(x, y, 200)
+
+        self.assertLessEqual(len(idx), 200)
+        self.assertIn(0, idx)
+        self.assertIn(len(x) - 1, idx)
+        self.assertIn(len(x) // 3, idx)
+        self.assertIn(int(y[1:5000].argmin()) + 1, idx)
+
+    def test_nan(self):
+        import numpy as np
+        from ambry_ui.downsample import lttb, minmax
+
+        x, y = self.series(1000)
+        y[100:300] = np.nan
+
+        for f in (lttb, minmax):
+            idx = f(x, y, 50)
+            self.assertFalse(np.isnan(y[idx[(idx < 100) | (idx >= 300)]]).any())
+
+    def test_frame(self):
+        import numpy as np
+        import pandas as pd
+        from ambry_ui.downsample import downsample_frame
+
+        x, y = self.series(5000)
+
+        df = pd.DataFrame({'a': y, 'b': -y}, index=pd.Index(x[::-1], name='year'))
+
+        out = downsample_frame(df, 100)
+
+        self.assertTrue(out.index.is_monotonic_increasing)
+        self.assertLessEqual(len(out), 200)
+        self.assertEqual(5000, len(downsample_frame(df, 0)))
+
+        with self.assertRaises(ValueError):
+            downsample_frame(df, 100, 'median')
+
+        with self.assertRaises(ValueError):
+            downsample_frame(df, -1)
+
+
+if __name__ == '__main__':
+    unittest.main()
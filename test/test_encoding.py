@@ -0,0 +1,80 @@
+import unittest
+
+
+class EncodingTest(unittest.TestCase):
+
+    def test_types(self):
+        import json
+        from datetime import datetime, date
+        from decimal import Decimal
+        from uuid import UUID
+        from ambry_ui.encoding import dumps
+
+        u = UUID('12345678123456781234567812345678')
+
+        d = json.loads(dumps(dict(dt=datetime(2015, 6, 1, 12, 30), d=date(2015, 6, 1), dec=Decimal('1.5'),
+                                  u=u, s={1}, o=object())))
+
+        self.assertEqual('2015-06-01T12:30:00', d['dt'])
+        self.assertEqual('2015-06-01', d['d'])
+        self.assertEqual(1.5, d['dec'])
+        self.assertEqual(str(u), d['u'])
+        self.assertEqual([1], d['s'])
+        self.assertIn('object', d['o'])
+
+    def test_stdlib_encoder(self):
+        """The encoder used when Flask's json module has no C extension converts the same types"""
+        from datetime import date
+        from decimal import Decimal
+        from ambry_ui.encoding import StdlibJSONEncoder, dumps
+
+        o = dict(d=date(2015, 6, 1), dec=Decimal('1.5'), l=[1, 'a'])
+
+        self.assertEqual(dumps(o), StdlibJSONEncoder(separators=(',', ':'), sort_keys=False).encode(o))
+
+    def test_numpy(self):
+        import json
+        from ambry_ui.encoding import dumps
+
+        try:
+            import numpy as np
+        except ImportError:
+            raise unittest.SkipTest('numpy is not installed')
+
+        d = json.loads(dumps(dict(i=np.int64(3), f=np.float32(0.5), b=np.bool_(True), a=np.arange(3))))
+
+        self.assertEqual(dict(i=3, f=0.5, b=True, a=[0, 1, 2]), d)
+
+    def test_iter_list(self):
+        import json
+        from ambry_ui.encoding import iter_list
+
+        for n in (0, 1, 5, 10, 23):
+            items = [dict(i=i) for i in range(n)]
+
+            chunks = list(iter_list('bundles', iter(items), chunk_size=5, total=n))
+
+            self.assertEqual(dict(bundles=items, total=n), json.loads(''.join(chunks)))
+
+        self.assertEqual(dict(bundles=[1, 2]), json.loads(''.join(iter_list('bundles', [1, 2]))))
+
+    def test_iter_ndjson(self):
+        import json
+        from ambry_ui.encoding import iter_ndjson
+
+        items = [dict(vid='d{:03d}'.format(i), name='n{}'.format(i), title='t') for i in range(250)]
+
+        chunks = list(iter_ndjson(items, chunk_size=100))
+        self.assertEqual(3, len(chunks))
+
+        lines = ''.join(chunks).splitlines()
+        self.assertEqual(items, [json.loads(l) for l in lines])
+
+        lines = ''.join(iter_ndjson(items, fields=['vid', 'missing'])).splitlines()
+        self.assertEqual([dict(vid=i['vid']) for i in items], [json.loads(l) for l in lines])
+
+        self.assertEqual([], list(iter_ndjson([])))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import unittest
+
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+
+        shutil.rmtree(self.root)
+
+    def test_registry(self):
+        from ambry_ui.metrics import Registry, render
+
+        r = Registry(self.root)
+
+        r.inc('ambry_ui_requests_total', dict(endpoint='index', method='GET', status='200'))
+        r.inc('ambry_ui_requests_total', dict(endpoint='index', method='GET', status='200'))
+        r.observe('ambry_ui_request_duration_seconds', dict(endpoint='index'), 0.02)
+        r.observe('ambry_ui_request_duration_seconds', dict(endpoint='index'), 3)
+        r.gauge_add('ambry_ui_requests_in_flight')
+
+        text = render(r.collect())
+
+        self.assertIn('# TYPE ambry_ui_requests_total counter', text)
+        self.assertIn('ambry_ui_requests_total{endpoint="index",method="GET",status="200"} 2', text)
+        self.assertIn('ambry_ui_request_duration_seconds_bucket{endpoint="index",le="0.01"} 0', text)
+        self.assertIn('ambry_ui_request_duration_seconds_bucket{endpoint="index",le="0.025"} 1', text)
+        self.assertIn('ambry_ui_request_duration_seconds_bucket{endpoint="index",le="+Inf"} 2', text)
+        self.assertIn('ambry_ui_request_duration_seconds_count{endpoint="index"} 2', text)
+        self.assertIn('ambry_ui_requests_in_flight 1', text)
+
+    def test_workers(self):
+        """Metrics from other workers are added up, and exited workers' counters are archived"""
+        import json
+        import os
+        from ambry_ui.metrics import Registry, _key
+
+        dead_pid = 2 ** 22 + 1  # Larger than the default pid_max
+
+        with open(os.path.join(self.root, '{}.json'.format(dead_pid)), 'w') as f:
+            json.dump(dict(counters={_key('c', {}): 5}, gauges={_key('g', {}): 3}, histograms={}), f)
+
+        r = Registry(self.root)
+        r.inc('c')
+        r.gauge_add('g')
+
+        data = r.collect()
+
+        self.assertEqual(6, data['counters'][_key('c', {})])
+        self.assertEqual(1, data['gauges'][_key('g', {})])
+        self.assertFalse(os.path.exists(os.path.join(self.root, '{}.json'.format(dead_pid))))
+
+        r.inc('c')
+        self.assertEqual(7, r.collect()['counters'][_key('c', {})])
+
+    def test_middleware(self):
+        from ambry_ui.metrics import Registry, MetricsMiddleware, _key
+
+        def app(environ, start_response):
+            environ['ambry_ui.endpoint'] = 'stream_file'
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return iter(['a' * 10, 'b' * 5])
+
+        r = Registry(self.root)
+        m = MetricsMiddleware(app, r)
+
+        statuses = []
+        body = m({'REQUEST_METHOD': 'GET'}, lambda s, h, e=None: statuses.append(s))
+
+        self.assertEqual(1, r.gauges[_key('ambry_ui_requests_in_flight', {})])
+
+        self.assertEqual('a' * 10 + 'b' * 5, ''.join(body))
+        body.close()
+
+        self.assertEqual(['200 OK'], statuses)
+        self.assertEqual(0, r.gauges[_key('ambry_ui_requests_in_flight', {})])
+        self.assertEqual(15, r.counters[_key('ambry_ui_response_bytes_total', dict(endpoint='stream_file'))])
+        self.assertEqual(1, r.counters[_key('ambry_ui_requests_total',
+                                            dict(endpoint='stream_file', method='GET', status='200'))])
+        self.assertEqual(1, r.histograms[_key('ambry_ui_response_duration_seconds',
+                                              dict(endpoint='stream_file'))][2])
+
+    def test_unmatched_endpoint(self):
+        from ambry_ui.metrics import Registry, MetricsMiddleware, _key
+
+        def app(environ, start_response):
+            start_response('404 NOT FOUND', [])
+            return iter([''])
+
+        r = Registry(self.root)
+        body = MetricsMiddleware(app, r)({'REQUEST_METHOD': 'GET'}, lambda s, h, e=None: None)
+        list(body)
+        body.close()
+
+        self.assertEqual(1, r.counters[_key('ambry_ui_requests_total',
+                                            dict(endpoint='unmatched', method='GET', status='404'))])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import unittest
+
+from .fakes import FakeLibrary
+
+
+def fake_convert(contents):
+    return u'<div>{}</div>'.format(contents)
+
+
+class NotebooksTest(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        from ambry_ui import notebooks
+
+        self.root = tempfile.mkdtemp()
+        self.convert = notebooks.convert
+        notebooks.convert = fake_convert
+
+    def tearDown(self):
+        import shutil
+        from ambry_ui import notebooks
+
+        notebooks.convert = self.convert
+        shutil.rmtree(self.root)
+
+    def test_render(self):
+        import os
+        from ambry_ui.notebooks import render, cache_path
+
+        l = FakeLibrary(self.root)
+
+        self.assertEqual(u'<div>v1</div>', render(l, 'f1', 'v1', timeout=30))
+        self.assertTrue(os.path.exists(cache_path(l, 'f1', 'v1')))
+
+        # Served from the cache, without converting
+        with open(cache_path(l, 'f1', 'v1'), 'w') as f:
+            f.write('cached')
+
+        self.assertEqual(u'cached', render(l, 'f1', 'v1'))
+
+        # A new version replaces the old one
+        self.assertEqual(u'<div>v2</div>', render(l, 'f1', 'v2', timeout=30))
+        self.assertFalse(os.path.exists(cache_path(l, 'f1', 'v1')))
+
+    def test_prerender(self):
+        from ambry_ui.notebooks import prerender, render
+
+        l = FakeLibrary(self.root)
+
+        result = prerender(l, 'f2', 'v1')
+        result.wait(30)
+
+        self.assertIsNone(prerender(l, 'f2', 'v1'))
+        self.assertEqual(u'<div>v1</div>', render(l, 'f2', 'v1', timeout=0))
+
+
+if __name__ == '__main__':
+    unittest.main()
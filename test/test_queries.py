@@ -0,0 +1,51 @@
+import unittest
+
+
+class QueriesTest(unittest.TestCase):
+
+    def test_statement_shape(self):
+        from ambry_ui.queries import statement_shape
+
+        a = statement_shape("SELECT * FROM columnstats WHERE cs_c_vid = 'c00001001' AND n > 10")
+        b = statement_shape("SELECT * FROM columnstats\n  WHERE cs_c_vid = 'c00001002' AND n > 2")
+
+        self.assertEqual(a, b)
+        self.assertEqual('SELECT * FROM columnstats WHERE cs_c_vid = ? AND n > ?', a)
+
+        self.assertEqual(statement_shape('SELECT a FROM t1 WHERE id IN (?, ?, ?)'),
+                         statement_shape('SELECT a FROM t1 WHERE id IN (%(id_1)s, %(id_2)s)'))
+
+    def test_budget(self):
+        from ambry_ui.queries import query_budget, QueryBudgetExceeded, _after_cursor_execute, recording
+
+        class FakeConnection(object):
+            info = {}
+
+        def execute(statement):
+            _after_cursor_execute(FakeConnection(), None, statement, None, None, False)
+
+        with recording() as outer:
+            with query_budget(3) as stats:
+                execute('SELECT 1')
+                execute('SELECT 2')
+
+        self.assertEqual(2, stats.count)
+        self.assertEqual(2, outer.count)
+        self.assertEqual([(2, 'SELECT ?')], stats.repeated(1))
+
+        execute('SELECT 3')  # Not recorded
+        self.assertEqual(2, outer.count)
+
+        with self.assertRaises(QueryBudgetExceeded):
+            with query_budget(3):
+                for i in range(4):
+                    execute('SELECT * FROM t WHERE id = {}'.format(i))
+
+        with self.assertRaises(QueryBudgetExceeded):
+            with query_budget(10, max_repeats=2):
+                for i in range(3):
+                    execute('SELECT * FROM t WHERE id = {}'.format(i))
+
+
+if __name__ == '__main__':
+    unittest.main()
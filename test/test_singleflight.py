@@ -0,0 +1,82 @@
+import unittest
+
+
+class SingleFlightTest(unittest.TestCase):
+
+    def test_concurrent_calls(self):
+        import os
+        import threading
+        import time
+        import tempfile
+        import shutil
+        from ambry_ui import singleflight
+
+        lock_dir = tempfile.mkdtemp()
+        fetched = []
+
+        def localize():
+            # Only the first caller does the slow fetch; later calls find the file already local.
+            if not fetched:
+                time.sleep(.2)
+                fetched.append(threading.current_thread().name)
+
+        threads = [threading.Thread(target=singleflight.run, args=('test', 'p1', localize, lock_dir))
+                   for i in range(5)]
+
+        try:
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+            singleflight.run('test', 'p1', localize, lock_dir)
+
+            self.assertEqual([], os.listdir(lock_dir))  # Lock files are removed after the runs
+        finally:
+            shutil.rmtree(lock_dir)
+
+        self.assertEqual(1, len(fetched))
+
+        stats = singleflight.stats('test')
+        self.assertEqual(6, stats['calls'])
+        self.assertEqual(1, stats['leaders'])
+        self.assertEqual(4, stats['waits'])
+        self.assertEqual(1, stats['hits'])
+
+    def test_done_is_bounded(self):
+        from ambry_ui import singleflight
+
+        for i in range(singleflight.MAX_DONE + 10):
+            singleflight.run('test-bounded', i, lambda: None)
+
+        self.assertEqual(singleflight.MAX_DONE, len(singleflight._done))
+
+        singleflight.run('test-bounded', 0, lambda: None)  # Forgotten, so it leads again
+        self.assertEqual(singleflight.MAX_DONE + 11, singleflight.stats('test-bounded')['leaders'])
+
+    def test_start(self):
+        """A background call isn't started while another call for the same key is running"""
+        import threading
+        from ambry_ui import singleflight
+
+        release = threading.Event()
+        calls = []
+
+        def build():
+            calls.append(1)
+            release.wait(5)
+
+        t = singleflight.start('test-start', 'p1', build)
+        self.assertIsNone(singleflight.start('test-start', 'p1', build))
+
+        release.set()
+        t.join()
+
+        singleflight.start('test-start', 'p1', build).join()
+
+        self.assertEqual(2, len(calls))
+        self.assertEqual(1, singleflight.stats('test-start')['hits'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,198 @@
+import unittest
+
+
+def make_rows(n):
+    return [[i, 'row {}'.format(i), i * 1.5, None] for i in range(n)]
+
+
+class StreamingTest(unittest.TestCase):
+
+    headers = ['id', 'name', 'value', 'empty']
+
+    def test_csv_blocks(self):
+        from ambry_ui.streaming import CsvEncoder
+        import unicodecsv as csv
+        from cStringIO import StringIO
+
+        rows = make_rows(5000)
+
+        blocks = list(CsvEncoder(flush_size=4096)(self.headers, rows))
+
+        self.assertTrue(len(blocks) > 1)
+        self.assertTrue(all(len(b) >= 4096 for b in blocks[:-1]))
+        self.assertTrue(all(len(b) < 4096 + 100 for b in blocks))
+
+        out = list(csv.reader(StringIO(''.join(blocks))))
+
+        self.assertEqual(self.headers, out[0])
+        self.assertEqual(5001, len(out))
+        self.assertEqual(['4999', 'row 4999', '7498.5', ''], out[-1])
+
+    def test_csv_index(self):
+        from ambry_ui.streaming import CsvEncoder
+
+        encoder = CsvEncoder(flush_size=100, index_interval=10)
+
+        data = ''.join(encoder(self.headers, make_rows(95)))
+
+        self.assertEqual(95, encoder.n_rows)
+        self.assertEqual(10, len(encoder.offsets))
+
+        for i, offset in enumerate(encoder.offsets):
+            self.assertTrue(data[offset:].startswith('{},row {},'.format(i * 10, i * 10)))
+
+    def test_csv_no_rows(self):
+        from ambry_ui.streaming import CsvEncoder
+
+        self.assertEqual(['id,name,value,empty\r\n'], list(CsvEncoder()(self.headers, [])))
+        self.assertEqual([], list(CsvEncoder()(None, [])))
+
+    def test_mpack_rows(self):
+        from ambry_ui.streaming import MsgpackEncoder
+        import msgpack
+
+        rows = make_rows(2500)
+
+        blocks = list(MsgpackEncoder(batch_size=1000)(self.headers, rows))
+
+        self.assertEqual(3, len(blocks))
+
+        out = list(msgpack.Unpacker(msgpack_stream(blocks)))
+
+        self.assertEqual(self.headers, out[0])
+        self.assertEqual(rows, out[1:])
+
+    def test_mpack_columns(self):
+        from ambry_ui.streaming import ColumnarMsgpackEncoder
+        import msgpack
+
+        rows = make_rows(2500)
+
+        out = list(msgpack.Unpacker(msgpack_stream(ColumnarMsgpackEncoder(batch_size=1000)(self.headers, rows))))
+
+        self.assertEqual({'format': 'columnar', 'headers': self.headers}, out[0])
+        self.assertEqual([0, 1000, 2000], [b['offset'] for b in out[1:]])
+        self.assertEqual([1000, 1000, 500], [b['n'] for b in out[1:]])
+        self.assertEqual(range(2000, 2500), out[3]['columns'][0])
+        self.assertEqual([None] * 500, out[3]['columns'][3])
+
+    def test_parse_where(self):
+        from ambry_ui.streaming import parse_where, FilterError
+
+        self.assertEqual(('county', 'eq', '06073'), parse_where('county:06073'))
+        self.assertEqual(('name', 'eq', 'in:out'), parse_where('name:eq:in:out'))
+        self.assertEqual(('county', 'in', ['1', '2']), parse_where('county:in:1,2'))
+        self.assertEqual(('year', 'range', ['2000', '']), parse_where('year:range:2000,'))
+
+        with self.assertRaises(FilterError):
+            parse_where('county')
+
+        with self.assertRaises(FilterError):
+            parse_where('year:range:2000')
+
+    def test_row_filter(self):
+        from ambry_ui.streaming import RowFilter, FilterError
+
+        rows = make_rows(100)
+        types = {'id': int, 'name': str, 'value': float}
+
+        rf = RowFilter(self.headers, columns=['name', 'id'], where=['id:range:10,19', 'value:in:15,28.5'],
+                       types=types)
+
+        self.assertEqual(['name', 'id'], rf.headers)
+        self.assertEqual([('row 10', 10), ('row 19', 19)], list(rf(rows)))
+
+        rf = RowFilter(self.headers, columns=['id'], where=['empty:'], types=types)
+        self.assertEqual(100, len(list(rf(rows))))
+        self.assertEqual((99,), list(rf(rows))[-1])
+
+        rf = RowFilter(self.headers, where=['id:range:,2'], types=types)
+        self.assertEqual(rows[:3], list(rf(rows)))
+
+        with self.assertRaises(FilterError):
+            RowFilter(self.headers, columns=['foo'])
+
+        with self.assertRaises(FilterError):
+            RowFilter(self.headers, where=['id:abc'], types=types)
+
+    def test_row_filter_unicode(self):
+        from ambry_ui.streaming import RowFilter, FilterError
+
+        rows = [[1, u'S\xe3o Paulo'], [2, u'Zurich'], [3, u'Z\xfcrich']]
+        headers = ['id', 'name']
+
+        rf = RowFilter(headers, where=[u'name:S\xe3o Paulo'], types={'name': str})
+        self.assertEqual([rows[0]], list(rf(rows)))
+
+        rf = RowFilter(headers, where=[u'name:in:Zurich,Z\xfcrich'], types={'name': str})
+        self.assertEqual(rows[1:], list(rf(rows)))
+
+        with self.assertRaises(FilterError):
+            RowFilter(headers, where=[u'id:\xe9'], types={'id': int})
+
+    def test_row_filter_dates(self):
+        from datetime import date, datetime, time
+        from ambry_ui.streaming import RowFilter, FilterError
+
+        headers = ['id', 'day', 'at', 'clock']
+        rows = [[i, date(2015, 1, i + 1), datetime(2015, 1, i + 1, 12, 30), time(i, 15)] for i in range(10)]
+        types = {'id': int, 'day': date, 'at': datetime, 'clock': time}
+
+        rf = RowFilter(headers, columns=['id'], where=['day:range:2015-01-03,2015-01-05'], types=types)
+        self.assertEqual([(2,), (3,), (4,)], list(rf(rows)))
+
+        rf = RowFilter(headers, columns=['id'], where=['at:2015-01-02T12:30:00'], types=types)
+        self.assertEqual([(1,)], list(rf(rows)))
+
+        rf = RowFilter(headers, columns=['id'], where=['at:range:2015-01-09,'], types=types)
+        self.assertEqual([(8,), (9,)], list(rf(rows)))
+
+        rf = RowFilter(headers, columns=['id'], where=['clock:range:,01:15'], types=types)
+        self.assertEqual([(0,), (1,)], list(rf(rows)))
+
+        with self.assertRaises(FilterError):
+            RowFilter(headers, where=['day:2015-13-01'], types=types)
+
+    def test_head_and_sample(self):
+        from ambry_ui.streaming import head_and_sample
+
+        rows = make_rows(10000)
+
+        head, sample, count = head_and_sample(rows, 100, seed='p00001')
+
+        self.assertEqual(10000, count)
+        self.assertEqual(rows[:100], head)
+        self.assertEqual(100, len(sample))
+        self.assertEqual(sorted(sample), sample)
+        self.assertTrue(sample[-1][0] > 5000)
+        self.assertEqual(sample, head_and_sample(rows, 100, seed='p00001')[1])
+
+        self.assertEqual((rows[:5], rows[:5], 5), head_and_sample(rows[:5], 10))
+        self.assertEqual(([], [], 0), head_and_sample([], 10))
+
+    def test_gzip_chunks(self):
+        import zlib
+        from ambry_ui.streaming import gzip_chunks
+
+        chunks = ['line {}\n'.format(i) * 10 for i in range(1000)]
+
+        blocks = list(gzip_chunks(iter(chunks), flush_size=1000))
+
+        self.assertTrue(len(blocks) > 10)
+        self.assertEqual(''.join(chunks), zlib.decompress(''.join(blocks), 16 + zlib.MAX_WBITS))
+
+        # The data flushed so far can be decompressed before the stream ends
+        d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.assertTrue(d.decompress(''.join(blocks[:len(blocks) // 2])).startswith('line 0'))
+
+        self.assertEqual('', zlib.decompress(''.join(gzip_chunks([])), 16 + zlib.MAX_WBITS))
+
+
+def msgpack_stream(blocks):
+    from cStringIO import StringIO
+
+    return StringIO(''.join(blocks))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+import unittest
+
+
+class ZipStreamTest(unittest.TestCase):
+
+    def test_archive(self):
+        from ambry_ui.zipstream import ZipStream, STORED
+        from cStringIO import StringIO
+        import zipfile
+
+        csv = ''.join('{},row {}\n'.format(i, i) for i in range(20000))
+
+        zs = ZipStream()
+
+        def generate():
+            chunks = (csv[i:i + 1000] for i in range(0, len(csv), 1000))
+            for data in zs.write_iter('bundle/data.csv', chunks):
+                yield data
+            for data in zs.write_str(u'bundle/sources/caf\xe9.txt', u'caf\xe9'):
+                yield data
+            for data in zs.write_str('bundle/empty.txt', ''):
+                yield data
+            zs.compression = STORED
+            for data in zs.write_str('bundle/stored.txt', 'stored'):
+                yield data
+            for data in zs.close():
+                yield data
+
+        archive = ''.join(generate())
+
+        self.assertTrue(len(archive) < len(csv))
+
+        zf = zipfile.ZipFile(StringIO(archive))
+
+        self.assertIsNone(zf.testzip())
+        self.assertEqual(['bundle/data.csv', u'bundle/sources/caf\xe9.txt', 'bundle/empty.txt', 'bundle/stored.txt'],
+                         zf.namelist())
+        self.assertEqual(csv, zf.read('bundle/data.csv'))
+        self.assertEqual(u'caf\xe9'.encode('utf-8'), zf.read(u'bundle/sources/caf\xe9.txt'))
+        self.assertEqual('', zf.read('bundle/empty.txt'))
+        self.assertEqual('stored', zf.read('bundle/stored.txt'))
+
+
+if __name__ == '__main__':
+    unittest.main()